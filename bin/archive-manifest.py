@@ -12,10 +12,13 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --header-index=FILE sqlite index of archive headers to read from and
+                         update (see datman.headerindex)
 """
 
 import datman
 import datman.utils
+import datman.headerindex
 import dicom
 import tarfile
 import zipfile
@@ -35,11 +38,13 @@ def main():
     from docopt import docopt
     import sys
     arguments = docopt(__doc__)
+    index = datman.headerindex.open_index(arguments['--header-index'])
 
     if arguments['--showheaders']:
         for archive in arguments['<archive>']:
             manifest = datman.utils.get_archive_headers(archive, 
-                                                        stop_after_first=False)
+                                                        stop_after_first=False,
+                                                        index=index)
             filepath, headers = manifest.items()[0] 
             print ",".join([archive,filepath])
             print "\t"+"\n\t".join(headers.dir())
@@ -51,7 +56,7 @@ def main():
 
     rows = []
     for archive in arguments['<archive>']:
-        manifest = datman.utils.get_archive_headers(archive)
+        manifest = datman.utils.get_archive_headers(archive, index=index)
         sortedseries = sorted(manifest.iteritems(), 
                               key = lambda x: x[1].get('SeriesNumber'))
         for path, dataset in sortedseries:
@@ -23,11 +23,31 @@ Options:
                             exam folders found in <examsdir/> must have this
                             text in their name.
     --ignore-headers LIST   Comma delimited list of headers to ignore
+    --jobs N                Number of exams to check in parallel [default: 1]
+    --force                 Check every exam, even those unchanged since they
+                            were last checked
     --verbose               Print mismatches to stdout as well as the log file
+
+DETAILS
+
+    The comparison against each gold standard is worked out once, up front:
+    which headers to compare, and with what tolerance. A header with both a
+    long and a short name (e.g. ReferencedImageSequence and RefdImageSequence)
+    is compared, and reported, under each name that isn't ignored.
+
+    Each exam is only checked again if its folder has been modified, or the
+    standards, ignored headers or tolerances have changed, since it was last
+    checked. When the exams were last checked is recorded in <logdir/> in
+    dm-check-headers.yml. A series that is rewritten in place does not modify
+    its exam folder, so use --force to check such exams again.
 """
 
 import sys
+import hashlib
+import itertools
 import collections
+import multiprocessing
+import yaml
 from docopt import docopt
 import dicom as dcm
 import datman as dm
@@ -141,6 +161,12 @@ DEFAULT_TOLERANCES = Tolerances(
     integer=INTEGER_TOLERANCES,
     decimal=DECIMAL_TOLERANCES)
 
+# record of when each exam was last checked, kept in the log folder
+STATE_FILE = 'dm-check-headers.yml'
+
+# map from tag -> (stdpath, HeaderPlan) of the standards being checked against
+PLANS = None
+
 
 def get_gold_standard_headers(path):
     """Fetches the gold standard headers.
@@ -156,81 +182,166 @@ def get_gold_standard_headers(path):
     return map
 
 
-def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
-    """
-    Accepts two pydicom objects and prints out header value differences.
+# a single comparison of a compiled HeaderPlan: the header is found by key
+# (tag number, for dicom datasets) and compared according to kind ('integer',
+# 'decimal' or 'exact'). expected is the gold standard value, and reference
+# the form of it that values are compared against.
+Check = collections.namedtuple(
+    'Check', ['header', 'kind', 'tolerance', 'expected', 'reference'])
 
-    Headers in ignore set are ignored.
+# header names for each tag number, looked up once
+TAG_NAMES = {}
 
-    Returns a tuple containing a list of mismatched headers (as a list of
-    Mismatch objects)
+
+def header_names(hdr):
     """
+    Returns a dict mapping the key of each named header in hdr to its names.
 
-    tolerances = tolerances or DEFAULT_TOLERANCES
-    ignore_headers = ignore_headers or []
+    For pydicom datasets the keys are the tag numbers, so that values can be
+    fetched without looking names up. Other objects (anything with dir() and
+    get()) are keyed by name.
+    """
+    if not isinstance(hdr, dcm.dataset.Dataset):
+        return {name: [name] for name in hdr.dir()}
 
-    # dir() is expensive so we cache results here
-    stdhdr_names = stdhdr.dir()
-    cmphdr_names = cmphdr.dir()
+    names = {}
+    for tag in hdr.keys():
+        if tag not in TAG_NAMES:
+            TAG_NAMES[tag] = [n for n in dcm.datadict.all_names_for_tag(tag)
+                              if n]
+        if TAG_NAMES[tag]:
+            names[tag] = TAG_NAMES[tag]
+    return names
 
-    # get the unignored headers
-    headers = set(stdhdr_names).union(cmphdr_names).difference(ignore_headers)
 
-    mismatches = []  # list of Mismatches
+def header_value(hdr, key):
+    if isinstance(hdr, dcm.dataset.Dataset):
+        return hdr[key].value
+    return hdr.get(key)
 
-    for header in headers:
-        if header not in stdhdr_names:
-            mismatches.append(Mismatch(
-                header=header, expected=None, actual=cmphdr.get(header), tolerance=None))
-            continue
 
-        if header not in cmphdr_names:
-            mismatches.append(Mismatch(
-                header=header, expected=stdhdr.get(header), actual=None, tolerance=None))
-            continue
+class HeaderPlan:
+    """
+    The comparisons to make against a gold standard header, worked out once.
 
-        stdval = stdhdr.get(header)
-        cmpval = cmphdr.get(header)
+    The plan holds a Check for each name of the gold standard's headers that
+    isn't ignored, with its tolerance and the standard value already rounded,
+    so comparing a header is a lookup and a compare per name. As with the
+    names dir() gives, a header with a long and a short name is checked (and
+    reported) under both.
+    """
 
-        # integer level tolerance
+    def __init__(self, stdhdr, tolerances=None, ignore_headers=None):
+        tolerances = tolerances or DEFAULT_TOLERANCES
+        self.ignore_headers = set(ignore_headers or [])
+        self.checks = {}
+
+        for key, names in header_names(stdhdr).iteritems():
+            headers = self.checked_names(names)
+            if not headers:
+                continue
+
+            stdval = header_value(stdhdr, key)
+            self.checks[key] = [self.check(header, stdval, tolerances)
+                                for header in headers]
+
+    def check(self, header, stdval, tolerances):
         if header in tolerances.integer:
             n = tolerances.integer[header]
-
-            stdval_rounded = np.round(float(stdval))
+            return Check(header, 'integer', n, stdval, np.round(float(stdval)))
+        if header in tolerances.decimal:
+            n = tolerances.decimal[header]
+            return Check(header, 'decimal', n, stdval, round(float(stdval), n))
+        return Check(header, 'exact', None, stdval, str(stdval))
+
+    def checked_names(self, names):
+        """
+        Returns those of a header's names that aren't ignored.
+        """
+        return [name for name in names if name not in self.ignore_headers]
+
+    def compare(self, cmphdr):
+        """
+        Returns a list of Mismatches between the standard and cmphdr.
+        """
+        cmpnames = header_names(cmphdr)
+        mismatches = []
+
+        for key, checks in self.checks.iteritems():
+            if key not in cmpnames:
+                for check in checks:
+                    mismatches.append(Mismatch(
+                        header=check.header, expected=check.expected, actual=None, tolerance=None))
+
+        for key, names in cmpnames.iteritems():
+            if key not in self.checks:
+                for header in self.checked_names(names):
+                    mismatches.append(Mismatch(
+                        header=header, expected=None, actual=header_value(cmphdr, key), tolerance=None))
+                continue
+
+            cmpval = header_value(cmphdr, key)
+            for check in self.checks[key]:
+                mismatch = self.compare_value(check, cmpval)
+                if mismatch:
+                    mismatches.append(mismatch)
+
+        return mismatches
+
+    def compare_value(self, check, cmpval):
+        """
+        Returns a Mismatch if cmpval doesn't pass check, or None.
+        """
+        # integer level tolerance
+        if check.kind == 'integer':
             cmpval_rounded = np.round(float(cmpval))
-            difference = np.abs(stdval_rounded - cmpval_rounded)
-
-            if difference > n:
-                mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
+            difference = np.abs(check.reference - cmpval_rounded)
+            if difference > check.tolerance:
+                return Mismatch(
+                    header=check.header, expected=check.reference, actual=cmpval_rounded, tolerance=check.tolerance)
 
         # decimal level tolerance
-        elif header in tolerances.decimal:
-            n = tolerances.decimal[header]
+        elif check.kind == 'decimal':
+            cmpval_rounded = round(float(cmpval), check.tolerance)
+            if cmpval_rounded != check.reference:
+                return Mismatch(
+                    header=check.header, expected=check.reference, actual=cmpval_rounded, tolerance=check.tolerance)
 
-            stdval_rounded = round(float(stdval), n)
-            cmpval_rounded = round(float(cmpval), n)
+        # no tolerance set
+        elif str(cmpval) != check.reference:
+            return Mismatch(
+                header=check.header, expected=check.expected, actual=cmpval, tolerance=None)
 
-            if stdval_rounded != cmpval_rounded:
-                mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
+        return None
 
-        # no tolerance set
-        elif str(cmpval) != str(stdval):
-            mismatches.append(Mismatch(
-                header=header, expected=stdval, actual=cmpval, tolerance=None))
 
-    return mismatches
+def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
+    """
+    Accepts two pydicom objects and prints out header value differences.
+
+    Headers in ignore set are ignored.
+
+    Returns a tuple containing a list of mismatched headers (as a list of
+    Mismatch objects)
+    """
+    return HeaderPlan(stdhdr, tolerances, ignore_headers).compare(cmphdr)
 
 
-def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
+def compile_plans(stdmap, ignore_headers, tolerances=None):
     """
-    Compares headers for each series in an exam against gold standards
+    Returns a map from tag -> (stdpath, HeaderPlan) for a map of the standard
+    headers (see get_gold_standard_headers).
+    """
+    return {tag: (stdpath, HeaderPlan(stdhdr, tolerances, ignore_headers))
+            for tag, (stdpath, stdhdr) in stdmap.iteritems()}
 
-    <stdmap> is a map from description -> (cmppath, headers) of all of the
-    standard headers to compare against.
 
-    <ignore_headers> is a list of headers to ignore.
+def compare_exam_headers(plans, examdir):
+    """
+    Compares headers for each series in an exam against gold standards
+
+    <plans> is a map from tag -> (stdpath, HeaderPlan) of all of the
+    standard headers to compare against (see compile_plans).
     """
     exam_headers = dm.utils.get_all_headers_in_folder(examdir)
 
@@ -238,21 +349,71 @@ def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
     for cmppath, cmphdr in exam_headers.iteritems():
         ident, tag, series, description = dm.scanid.parse_filename(cmppath)
 
-        if tag not in stdmap:
+        if tag not in plans:
             log.warning(
                 "{}: No matching standard for tag '{}'".format(cmppath, tag))
             continue
 
-        stdpath, stdhdr = stdmap[tag]
-        mismatches = compare_headers(
-            stdhdr, cmphdr, tolerances, ignore_headers)
+        stdpath, plan = plans[tag]
+        mismatches = plan.compare(cmphdr)
         if mismatches:
             all_mismatches[cmppath] = mismatches
 
     return all_mismatches
 
 
+def check_exam(examdir):
+    """
+    Compares an exam against the standards in PLANS. Returns the examdir, the
+    number of mismatched series, and a log message for each mismatch.
+    """
+    all_mismatches = compare_exam_headers(PLANS, examdir)
+
+    messages = []
+    for path, mismatches in all_mismatches.iteritems():
+        for m in mismatches:
+            messages.append("{}: header {}, expected = {}, actual = {} [tolerance = {}]".format(
+                path, m.header, m.expected, m.actual, m.tolerance))
+    return examdir, len(all_mismatches), messages
+
+
+def standards_signature(standardsdir, ignore_headers, tolerances):
+    """
+    Returns a string that changes whenever the gold standards (their files,
+    sizes and modification times), ignored headers or tolerances do.
+    """
+    files = []
+    for dirname, dirnames, filenames in os.walk(standardsdir):
+        for filename in filenames:
+            st = os.stat(os.path.join(dirname, filename))
+            files.append((os.path.join(dirname, filename), st.st_size, st.st_mtime))
+    signature = repr((sorted(files), sorted(ignore_headers),
+                      sorted(tolerances.integer.items()),
+                      sorted(tolerances.decimal.items())))
+    return hashlib.sha1(signature).hexdigest()
+
+
+def load_state(statefile):
+    """
+    Loads the record of when each exam was last checked: a map from exam name
+    to the exam folder's modification time, and the standards signature.
+    """
+    if not os.path.exists(statefile):
+        return {}
+    with open(statefile, 'r') as stream:
+        return yaml.safe_load(stream) or {}
+
+
+def save_state(statefile, state):
+    tmpfile = statefile + '.tmp'
+    with open(tmpfile, 'w') as stream:
+        yaml.safe_dump(state, stream, default_flow_style=False)
+    os.rename(tmpfile, statefile)
+
+
 def main():
+    global PLANS
+
     arguments = docopt(__doc__)
     standardsdir = arguments['<standards/>']
     logsdir = arguments['<logdir/>']
@@ -260,6 +421,8 @@ def main():
     verbose = arguments['--verbose']
     filtertext = arguments['--filter']
     ignore_headers = arguments['--ignore-headers']
+    jobs = int(arguments['--jobs'])
+    force = arguments['--force']
 
     log.basicConfig(
         level=log.WARN, format="[dm-check-headers] %(levelname)s: %(message)s")
@@ -280,33 +443,64 @@ def main():
     ignore_headers = ignore_headers and ignore_headers.split(",") or []
     ignore_headers = DEFAULT_IGNORED_HEADERS.union(ignore_headers)
 
-    stdmap = get_gold_standard_headers(standardsdir)
+    statefile = os.path.join(logsdir, STATE_FILE)
+    state = load_state(statefile)
+    standards = standards_signature(
+        standardsdir, ignore_headers, DEFAULT_TOLERANCES)
 
     globexpr = '*'
     if filtertext:
         globexpr = '*{}*'.format(filtertext)
 
+    examdirs = []
     for examdir in glob.glob('{}/{}/'.format(examsdir,globexpr)):
         if '_PHA_' in examdir:  # ignore phantoms
             continue
 
-        logfile = os.path.join(logsdir, "dm-check-headers-{}.log".format(
-            os.path.basename(os.path.normpath(examdir))))
-
-        all_mismatches = compare_exam_headers(stdmap, examdir, ignore_headers)
-        if not all_mismatches:
+        exam = os.path.basename(os.path.normpath(examdir))
+        mtime = os.path.getmtime(examdir)
+        if not force and state.get(exam) == [mtime, standards]:
+            log.debug('{} unchanged since last checked, skipping'.format(examdir))
             continue
+        examdirs.append((examdir, exam, mtime))
+
+    if not examdirs:
+        return
+
+    # the plans are inherited by the pool's worker processes
+    PLANS = compile_plans(get_gold_standard_headers(standardsdir),
+                          ignore_headers, DEFAULT_TOLERANCES)
+
+    exams = {examdir: (exam, mtime) for examdir, exam, mtime in examdirs}
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(check_exam, sorted(exams))
+    else:
+        pool = None
+        results = itertools.imap(check_exam, sorted(exams))
+
+    try:
+        for examdir, n_mismatches, messages in results:
+            exam, mtime = exams[examdir]
+            state[exam] = [mtime, standards]
+
+            if not messages:
+                continue
 
-        if not os.path.exists(logfile):  # display warning on first encounter
-            log.warn('{} mismatches for exam {}'.format(len(all_mismatches), examdir))
+            logfile = os.path.join(logsdir, "dm-check-headers-{}.log".format(exam))
+            if not os.path.exists(logfile):  # display warning on first encounter
+                log.warn('{} mismatches for exam {}'.format(n_mismatches, examdir))
 
-        with open(logfile, "w") as fname:
-            for path, mismatches in all_mismatches.iteritems():
-                for m in mismatches:
-                    message = "{}: header {}, expected = {}, actual = {} [tolerance = {}]".format(
-                        path, m.header, m.expected, m.actual, m.tolerance)
+            with open(logfile, "w") as fname:
+                for message in messages:
                     log.info(message)
                     fname.write(message + "\n")
+    finally:
+        # keep the record of the exams checked so far, even if one failed
+        save_state(statefile, state)
+        if pool:
+            pool.close()
+            pool.join()
 
 if __name__ == '__main__':
     main()
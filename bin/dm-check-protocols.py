@@ -11,6 +11,8 @@ Arguments:
     <exportinfo>       exportinfo.csv file containing expected counts
 
 Options:
+    --catalog FILE     sqlite catalog of <datadir> to look files up in (and
+                       refresh), instead of listing every subject folder
     --verbose          Be chatty
 
 DETAILS
@@ -32,8 +34,8 @@ def check_protocol_length(data, expected):
     if len(data) != expected:
         raise ValueError
 
-def find_niftis_with_tag(datadir, tag):
-    files = dm.utils.get_files_with_tag(datadir, tag)
+def find_niftis_with_tag(datadir, tag, catalog=None):
+    files = dm.utils.get_files_with_tag(datadir, tag, catalog=catalog)
     files = filter(lambda x: '.nii.gz' in x, files)
 
     return files
@@ -44,8 +46,9 @@ def main():
     datadir         = arguments['<datadir>']
     exportinfo      = arguments['<exportinfo>']
     VERBOSE         = arguments['--verbose']
+    catalog         = dm.catalog.open_catalog(arguments['--catalog'], datadir)
 
-    subjects = dm.utils.get_subjects(datadir)
+    subjects = dm.utils.get_subjects(datadir, catalog)
     subjects = filter(lambda x: '_PHA_' not in x, subjects)
 
     # import data, get dimensions
@@ -74,7 +77,7 @@ def main():
         subjdir = os.path.join(datadir, sub)
 
         for tag in tags_expected:
-            files = find_niftis_with_tag(subjdir, tag)
+            files = find_niftis_with_tag(subjdir, tag, catalog)
             tags_found[tag] = len(files)
 
         # compare the protocols
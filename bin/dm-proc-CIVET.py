@@ -58,10 +58,10 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import glob
 import os.path
 import sys
-import subprocess
 import datetime
 import tempfile
 import shutil
@@ -94,7 +94,7 @@ QCedTranfer = False if rawQCfile == None else True
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 # need to find the t1 weighted scan and update the checklist
 def doCIVETlinking(colname, archive_tag, civet_ext):
@@ -16,7 +16,9 @@ Options:
                        This script should accept the following arguments:
                             dwifile outputdir ref_vol fa_threshold
     --tag TAG          A string to filter inputs by [ex. site name]
-    --walltime TIME    A walltime to pass to qbatch [default: 0:30:00]
+    --walltime TIME    A walltime for each job [default: 0:30:00]
+    --pack             Pack several DWIs into each array task, as many as are
+                       expected to fit in the walltime going by earlier runs
     --quiet            Be quiet
     --verbose          Be chatty
     --debug            Be extra chatty
@@ -29,8 +31,9 @@ import logging as log
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.scheduler
 import os
-import tempfile
+import sys
 import time
 
 DRYRUN = False
@@ -46,6 +49,7 @@ def main():
     script    = arguments['--script']
     TAG       = arguments['--tag']
     walltime  = arguments['--walltime']
+    pack      = arguments['--pack']
     quiet     = arguments['--quiet']
     debug     = arguments['--debug']
     verbose   = arguments['--verbose']
@@ -97,15 +101,17 @@ def main():
         os.chdir(outputdir)
         log.debug("queueing up the following commands:\n"+'\n'.join(commands))
         jobname = "dm_dtifit_{}".format(time.strftime("%Y%m%d-%H%M%S"))
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write('\n'.join(commands))
-            tmp.flush()
-            cmd = "qbatch --walltime {wt} --logdir {logdir} -N {name} {file} ".format(
-                wt = walltime,
-                logdir = logdir,
-                name = jobname,
-                file = tmp.name)
-            dm.utils.run(cmd, dryrun=DRYRUN)
+        chunksize = 1
+        if pack:
+            chunksize = dm.scheduler.packed_chunksize(logdir, 'dm_dtifit_',
+                                                      walltime)
+        sched = dm.scheduler.get_scheduler(dryrun=DRYRUN)
+        try:
+            sched.submit(commands, jobname, logdir=logdir, walltime=walltime,
+                         chunksize=chunksize, packed=pack)
+        except dm.scheduler.SchedulerException, e:
+            log.error("Job submission failed: {}".format(e))
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -62,6 +62,7 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.scheduler
 import glob
 import os
 import sys
@@ -99,11 +100,6 @@ runenigmash_name = 'run_engimadti.sh'
 runconcatsh_name = 'concatresults.sh'
 
 ### Erin's little function for running things in the shell
-def docmd(cmd):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print cmd
-    rtn, out, err = dm.utils.run(cmd, dryrun = DRYRUN)
-
 # need to find the t1 weighted scan and update the checklist
 def find_FAimages(archive_tag,archive_tag2):
     """
@@ -296,6 +292,7 @@ find_FAimages(FA_tag,TAG2)
 #if no submits that subject to the queue
 jobnameprefix="edti_{}_".format(datetime.datetime.today().strftime("%Y%m%d-%H%M%S"))
 submitted = False
+sched = dm.scheduler.get_scheduler(dryrun=DRYRUN)
 
 for i in range(0,len(checklist)):
     subid = checklist['id'][i]
@@ -309,15 +306,16 @@ for i in range(0,len(checklist)):
     soutput = os.path.join(outputdir,subid)
     smap = checklist['FA_nii'][i]
     jobname = jobnameprefix + subid
-    docmd('echo bash -l {rundir}/{script} {output} {inputdir} | '
-          'qbatch -N {jobname} --logdir {logdir} --walltime {wt} -'.format(
-            rundir = run_dir,
-            script = runenigmash_name,
-            output = soutput,
-            inputdir = os.path.join(dtifit_dir,subid,smap),
-            jobname = jobname,
-            logdir = log_dir,
-            wt = walltime))
+    try:
+        sched.submit('bash -l {rundir}/{script} {output} {inputdir}'.format(
+                        rundir = run_dir,
+                        script = runenigmash_name,
+                        output = soutput,
+                        inputdir = os.path.join(dtifit_dir,subid,smap)),
+                     jobname, logdir = log_dir, walltime = walltime)
+    except dm.scheduler.SchedulerException, e:
+        print('ERROR: {}'.format(e))
+        continue
 
     checklist['date_ran'][i] = datetime.date.today()
     submitted = True
@@ -327,14 +325,14 @@ for i in range(0,len(checklist)):
 ## submit a final job that will consolidate the resutls after they are finished
 if submitted:
     os.chdir(run_dir)
-    docmd('echo bash -l {rundir}/{script} | '
-          'qbatch -N {jobname} --logdir {logdir} --afterok {hold} --walltime {wt} -'.format(
-            rundir = run_dir,
-            script = runconcatsh_name,
-            jobname = jobnameprefix + 'concat',
-            logdir = log_dir,
-            hold = jobnameprefix + '*',
-            wt = walltime_final))
+    try:
+        sched.submit('bash -l {rundir}/{script}'.format(
+                        rundir = run_dir,
+                        script = runconcatsh_name),
+                     jobnameprefix + 'concat', logdir = log_dir,
+                     afterok = [jobnameprefix + '*'], walltime = walltime_final)
+    except dm.scheduler.SchedulerException, e:
+        print('ERROR: {}'.format(e))
 
 ## write the checklist out to a file
 checklist.to_csv(checklistfile, sep=',', index = False)
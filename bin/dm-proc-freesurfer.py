@@ -70,6 +70,7 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.scheduler
 import glob
 import os
 import time
@@ -116,11 +117,6 @@ runPostsh_name = 'postfreesurfer.sh'
 ## two silly little things to find for the run script
 
 ### Erin's little function for running things in the shell
-def docmd(cmd):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print cmd
-    rtn, out, err = dm.utils.run(cmd, dryrun = DRYRUN)
-
 # need to find the t1 weighted scan and update the checklist
 def find_T1images(archive_tag):
     """
@@ -336,6 +332,7 @@ find_T1images(T1_tag)
 
 jobnameprefix="FS_{}_".format(datetime.datetime.today().strftime("%Y%m%d-%H%M%S"))
 submitted = False
+sched = dm.scheduler.get_scheduler(dryrun=DRYRUN)
 
 os.chdir(run_dir)
 if not POSTFS_ONLY:
@@ -374,15 +371,16 @@ if not POSTFS_ONLY:
                 T1s.append(os.path.join(inputdir,subid,basemap))
 
             ## submit this subject to the queue
-            docmd('echo bash -l {rundir}/{script} {subid} {T1s} | '
-                  'qbatch -N {jobname} --logdir {logdir} --walltime {wt} -'.format(
-                    rundir = run_dir,
-                    script = runFSsh_name,
-                    subid = subid,
-                    T1s = ' '.join(T1s),
-                    jobname = jobname,
-                    logdir = log_dir,
-                    wt = walltime))
+            try:
+                sched.submit('bash -l {rundir}/{script} {subid} {T1s}'.format(
+                                rundir = run_dir,
+                                script = runFSsh_name,
+                                subid = subid,
+                                T1s = ' '.join(T1s)),
+                             jobname, logdir = log_dir, walltime = walltime)
+            except dm.scheduler.SchedulerException, e:
+                print('ERROR: {}'.format(e))
+                continue
 
             ## add today date to the checklist
             checklist['date_ran'][i] = datetime.date.today()
@@ -393,14 +391,14 @@ if not POSTFS_ONLY:
 ## submit a final job that will consolidate the resutls after they are finished
 if not NO_POST and submitted:
     os.chdir(run_dir)
-    docmd('echo bash -l {rundir}/{script} | '
-          'qbatch -N {jobname} --logdir {logdir} --afterok {hold} --walltime {wt} -'.format(
-            rundir = run_dir,
-            script = runPostsh_name,
-            jobname = jobnameprefix + 'post',
-            logdir = log_dir,
-            hold = jobnameprefix + '*',
-            wt = walltime_post))
+    try:
+        sched.submit('bash -l {rundir}/{script}'.format(
+                        rundir = run_dir,
+                        script = runPostsh_name),
+                     jobnameprefix + 'post', logdir = log_dir,
+                     afterok = [jobnameprefix + '*'], walltime = walltime_post)
+    except dm.scheduler.SchedulerException, e:
+        print('ERROR: {}'.format(e))
 
 ## write the checklist out to a file
 checklist.to_csv(checklistfile, sep=',', index = False)
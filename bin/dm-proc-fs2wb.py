@@ -11,7 +11,7 @@ Arguments:
 
 Options:
   --prefix STR			   Tag for filtering subject directories
-  --walltime TIME          A walltime to pass to qbatch [default: 2:00:00]
+  --walltime TIME          A walltime for each subject's job [default: 2:00:00]
   --walltime-qc TIME       A walltime for the qc step [default: 2:00:00]
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
@@ -32,6 +32,7 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.scheduler
 import glob
 import os.path
 import sys
@@ -55,11 +56,6 @@ DRYRUN          = arguments['--dry-run']
 if DEBUG: print arguments
 
 ### Erin's little function for running things in the shell
-def docmd(cmd):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print cmd
-    rtn, out, err = dm.utils.run(cmd, dryrun = DRYRUN)
-
 epiclone = os.path.join(os.environ['DATMAN_ASSETSDIR'],'epitome','160404-ewd')
 
 ### build a template .sh file that gets submitted to the queue
@@ -187,6 +183,7 @@ checklist = checklist.append(newsubs_df)
 #if no submits that subject to the queue
 jobnameprefix="fs2wb_{}_".format(datetime.datetime.today().strftime("%Y%m%d-%H%M%S"))
 submitted = False
+sched = dm.scheduler.get_scheduler(dryrun=DRYRUN)
 
 for i in range(0,len(checklist)):
     subid = checklist['id'][i]
@@ -200,14 +197,15 @@ for i in range(0,len(checklist)):
 
     jobname = jobnameprefix + subid
     os.chdir(bin_dir)
-    docmd('echo bash -l {rundir}/{script} {subid} | '
-          'qbatch -N {jobname} --logdir {logdir} --walltime {wt} -'.format(
-            rundir = bin_dir,
-            script = runconvertsh,
-            subid = subid,
-            jobname = jobname,
-            logdir = logs_dir,
-            wt = walltime))
+    try:
+        sched.submit('bash -l {rundir}/{script} {subid}'.format(
+                        rundir = bin_dir,
+                        script = runconvertsh,
+                        subid = subid),
+                     jobname, logdir = logs_dir, walltime = walltime)
+    except dm.scheduler.SchedulerException, e:
+        print('ERROR: {}'.format(e))
+        continue
     checklist['date_converted'][i] = datetime.date.today()
     submitted = True
 
@@ -220,14 +218,14 @@ for i in range(0,len(checklist)):
 if submitted:
     os.chdir(bin_dir)
     #if any subjects have been submitted - submit an extract consolidation job to run at the end
-    docmd('echo bash -l {run_dir}/{script} | '
-          'qbatch -N {jobname} --logdir {logdir} --afterok {hold} --walltime {wt} -'.format(
-            run_dir = bin_dir,
-            script = runpostsh,
-            jobname = jobnameprefix + 'hcp_qc',
-            logdir = logs_dir,
-            hold = jobnameprefix + '*',
-            wt = walltime_qc))
+    try:
+        sched.submit('bash -l {run_dir}/{script}'.format(
+                        run_dir = bin_dir,
+                        script = runpostsh),
+                     jobnameprefix + 'hcp_qc', logdir = logs_dir,
+                     afterok = [jobnameprefix + '*'], walltime = walltime_qc)
+    except dm.scheduler.SchedulerException, e:
+        print('ERROR: {}'.format(e))
 
 ## write the checklist out to a file
 checklist.to_csv(checklistfile, sep=',', columns = cols, index = False)
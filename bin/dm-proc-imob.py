@@ -16,6 +16,8 @@ Arguments:
                         provided, all subjects in the project will be processed.
 Options:
     --walltime TIME     Walltime for each subject job [default: 2:00:00]
+    --pack              Pack several subjects into each job, as many as are
+                        expected to fit in the walltime going by earlier runs
     -v,--verbose        Verbose logging
     --debug             Debug logging
     --dry-run           Don't do anything.
@@ -262,6 +264,7 @@ def main():
     assets     = arguments['<assets>']
     sub        = arguments['<subject>']
     walltime   = arguments['--walltime']
+    pack       = arguments['--pack']
     verbose    = arguments['--verbose']
     debug      = arguments['--debug']
     dryrun     = arguments['--dry-run']
@@ -325,11 +328,7 @@ def main():
         if commands: 
             logger.debug("queueing up the following commands:\n"+'\n'.join(commands))
             jobname = "dm_imob_{}".format(time.strftime("%Y%m%d-%H%M%S"))
-            fd, path = tempfile.mkstemp() 
-            os.write(fd, '\n'.join(commands))
-            os.close(fd)
-
-            # using qbatch -i (individual jobs) rather than the default array
+            # using individual jobs (qbatch -i) rather than the default array
             # job to work around interaction between epitome scripts and PBS
             # tempdir names.
             #  
@@ -340,15 +339,18 @@ def main():
             # Epitome scripts do not properly escape the DIR_DATA when used, so
             # references to this path do not parse correctly (square brackets
             # being patterns in bash).
-            rtn, out, err = dm.utils.run('qbatch -i --logdir {logdir} -N {name} --walltime {wt} {cmds}'.format(
-                logdir = log_path,
-                name = jobname,
-                wt = walltime, 
-                cmds = path), dryrun = dryrun)
-
-            if rtn != 0:
-                logger.error("Job submission failed. Output follows.")
-                logger.error("stdout: {}\nstderr: {}".format(out,err))
+            chunksize = 1
+            if pack:
+                chunksize = dm.scheduler.packed_chunksize(log_path,
+                        'dm_imob_', walltime)
+
+            sched = dm.scheduler.get_scheduler(dryrun=dryrun)
+            try:
+                sched.submit(commands, jobname, logdir=log_path,
+                             walltime=walltime, individual=True,
+                             chunksize=chunksize, packed=pack)
+            except dm.scheduler.SchedulerException, e:
+                logger.error("Job submission failed: {}".format(e))
                 sys.exit(1)
 
 if __name__ == "__main__":
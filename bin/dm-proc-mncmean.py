@@ -24,8 +24,8 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import os.path
-import subprocess
 import sys
 import datetime
 
@@ -50,7 +50,7 @@ if DEBUG:
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 ## make the tmpdir
 dm.utils.makedirs(tmpdir)
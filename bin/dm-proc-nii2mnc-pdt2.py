@@ -22,12 +22,12 @@ from docopt import docopt
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import glob
 import tempfile
 import os.path
 import shutil
 import sys
-import subprocess
 
 
 arguments       = docopt(__doc__)
@@ -47,7 +47,7 @@ def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
     if not DRYRUN:
-        proc = subprocess.call(cmdlist)
+        dm.runner.run(cmdlist, capture=False)
 
 #mkdir a tmpdir for the
 tmpdir = tempfile.mkdtemp()
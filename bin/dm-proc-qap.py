@@ -22,7 +22,7 @@ Options:
     --func_tags TAGS     A comma separated list of strings to filter functional 
                          inputs by [default: RST] 
                          
-    --walltime TIME      A walltime to pass to qbatch for each subject processing
+    --walltime TIME      A walltime for each subject processing job
                          [default: 1:00:00]
                          
     --quiet              Be quiet
@@ -37,7 +37,6 @@ import datman
 import docopt
 import glob
 import logging as log
-import tempfile
 import time
 import os
 import yaml
@@ -130,21 +129,12 @@ def main():
 
     if commands:
         log.debug("queueing up the following commands:\n" + '\n'.join(commands))
-        fd, path = tempfile.mkstemp()
-        os.write(fd, '\n'.join(commands))
-        os.close(fd)
-
         jobname = "dm_qap_{}".format(time.strftime("%Y%m%d-%H%M%S"))
-        rtn, out, err = datman.utils.run(
-            'qbatch --logdir {logdir} -N {name} --walltime {wt} {cmds}'.format(
-                logdir=logdir,
-                name=jobname,
-                wt=walltime,
-                cmds=path), dryrun=dryrun)
-
-        if rtn != 0:
-            log.error("Job {} submission failed. Output follows.".format(jobname))
-            log.error("stdout: {}\nstderr: {}".format(out, err))
+        sched = datman.scheduler.get_scheduler(dryrun=dryrun)
+        try:
+            sched.submit(commands, jobname, logdir=logdir, walltime=walltime)
+        except datman.scheduler.SchedulerException, e:
+            log.error("Job {} submission failed: {}".format(jobname, e))
 
 if __name__ == '__main__':
     main()
@@ -12,7 +12,8 @@ Arguments:
     <fsdir>             Path to freesurfer output folder containing t1/
     <outputdir>         Path to output folder
     <script>            Full path to an epitome-style script.
-    <atlas>             Full path to a NIFTI atlas in MNI space.
+    <atlas>             Full path to a NIFTI atlas in MNI space, or a comma
+                        delimited list of atlases.
     <subject>           Subject name to run on, e.g. SPN01_CMH_0020_01. If not
                         provided, all subjects matching the given --tags will
                         be processed.
@@ -20,6 +21,8 @@ Arguments:
 Options:
     --walltime TIME     Walltime for each subject job [default: 2:00:00]
     --tags LIST         DATMAN tags to run pipeline on. (comma delimited) [default: RST]
+    --shrinkage FLOAT   Shrinkage (0 to 1) applied to the ROI covariance before
+                        computing partial correlations [default: 0]
     -v,--verbose        Verbose logging
     --debug             Debug logging
     --dry-run          Don't do anything.
@@ -28,7 +31,13 @@ DETAILS
 
     1) Preprocesses fMRI data using the defined epitome-style script.
     2) Produces a CSV of the ROI time series from the MNI-space atlas NIFTI in assets/.
+       Several atlases can be given at once, in which case the outputs of each
+       are suffixed with the atlas name.
     3) Produces a correlation matrix of these same time series.
+    4) Produces a partial correlation matrix of these same time series. Scans
+       with no more timepoints than ROIs need some --shrinkage for this to be
+       meaningful, and without it the partial correlations are skipped (with
+       a warning).
 
     Each subject is run through this pipeline if the outputs do not already exist.
     Outputs are placed in <project>/data/rest
@@ -50,10 +59,10 @@ This message is printed with the -h, --help flags.
 from datman.docopt import docopt
 from glob import glob
 from random import choice
-from scipy import stats, linalg
 from string import ascii_uppercase, digits
 import datman as dm
 import logging
+import nibabel as nib
 import numpy as np
 import os
 import shutil
@@ -74,67 +83,6 @@ class ProcessingException(Exception):
     pass
 
 
-def partial_corr(C):
-    """
-    Partial Correlation in Python (clone of Matlab's partialcorr)
-    from https://gist.github.com/fabianp/9396204419c7b638d38f
-
-    This uses the linear regression approach to compute the partial
-    correlation (might be slow for a huge number of variables). The
-    algorithm is detailed here:
-
-        http://en.wikipedia.org/wiki/Partial_correlation#Using_linear_regression
-
-    Taking X and Y two variables of interest and Z the matrix with all the variable minus {X, Y},
-    the algorithm can be summarized as
-
-        1) perform a normal linear least-squares regression with X as the target and Z as the predictor
-        2) calculate the residuals in Step #1
-        3) perform a normal linear least-squares regression with Y as the target and Z as the predictor
-        4) calculate the residuals in Step #3
-        5) calculate the correlation coefficient between the residuals from Steps #2 and #4;
-
-    The result is the partial correlation between X and Y while controlling for the effect of Z
-
-    Returns the sample linear partial correlation coefficients between pairs of variables in C, controlling
-    for the remaining variables in C.
-
-
-    Parameters
-    ----------
-    C : array-like, shape (n, p)
-        Array with the different variables. Each column of C is taken as a variable
-
-
-    Returns
-    -------
-    P : array-like, shape (p, p)
-        P[i, j] contains the partial correlation of C[:, i] and C[:, j] controlling
-        for the remaining variables in C.
-    """
-
-    C = np.asarray(C)
-    p = C.shape[1]
-    P_corr = np.zeros((p, p), dtype=np.float)
-    for i in range(p):
-        P_corr[i, i] = 1
-        for j in range(i + 1, p):
-            idx = np.ones(p, dtype=np.bool)
-            idx[i] = False
-            idx[j] = False
-            beta_i = linalg.lstsq(C[:, idx], C[:, j])[0]
-            beta_j = linalg.lstsq(C[:, idx], C[:, i])[0]
-
-            res_j = C[:, j] - C[:, idx].dot(beta_i)
-            res_i = C[:, i] - C[:, idx].dot(beta_j)
-
-            corr = stats.pearsonr(res_i, res_j)[0]
-            P_corr[i, j] = corr
-            P_corr[j, i] = corr
-
-    return P_corr
-
-
 def proc_data(sub, data, log_path, tmpfolder, script):
     """
     Copies functional data into epitome-compatible structure, then runs the
@@ -211,10 +159,22 @@ def export_data(sub, data, tmpfolder, func_path):
     open('{}/{}_preproc-complete.log'.format(out_path, sub), 'a').close()
 
 
-def analyze_data(sub, atlas, func_path):
+def atlas_name(atlas):
+    """
+    Returns the name of an atlas file, without its folder or .nii[.gz]
+    extension.
+    """
+    return os.path.basename(atlas).split('.nii')[0]
+
+
+def analyze_data(sub, atlases, func_path, shrinkage=0):
     """
     Extracts: time series, correlation / partial correlation matricies using labels defined
     in 'rsfc.labels' in assets/. This file should be formatted for 3dUndump.
+
+    The functional data is read in once for all of the atlases. With a single
+    atlas the outputs are named <basename>_roi-*, otherwise they are named
+    <basename>_<atlas>_roi-* after each atlas file.
     """
 
     # get an input file list
@@ -226,40 +186,55 @@ def analyze_data(sub, atlas, func_path):
         # strips off extension and folder structure from input filename
         basename = '.'.join(os.path.basename(f).split('.')[:-2])
 
-        rtn, out, err = dm.utils.run(
-            '3dresample -master {f} -prefix {func_path}/{sub}/{basename}_rois.nii.gz -inset {atlas}'.format(
-                f=f, func_path=func_path, basename=basename, sub=sub, atlas=atlas))
-        output = '\n'.join([out, err]).replace('\n', '\n\t')
-        if rtn != 0:
-            logger.error(output)
-            raise ProcessingException("Error resampling atlas.")
+        if len(atlases) == 1:
+            stems = [basename]
         else:
-            logger.info(output)
-
-        rois, _, _, _ = dm.utils.loadnii(
-            '{func_path}/{sub}/{basename}_rois.nii.gz'.format(func_path=func_path, sub=sub, basename=basename))
-        data, _, _, _ = dm.utils.loadnii(f)
-
-        n_rois = len(np.unique(rois[rois > 0]))
-        dims = np.shape(data)
-
-        # loop through all ROIs, extracting mean timeseries.
-        output = np.zeros((n_rois, dims[1]))
-
-        for i, roi in enumerate(np.unique(rois[rois > 0])):
-            idx = np.where(rois == roi)[0]
-
-            if len(idx) > 0:
-                output[i, :] = np.mean(data[idx, :], axis=0)
-
-        # save the raw time series
-        np.savetxt('{func_path}/{sub}/{basename}_roi-timeseries.csv'.format(
-            func_path=func_path, sub=sub, basename=basename), output.transpose(), delimiter=',')
-
-        # save the full correlation matrix
-        corrs = np.corrcoef(output)
-        np.savetxt('{func_path}/{sub}/{basename}_roi-corrs.csv'.format(
-            func_path=func_path, sub=sub, basename=basename), corrs, delimiter=',')
+            stems = ['{}_{}'.format(basename, atlas_name(a)) for a in atlases]
+
+        labels = []
+        for atlas, stem in zip(atlases, stems):
+            rtn, out, err = dm.utils.run(
+                '3dresample -master {f} -prefix {func_path}/{sub}/{stem}_rois.nii.gz -inset {atlas}'.format(
+                    f=f, func_path=func_path, stem=stem, sub=sub, atlas=atlas))
+            output = '\n'.join([out, err]).replace('\n', '\n\t')
+            if rtn != 0:
+                logger.error(output)
+                raise ProcessingException("Error resampling atlas.")
+            else:
+                logger.info(output)
+
+            rois = nib.load('{func_path}/{sub}/{stem}_rois.nii.gz'.format(
+                func_path=func_path, sub=sub, stem=stem)).get_data()
+            labels.append(rois.reshape(rois.shape[:3]))
+
+        # only the voxels inside (any of) the atlases are read in
+        mask = reduce(np.logical_or, [rois > 0 for rois in labels])
+        data = dm.utils.load_masked_nii(f, mask)
+
+        for rois, stem in zip(labels, stems):
+            # mean timeseries of every ROI, in label order
+            _, output = dm.utils.roi_means(data, rois[mask])
+
+            # save the raw time series
+            np.savetxt('{func_path}/{sub}/{stem}_roi-timeseries.csv'.format(
+                func_path=func_path, sub=sub, stem=stem), output.transpose(), delimiter=',')
+
+            # save the full correlation matrix
+            corrs = np.corrcoef(output)
+            np.savetxt('{func_path}/{sub}/{stem}_roi-corrs.csv'.format(
+                func_path=func_path, sub=sub, stem=stem), corrs, delimiter=',')
+
+            # save the partial correlation matrix, if the covariance of the
+            # time series can be inverted
+            n_rois, n_timepoints = output.shape
+            if n_timepoints <= n_rois and not shrinkage:
+                logger.warning("{}: {} has {} timepoints for {} ROIs, "
+                    "skipping partial correlations (see --shrinkage)".format(
+                    sub, stem, n_timepoints, n_rois))
+                continue
+            pcorrs = dm.utils.partial_corr(output.transpose(), shrinkage)
+            np.savetxt('{func_path}/{sub}/{stem}_roi-pcorrs.csv'.format(
+                func_path=func_path, sub=sub, stem=stem), pcorrs, delimiter=',')
 
     open('{path}/{sub}/{sub}_analysis-complete.log'.format(path=func_path,
                                                            sub=sub), 'a').close()
@@ -327,7 +302,8 @@ def get_required_data(data_path, fsdir, sub, tags):
             'tags': taglist}
 
 
-def process_subject(func_path, log_path, data, sub, tags, atlas, script):
+def process_subject(func_path, log_path, data, sub, tags, atlases, script,
+                    shrinkage=0):
     tempfolder = tempfile.mkdtemp(prefix='rest-')
     try:
         if os.path.isfile(os.path.join(func_path, sub, '{sub}_preproc-complete.log'.format(sub=sub))):
@@ -343,7 +319,7 @@ def process_subject(func_path, log_path, data, sub, tags, atlas, script):
                 "Subject's {} rest folder not present after preproc.".format(sub))
             return False
 
-        analyze_data(sub, atlas, func_path)
+        analyze_data(sub, atlases, func_path, shrinkage)
     except ProcessingException, e:
         logger.error(e.message)
         return False
@@ -369,9 +345,11 @@ def main():
     fsdir      = arguments['<fsdir>']
     script = arguments['<script>']
     atlas = arguments['<atlas>']
+    atlases = atlas.split(',')
     subjects = arguments['<subject>']
     walltime   = arguments['--walltime']
     tags = arguments['--tags'].split(',')
+    shrinkage = float(arguments['--shrinkage'])
     verbose = arguments['--verbose']
     debug = arguments['--debug']
     dryrun     = arguments['--dry-run']
@@ -382,9 +360,10 @@ def main():
         logger.setLevel(logging.DEBUG)
 
     # check inputs
-    if not os.path.isfile(atlas):
-        logger.error("Atlas {} does not exist".format(atlas))
-        sys.exit(-1)
+    for a in atlases:
+        if not os.path.isfile(a):
+            logger.error("Atlas {} does not exist".format(a))
+            sys.exit(-1)
 
     if not os.path.isfile(script):
         logger.error("Epitome script {} does not exist".format(script))
@@ -416,15 +395,17 @@ def main():
         if subjects: 
             logger.info("Processing subject {}".format(subject))
             if not dryrun:
-                process_subject(func_path, log_path, data, subject, tags, atlas, script)
+                process_subject(func_path, log_path, data, subject, tags, atlases,
+                                script, shrinkage)
 
 
         # otherwise, submit a list of calls to ourself, one per subject
         else:
-            opts = '{verbose} {debug} {tags}'.format(
+            opts = '{verbose} {debug} {tags} {shrinkage}'.format(
                 verbose = (verbose and ' --verbose' or ''),
                 debug = (debug and ' --debug' or ''),
-                tags = (tags and ' --tags=' + ','.join(tags) or ''))
+                tags = (tags and ' --tags=' + ','.join(tags) or ''),
+                shrinkage = ' --shrinkage={}'.format(shrinkage))
 
             commands.append(" ".join([__file__, opts, datadir, fsdir,
                 outputdir, script, atlas, subject]))
@@ -434,11 +415,7 @@ def main():
         jobname = "dm_rest_{}".format(time.strftime("%Y%m%d-%H%M%S"))
         log_path = dm.utils.define_folder(os.path.join(outputdir, 'logs'))
 
-        fd, path = tempfile.mkstemp() 
-        os.write(fd, '\n'.join(commands))
-        os.close(fd)
-
-        # using qbatch -i (individual jobs) rather than the default array
+        # using individual jobs (qbatch -i) rather than the default array
         # job to work around interaction between epitome scripts and PBS
         # tempdir names.
         #  
@@ -449,15 +426,12 @@ def main():
         # Epitome scripts do not properly escape the DIR_DATA when used, so
         # references to this path do not parse correctly (square brackets
         # being patterns in bash).
-        rtn, out, err = dm.utils.run('qbatch -i --logdir {logdir} -N {name} --walltime {wt} {cmds}'.format(
-            logdir = log_path,
-            name = jobname,
-            wt = walltime, 
-            cmds = path), dryrun = dryrun)
-
-        if rtn != 0:
-            logger.error("Job submission failed. Output follows.")
-            logger.error("stdout: {}\nstderr: {}".format(out,err))
+        sched = dm.scheduler.get_scheduler(dryrun=dryrun)
+        try:
+            sched.submit(commands, jobname, logdir=log_path,
+                         walltime=walltime, individual=True)
+        except dm.scheduler.SchedulerException, e:
+            logger.error("Job submission failed: {}".format(e))
             sys.exit(1)
 
 
@@ -17,7 +17,7 @@ from docopt import docopt
 import numpy as np
 import nibabel as nib
 import datman as dm
-import tempfile 
+import datman.scratch
 import shutil
 import glob
 import os.path
@@ -47,32 +47,27 @@ def split(image):
     if os.path.exists(pd_path) and os.path.exists(t2_path): 
         return  
 
-    tempdir = tempfile.mkdtemp()
-  
-    dm.utils.run("fslsplit {} {}/".format(image, tempdir)) 
+    with dm.scratch.Scratch() as tempdir:
+        dm.utils.run("fslsplit {} {}/".format(image, tempdir))
 
-    vols = glob.glob('{}/*.nii.gz'.format(tempdir))
-    if len(vols) != 2: 
-        print "{}: Expected exactly 2 volumes, got: {}".format(
-                image, ", ".join(vols))
-        print tempdir
-        #shutil.rmtree(tempdir) 
-        return
+        vols = glob.glob('{}/*.nii.gz'.format(tempdir))
+        if len(vols) != 2:
+            print "{}: Expected exactly 2 volumes, got: {}".format(
+                    image, ", ".join(vols))
+            return
 
-    vol0_mean = np.mean(nib.load(vols[0]).get_data())
-    vol1_mean = np.mean(nib.load(vols[1]).get_data())
+        vol0_mean = np.mean(nib.load(vols[0]).get_data())
+        vol1_mean = np.mean(nib.load(vols[1]).get_data())
 
-    if vol0_mean > vol1_mean:      # PD should have a higher mean intensity
-        pd_tmp, t2_tmp = vols[0], vols[1]
-    else:
-        t2_tmp, pd_tmp = vols[0], vols[1]
+        if vol0_mean > vol1_mean:      # PD should have a higher mean intensity
+            pd_tmp, t2_tmp = vols[0], vols[1]
+        else:
+            t2_tmp, pd_tmp = vols[0], vols[1]
 
-    if not os.path.exists(pd_path):
-        shutil.move(pd_tmp, pd_path)
-    if not os.path.exists(t2_path): 
-        shutil.move(t2_tmp, t2_path)
-
-    shutil.rmtree(tempdir) 
+        if not os.path.exists(pd_path):
+            shutil.move(pd_tmp, pd_path)
+        if not os.path.exists(t2_path):
+            shutil.move(t2_tmp, t2_path)
 
 if __name__ == "__main__":
     main()
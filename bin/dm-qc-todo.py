@@ -10,6 +10,8 @@ Options:
     --show-newer     Show data files newer than QC doc
     --root PATH      Path to parent folder to all study folders.
                      [default: /archive/data-2.0]
+    --catalog        Look data files up in (and refresh) a catalog of each
+                     study's data/nii folder, kept in metadata/catalog.db
 
 Expects to be run in the parent folder to all study folders. Looks for the file
 checklist.csv in subfolders, and prints out any QC pdf from those that haven't
@@ -21,6 +23,7 @@ import glob
 import os
 import os.path
 import re
+import datman as dm
 
 def get_project_dirs(root, maxdepth=2):
     """
@@ -42,6 +45,16 @@ def get_project_dirs(root, maxdepth=2):
             del dirs[:]
     return paths
 
+def get_data_mtimes(timepointdir, catalog=None):
+    """
+    Returns a dict mapping each file in timepointdir to its modification time,
+    looked up in the catalog if one is given.
+    """
+    if catalog:
+        return {entry.path: entry.mtime
+                for entry in catalog.files(folder=timepointdir)}
+    return {path: os.path.getmtime(path)
+            for path in glob.glob(timepointdir + '/*')}
 
 def main():
     arguments = docopt.docopt(__doc__)
@@ -50,6 +63,12 @@ def main():
     for projectdir in get_project_dirs(rootdir):
         checklist = os.path.join(projectdir, 'metadata', 'checklist.csv')
 
+        catalog = None
+        if arguments['--catalog']:
+            catalog = dm.catalog.open_catalog(
+                    os.path.join(projectdir, 'metadata', 'catalog.db'),
+                    os.path.join(projectdir, 'data', 'nii'))
+
         # map qc pdf to comments
         checklistdict = {d[0]: d[1:] for d in [l.strip().split()
                                                for l in open(checklist).readlines() if l.strip()]}
@@ -61,7 +80,13 @@ def main():
 
         # check whether data is newer than qc doc or
         # whether qc doc hasn't been signed off on
-        for timepointdir in sorted(glob.glob(projectdir + '/data/nii/*')):
+        if catalog:
+            timepointdirs = [os.path.join(projectdir, 'data', 'nii', timepoint)
+                             for timepoint in catalog.subjects()]
+        else:
+            timepointdirs = sorted(glob.glob(projectdir + '/data/nii/*'))
+
+        for timepointdir in timepointdirs:
             if '_PHA_' in timepointdir:
                 continue
 
@@ -69,8 +94,8 @@ def main():
             qcdocname = 'qc_' + timepoint + '.html'
             qcdoc = os.path.join(projectdir, 'qc', timepoint, qcdocname)
 
-            data_mtime = max(
-                map(os.path.getmtime, glob.glob(timepointdir + '/*')+[timepointdir]))
+            data_mtimes = get_data_mtimes(timepointdir, catalog)
+            data_mtime = max(data_mtimes.values() + [os.path.getmtime(timepointdir)])
 
             if qcdocname not in checklistdict or not os.path.exists(qcdoc):
                 print 'No QC doc generated for {}'.format(timepointdir)
@@ -78,8 +103,8 @@ def main():
             elif not arguments['--no-older'] and data_mtime > os.path.getmtime(qcdoc):
                 print '{}: QC doc is older than data in folder {} {} {}'.format(qcdoc, timepointdir, data_mtime, os.path.getmtime(qcdoc))
                 if arguments['--show-newer']:
-                    newer = filter(lambda x: os.path.getmtime(x) > os.path.getmtime(qcdoc),
-                                   glob.glob(timepointdir + '/*'))
+                    newer = sorted(x for x, mtime in data_mtimes.items()
+                                   if mtime > os.path.getmtime(qcdoc))
                     print '\t' + '\n\t'.join(newer)
 
             elif not checklistdict[qcdocname]:
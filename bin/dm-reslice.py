@@ -27,6 +27,7 @@ from glob import glob
 from copy import copy
 import os, sys
 import datman as dm
+import datman.utils
 import nibabel as nib
 from datman.docopt import docopt
 
@@ -70,10 +71,10 @@ def reslice(target, f):
         orig_name = '{}_ORIG_RESOLUTION{}'.format(f.split(ext)[0], ext)
         if os.path.isfile(orig_name) == False:
             # save the original file with 'ORIG_RESOLUTION' in filename
-            os.system('mv {} {}'.format(f, orig_name))
+            os.rename(f, orig_name)
             # NB: defaults to nearest neighbour for now
-            os.system('3dresample -dxyz {} {} {} -rmode NN -prefix {} -inset {}'.format(
-                t[0], t[1], t[2], f, orig_name))
+            dm.utils.run('3dresample -dxyz {} {} {} -rmode NN -prefix {} -inset {}'.format(
+                t[0], t[1], t[2], f, orig_name), echo=True)
 
 def main():
 
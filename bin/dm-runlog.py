@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Summarizes the run log of the external programs run by the pipeline, to find
+which are the slowest or most memory-hungry.
+
+Usage:
+    dm-runlog.py [options] [<runlog.db>]
+
+Arguments:
+    <runlog.db>             Run log to read (default is $DM_RUNLOG)
+
+Options:
+    --program NAME          Only show runs of this program
+    --days N                Only show runs started in the last N days
+    --sort COLUMN           Column to sort the summary by: wall, max_wall,
+                            cpu, maxrss or runs [default: wall]
+    --runs                  List the individual runs rather than a summary
+    --failed                Only list runs that failed (implies --runs)
+
+DETAILS
+
+    Commands run through datman.runner (which datman.utils.run and the
+    scripts' own run and docmd functions use) are recorded in the sqlite
+    database named by the DM_RUNLOG environment variable, if it is set.
+
+    The summary has a row per program, with the number of runs and failures,
+    the total and longest wall time and total CPU time (in seconds), and the
+    largest peak memory use (in MB). The run listing has the start time,
+    host, exit status, wall time, CPU time and peak memory of each run, and
+    its command line.
+
+EXAMPLES
+
+    DM_RUNLOG=/archive/logs/runlog.db qc-html.py ...
+    dm-runlog.py --days 7 --sort maxrss /archive/logs/runlog.db
+    dm-runlog.py --program 3dvolreg --failed /archive/logs/runlog.db
+"""
+from docopt import docopt
+import datman as dm
+import datman.runner
+import os
+import sys
+import time
+import pipes
+
+SORT_COLUMNS = ('wall', 'max_wall', 'cpu', 'maxrss', 'runs')
+
+def print_summary(summary, sort):
+    summary = sorted(summary, key=lambda s: getattr(s, sort), reverse=True)
+    print "{:<24} {:>7} {:>7} {:>11} {:>9} {:>11} {:>9}".format(
+        'program', 'runs', 'failed', 'wall', 'max wall', 'cpu', 'max MB')
+    for s in summary:
+        print "{:<24} {:>7} {:>7} {:>11.1f} {:>9.1f} {:>11.1f} {:>9.1f}".format(
+            s.program, s.runs, s.failures, s.wall, s.max_wall, s.cpu,
+            s.maxrss / 1024.0)
+
+def print_runs(runs):
+    for run in runs:
+        started = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(run.started))
+        print "{} {:<12} {:>4} {:>9.1f}s {:>9.1f}s {:>8.1f}MB  {}".format(
+            started, run.host.split('.')[0], run.returncode, run.wall,
+            run.user + run.sys, run.maxrss / 1024.0,
+            ' '.join(pipes.quote(arg) for arg in run.argv))
+
+def main():
+    arguments = docopt(__doc__)
+    filename  = arguments['<runlog.db>'] or os.environ.get('DM_RUNLOG')
+    program   = arguments['--program']
+    days      = arguments['--days']
+    sort      = arguments['--sort']
+    failed    = arguments['--failed']
+    show_runs = arguments['--runs'] or failed
+
+    if not filename:
+        sys.exit("No run log given, and DM_RUNLOG is not set")
+    if not os.path.exists(filename):
+        sys.exit("{} does not exist".format(filename))
+    if sort not in SORT_COLUMNS:
+        sys.exit("Cannot sort by {}, only by {}".format(sort,
+                 ", ".join(SORT_COLUMNS)))
+
+    since = None
+    if days:
+        since = time.time() - float(days) * 24 * 60 * 60
+
+    runlog = dm.runner.RunLog(filename)
+    if show_runs:
+        print_runs(runlog.runs(program, since, failed))
+    else:
+        print_summary(runlog.summary(program, since), sort)
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4 sw=4:
@@ -38,10 +38,10 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import glob
 import os
 import sys
-import subprocess
 import datetime
 import tempfile
 import shutil
@@ -67,7 +67,7 @@ QCedTranfer = False if rawQCfile == None else True
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 # need to find the t1 weighted scan and update the checklist
 def find_and_copy_tagnii(colname, archive_tag, expected_count):
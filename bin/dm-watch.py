@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Watches folders for new or changed exams, and runs the ingest stages for each
+exam once it has finished arriving.
+
+Usage:
+    dm-watch.py [options] <config.yml>
+
+Arguments:
+    <config.yml>            Configuration file listing the folders to watch and
+                            the commands to run (see CONFIGURATION)
+
+Options:
+    --poll SECS             Poll the folders every SECS seconds rather than
+                            use inotify (which misses changes made over NFS)
+    --settle SECS           How long an exam must go unchanged before it is
+                            processed [default: 300]
+    --scheduler NAME        Scheduler to run the commands with (see
+                            datman.scheduler; default is $DM_SCHEDULER)
+    --logdir DIR            Folder for the logs of the commands
+    -v,--verbose            Be chatty
+    --debug                 Be extra chatty
+    -n,--dry-run            Print the commands, don't run them
+
+DETAILS
+
+    Rather than scanning every project folder from cron for the few exams that
+    are new, this program waits to be told of changes (see datman.watcher).
+    An exam is a folder or file (e.g. a zip) directly within a watched folder,
+    such as an exam folder in an XNAT archive or an exam zip in a project's
+    data/dicom folder. When an exam is created or changes, its size and
+    modification times are checked until they have gone unchanged for the
+    settling time (so that exams still being uploaded are not processed), and
+    then the commands configured for the folder are run for it as one job, in
+    order, stopping at the first that fails.
+
+    Exams already present when the watcher starts are not processed until
+    they change.
+
+    Only changes to the exam folder or file itself are noticed. A file added
+    deeper inside an exam folder that has already been processed (e.g. a
+    series re-sent into SCANS/ of an XNAT exam) does not change the exam
+    folder, so the exam is not processed again; run the commands for it by
+    hand in that case.
+
+CONFIGURATION
+
+    The configuration lists the folders to watch, under Watch. For each:
+
+        Folder:   the folder to watch
+        Pattern:  (optional) a glob that the exam names must match
+        Commands: the commands to run for each exam. In these, <path> is
+                  replaced by the path to the exam, <name> by its name, and
+                  <scanid> by its name without any extension.
+
+    For example:
+
+        Watch:
+          - Folder: /mnt/xnat/spred/archive/SPINS/arc001
+            Pattern: 'SPN01_*'
+            Commands:
+              - xnat-extract.py --datadir ${PROJECTDIR}/data <path>
+              - dm-check-headers.py --filter <name> ${PROJECTDIR}/metadata/gold_standards ${PROJECTDIR}/logs/dm-check-headers ${PROJECTDIR}/data/dcm
+              - qc-html.py --datadir ${PROJECTDIR}/data --qcdir ${PROJECTDIR}/qc --project-settings ${PROJECTDIR}/metadata/project_settings.yml --subject <scanid>
+"""
+from docopt import docopt
+import datman as dm
+import datman.scheduler
+import datman.watcher
+import fnmatch
+import logging
+import os.path
+import sys
+import yaml
+
+VERBOSE = False
+DRYRUN  = False
+DEBUG   = False
+
+def log(message):
+    print message
+    sys.stdout.flush()
+
+def error(message):
+    log("ERROR: " + message)
+
+def verbose(message):
+    if not(VERBOSE or DEBUG): return
+    log(message)
+
+def debug(message):
+    if not DEBUG: return
+    log("DEBUG: " + message)
+
+def read_config(config_yml):
+    """
+    Reads the watch configuration, and returns a dict mapping each folder to
+    its (pattern, commands).
+    """
+    with open(config_yml, 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    watches = {}
+    for watch in config.get('Watch') or []:
+        folder = os.path.normpath(watch['Folder'])
+        watches[folder] = (watch.get('Pattern') or '*', watch['Commands'])
+    return watches
+
+def exam_commands(path, commands):
+    """
+    Returns the commands to run for the exam at path.
+    """
+    name = os.path.basename(path)
+    scanid = name[:-len(dm.utils.get_extension(name))] \
+             if os.path.isfile(path) else name
+    return [c.replace('<path>', path).replace('<name>', name)
+             .replace('<scanid>', scanid) for c in commands]
+
+def process_exam(path, watches, scheduler, logdir):
+    folder = os.path.dirname(path)
+    pattern, commands = watches[folder]
+    if not fnmatch.fnmatch(os.path.basename(path), pattern):
+        debug("{} does not match {}, ignoring".format(path, pattern))
+        return
+
+    commands = exam_commands(path, commands)
+    log("Processing {}".format(path))
+    for command in commands:
+        if DRYRUN:
+            log("  {}".format(command))
+        else:
+            verbose("  {}".format(command))
+
+    jobname = 'dm_watch_{}'.format(os.path.basename(path))
+    scheduler.submit([' && '.join(commands)], jobname, logdir=logdir)
+
+def main():
+    global VERBOSE
+    global DRYRUN
+    global DEBUG
+    arguments  = docopt(__doc__)
+    config_yml = arguments['<config.yml>']
+    poll       = arguments['--poll']
+    settle     = float(arguments['--settle'])
+    logdir     = arguments['--logdir']
+    VERBOSE    = arguments['--verbose']
+    DEBUG      = arguments['--debug']
+    DRYRUN     = arguments['--dry-run']
+
+    if DEBUG:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    watches = read_config(config_yml)
+    if not watches:
+        error("No folders to watch in {}".format(config_yml))
+        sys.exit(1)
+
+    scheduler = dm.scheduler.get_scheduler(arguments['--scheduler'],
+                                           dryrun=DRYRUN)
+    watcher = dm.watcher.get_watcher(poll and float(poll))
+    for folder in watches:
+        verbose("Watching {}".format(folder))
+        watcher.add(folder)
+
+    # check on unsettled exams a few times per settling period
+    debouncer = dm.watcher.Debouncer(settle)
+    interval = max(1, settle / 5)
+
+    try:
+        while True:
+            for path in watcher.changes(timeout=interval):
+                if os.path.dirname(path) in watches:
+                    debug("{} changed".format(path))
+                    debouncer.touch(path)
+
+            for path in debouncer.ready():
+                try:
+                    process_exam(path, watches, scheduler, logdir)
+                except dm.scheduler.SchedulerException, e:
+                    error("{}: {}".format(path, e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4 sw=4:
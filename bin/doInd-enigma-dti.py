@@ -48,10 +48,10 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import glob
 import os
 import sys
-import subprocess
 
 
 arguments       = docopt(__doc__)
@@ -69,7 +69,7 @@ if DEBUG: print arguments
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 # check that ENIGMAHOME environment variable exists
 ENIGMAHOME = os.getenv('ENIGMAHOME')
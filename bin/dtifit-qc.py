@@ -37,10 +37,9 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.scratch
+import datman.runner
 import os
-import subprocess
-import tempfile
-import shutil
 import glob
 import sys
 
@@ -65,7 +64,7 @@ if FSLDIR==None:
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 def gif_gridtoline(input_gif,output_gif):
     '''
@@ -131,11 +130,6 @@ if TAG != None:
 if DEBUG : print("FAmaps after filtering: {}".format(allFAmaps))
 allFAmaps = [ v for v in allFAmaps if "PHA" not in v ] ## remove the phantoms from the list
 
-#mkdir a tmpdir for the
-tmpdirbase = tempfile.mkdtemp()
-# tmpdirbase = os.path.join(QCdir,'tmp')
-# dm.utils.makedirs(tmpdirbase)
-
 # make the output directories
 QC_bet_dir = os.path.join(QCdir,'BET')
 QC_V1_dir = os.path.join(QCdir, 'directions')
@@ -147,20 +141,20 @@ V1pics = []
 for FAmap in allFAmaps:
     ## manipulate the full path to the FA map to get the other stuff
     subid = os.path.basename(os.path.dirname(FAmap))
-    tmpdir = os.path.join(tmpdirbase,subid)
-    dm.utils.makedirs(tmpdir)
     basename = os.path.basename(FAmap).replace('dtifit_FA.nii.gz','')
     pathbase = FAmap.replace('dtifit_FA.nii.gz','')
 
-    maskpic = os.path.join(QC_bet_dir,basename + 'b0_bet_mask.gif')
-    maskpics.append(maskpic)
-    if os.path.exists(maskpic) == False:
-        mask_overlay(pathbase + 'b0.nii.gz',pathbase + 'b0_bet_mask.nii.gz', maskpic)
+    # the overlay functions put their intermediates in tmpdir
+    with dm.scratch.Scratch(prefix=subid + '-') as tmpdir:
+        maskpic = os.path.join(QC_bet_dir,basename + 'b0_bet_mask.gif')
+        maskpics.append(maskpic)
+        if os.path.exists(maskpic) == False:
+            mask_overlay(pathbase + 'b0.nii.gz',pathbase + 'b0_bet_mask.nii.gz', maskpic)
 
-    V1pic = os.path.join(QC_V1_dir,basename + 'dtifit_V1.gif')
-    V1pics.append(V1pic)
-    if os.path.exists(V1pic) == False:
-        V1_overlay(FAmap,pathbase + 'dtifit_V1.nii.gz', V1pic)
+        V1pic = os.path.join(QC_V1_dir,basename + 'dtifit_V1.gif')
+        V1pics.append(V1pic)
+        if os.path.exists(V1pic) == False:
+            V1_overlay(FAmap,pathbase + 'dtifit_V1.nii.gz', V1pic)
 
 
 ## write an html page that shows all the BET mask pics
@@ -188,7 +182,3 @@ for pic in V1pics:
     qchtml.write(relpath + '</a><br>\n')
 qchtml.write('</BODY></HTML>\n')
 qchtml.close() # you can omit in most cases as the destructor will call it
-
-
-#get rid of the tmpdir
-shutil.rmtree(tmpdirbase)
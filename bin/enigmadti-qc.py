@@ -39,8 +39,8 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.runner
 import os
-import subprocess
 import tempfile
 import shutil
 
@@ -65,7 +65,7 @@ if checklistfile == None:
 def docmd(cmdlist):
     "sends a command (inputed as a list) to the shell"
     if DEBUG: print ' '.join(cmdlist)
-    if not DRYRUN: subprocess.call(cmdlist)
+    if not DRYRUN: dm.runner.run(cmdlist, capture=False)
 
 def overlay_skel(background_nii, skel_nii,overlay_gif):
     '''
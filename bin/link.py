@@ -17,6 +17,10 @@ Options:
                                 [default: metadata/scans.csv]
     --scanid_field STR       Dicom field to match target_name with 
                              [default: PatientName]
+    --header-index FILE      sqlite index of archive headers to read from
+                             and update (see datman.headerindex)
+    -j,--jobs N              Number of archives to read headers from in
+                             parallel [default: 1]
     -v,--verbose             Verbose logging
     --debug                  Debug logging
     -n,--dry-run             Dry run
@@ -67,6 +71,16 @@ IGNORING EXAM ARCHIVES
     the target_name of '<ignore>', for example: 
         source_name      target_name            dicom_StudyID
         2014_0126_FB001  <ignore>
+
+BATCHES OF ARCHIVES
+    All of the given archives are looked up in the table first. Archives that
+    are already linked, ignored, or named in the table with a target that
+    already exists are skipped without being opened. DICOM headers are then
+    read only from the archives that need them (those not in the table, or
+    with dicom_ columns to check), by --jobs worker processes at once, and
+    finally the archives are linked in the order given. Since archives named
+    in the table with nothing to check are never opened, they are linked
+    whether or not they hold any DICOMs.
 """
 
 from docopt import docopt
@@ -74,7 +88,9 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headerindex
 import glob
+import multiprocessing
 import os.path
 import sys
 
@@ -106,32 +122,28 @@ def main():
     targetdir    = arguments['<targetdir>']
     lookup_table = arguments['--lookup']
     scanid_field = arguments['--scanid_field']
+    index        = dm.headerindex.open_index(arguments['--header-index'])
+    jobs         = int(arguments['--jobs'])
     VERBOSE      = arguments['--verbose']
     DEBUG        = arguments['--debug']
     DRYRUN       = arguments['--dry-run']
 
 
-    lookup = pd.read_table(lookup_table, sep='\s+', dtype=str)
+    lookup = read_lookup_table(lookup_table)
     targetdir = os.path.normpath(targetdir)
 
     already_linked = { os.path.realpath(f):f for f in glob.glob(targetdir+'/*') if os.path.islink(f)}
 
+    # work out what we can from the lookup table alone, and which archives
+    # still need their headers read
+    pending = []
     for archivepath in archives: 
 
-        if os.path.realpath(archivepath) in already_linked.keys(): 
+        if os.path.realpath(archivepath) in already_linked: 
             verbose("{} already linked at {}".format(archivepath, already_linked[os.path.realpath(archivepath)]))
             continue
 
-        # get some DICOM headers from the archive
-        header = None
-        try:
-            header = dm.utils.get_archive_headers(
-                                archivepath, stop_after_first=True).values()[0]
-        except:
-            verbose("{}: Contains no DICOMs. Skipping.".format(archivepath))
-            continue
-
-        # search the lookup and the headers for a valid scan ID 
+        # search the lookup for a scan ID
         scanid, lookupinfo = get_scanid_from_lookup_table(archivepath, lookup)
         debug("Found {} as scanid from lookup table {}".format(scanid, lookup_table))
 
@@ -139,6 +151,22 @@ def main():
             verbose("Ignoring {}".format(archivepath))
             continue
 
+        if scanid and target_exists(targetdir, scanid, archivepath):
+            continue
+
+        pending.append((archivepath, scanid, lookupinfo))
+
+    # get some DICOM headers from the archives that need them
+    probe = [archivepath for archivepath, scanid, lookupinfo in pending
+             if needs_header(scanid, lookupinfo)]
+    headers = get_headers(probe, index, jobs)
+
+    for archivepath, scanid, lookupinfo in pending: 
+        header = headers.get(archivepath)
+        if archivepath in headers and header is None:
+            verbose("{}: Contains no DICOMs. Skipping.".format(archivepath))
+            continue
+
         # if we have a scan id, then validate any expected DICOM headers, 
         # otherwise, check the DICOM headers for a valid scan id
         if scanid: 
@@ -155,20 +183,106 @@ def main():
             continue
 
         # do the linking 
-        target = os.path.join(targetdir,scanid) + datman.utils.get_extension(archivepath)
-        if os.path.exists(target): 
-            verbose("{} already exists for archive {}. Skipping.".format(
-                target,archivepath))
+        if target_exists(targetdir, scanid, archivepath):
             continue
 
+        target = os.path.join(targetdir,scanid) + datman.utils.get_extension(archivepath)
         relpath = os.path.relpath(archivepath,os.path.dirname(target))
         log("linking {} to {}".format(relpath, target))
         if not DRYRUN:
             os.symlink(relpath, target)
 
+def target_exists(targetdir, scanid, archivepath):
+    target = os.path.join(targetdir,scanid) + datman.utils.get_extension(archivepath)
+    if os.path.exists(target): 
+        verbose("{} already exists for archive {}. Skipping.".format(
+            target,archivepath))
+        return True
+    return False
+
+def needs_header(scanid, lookupinfo):
+    """
+    An archive's headers are needed to find its scan id when it isn't in the
+    lookup table, or to check the dicom_ columns of its lookup table entry.
+    """
+    if not scanid:
+        return True
+    return any(c.startswith('dicom_') for c in lookupinfo.keys())
+
+def read_header(archivepath):
+    """
+    Returns the archive path and the headers of a dicom in the archive, or
+    None if the archive can't be read or contains no dicoms.
+    """
+    try:
+        manifest = dm.utils.get_archive_headers(archivepath,
+                                                stop_after_first=True)
+        return archivepath, manifest
+    except:
+        return archivepath, None
+
+def get_headers(archives, index=None, jobs=1):
+    """
+    Returns a dict mapping each archive to the headers of a dicom in it (or
+    None, if there are none).
+
+    Headers are taken from the header index where possible, and otherwise read
+    from the archives by a pool of jobs worker processes. The index is only
+    used (and updated) from this process, with the archives' signatures
+    taken before they are read.
+    """
+    manifests = {}
+    unindexed = []
+    signatures = {}
+    for archivepath in archives:
+        manifest = None
+        if index is not None:
+            manifest = index.lookup(archivepath, stop_after_first=True)
+        if manifest is not None:
+            manifests[archivepath] = manifest
+            continue
+        unindexed.append(archivepath)
+        if index is not None and os.path.exists(archivepath):
+            signatures[archivepath] = \
+                    dm.headerindex.archive_signature(archivepath)
+
+    if jobs > 1 and len(unindexed) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(unindexed)))
+        results = pool.imap_unordered(read_header, unindexed)
+    else:
+        pool = None
+        results = (read_header(archivepath) for archivepath in unindexed)
+
+    for archivepath, manifest in results:
+        manifests[archivepath] = manifest
+        if manifest is not None and index is not None:
+            index.store(archivepath, manifest, stop_after_first=True,
+                        signature=signatures.get(archivepath))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    headers = {}
+    for archivepath, manifest in manifests.items():
+        headers[archivepath] = manifest and manifest.values()[0] or None
+    return headers
+
+def read_lookup_table(lookup_table):
+    """
+    Reads the lookup table into a dict mapping each source_name to its entry
+    (a dict of the entry's columns). Only the first entry for a source_name is
+    kept.
+    """
+    lookup = pd.read_table(lookup_table, sep='\s+', dtype=str)
+    index = {}
+    for entry in lookup.to_dict('records'):
+        index.setdefault(entry['source_name'], entry)
+    return index
+
 def get_scanid_from_lookup_table(archivepath, lookup):
     """
-    Gets the scanid from the lookup table (pandas dataframe)
+    Gets the scanid from the lookup table (see read_lookup_table)
 
     Returns the scanid and the rest of the lookup table information (e.g.
     expected dicom header matches). If no match is found, both the scan id and
@@ -176,13 +290,13 @@ def get_scanid_from_lookup_table(archivepath, lookup):
     """
     basename    = os.path.basename(os.path.normpath(archivepath))
     source_name = basename[:-len(datman.utils.get_extension(basename))]
-    lookupinfo  = lookup[ lookup['source_name'] == source_name ]
+    lookupinfo  = lookup.get(source_name)
 
-    if len(lookupinfo) == 0:
+    if lookupinfo is None:
         debug("{} not found in source_name column.".format(source_name))
         return (None, None)
     else: 
-        scanid = lookupinfo['target_name'].tolist()[0]
+        scanid = lookupinfo['target_name']
         return (scanid, lookupinfo)
 
 def get_scanid_from_header(archivepath, header, scanid_field):
@@ -217,7 +331,7 @@ def validate(archivepath, header, lookupinfo):
 
     Checks that all dicom_* dicom header fields match the lookup table
     """
-    columns    = lookupinfo.columns.values.tolist()
+    columns    = lookupinfo.keys()
     dicom_cols = [c for c in columns if c.startswith('dicom_')]
 
     for c in dicom_cols:
@@ -229,7 +343,7 @@ def validate(archivepath, header, lookupinfo):
             return False
 
         actual   = str(header.get(f))
-        expected = str(lookupinfo[c].tolist()[0])
+        expected = str(lookupinfo[c])
 
         if actual != expected :
             error("{}: dicom field '{}' = '{}', expected '{}'".format(
@@ -12,6 +12,13 @@ Options:
     --project-settings YML  File with project settings (to read expected file list from)
     --subject SCANID        Scan ID to QC for. E.g. DTI_CMH_H001_01_01
     --rewrite               Rewrite the html of an existing qc page
+    --incremental           Rebuild existing qc pages, only re-running QC for
+                            series whose inputs have changed
+    --jobs N                Number of series to QC in parallel [default: 1]
+    --wal                   Use write-ahead logging for the QC database, so
+                            it can be read while QC is running (not on NFS)
+    --catalog FILE          sqlite catalog of <datadir>/nii to look the exams
+                            and their niftis up in (and refresh)
     --verbose               Be chatty
     --debug                 Be extra chatty
     --dry-run               Don't actually do any work
@@ -27,6 +34,27 @@ DETAILS
     The database stores some of the numbers plotted here, and is used by web-
     build to generate interactive charts detailing the acquisitions over time.
 
+    When more than one job is requested, the QC of every series of every
+    subject is farmed out to a pool of worker processes. Pages and database
+    values are written by the main process as each subject's QC finishes.
+
+INCREMENTAL MODE
+
+    Normally an exam is skipped if its qc page already exists. In incremental
+    mode the page is always rebuilt, but the QC for each series is
+    only re-run if the files it is computed from (the nifti and any files
+    sharing its name, like .bvec/.bval) have changed size or modification time,
+    or if any of its images are missing. The inputs and html of each series are
+    recorded in <qcdir>/<subject>/qc_<subject>_manifest.yml, and the html of
+    unchanged series is reused from there.
+
+SCRATCH SPACE
+
+    The intermediate files of the fMRI and DTI QC (motion corrected series,
+    mean, std and SFNR volumes, ...) are written to scratch folders, which
+    are removed once each series is done. Set DM_SCRATCH to a local disk or
+    tmpfs (e.g. /dev/shm) to keep them off NFS (see datman.scratch).
+
 """
 
 import os
@@ -35,6 +63,7 @@ import glob
 import logging
 import sqlite3
 import datetime
+import collections
 import numpy as np
 import scipy as sp
 import scipy.signal as sig
@@ -43,14 +72,16 @@ import nibabel as nib
 import datman as dm
 import datman.utils
 import datman.scanid
-import subprocess as proc
-from copy import copy
+import datman.scratch
+import datman.runner
+import multiprocessing
+import multiprocessing.pool
 from docopt import docopt
 import re
-import tempfile
 import textwrap
 import yaml
 import pandas as pd
+from StringIO import StringIO
 
 import matplotlib
 matplotlib.use('Agg')   # Force matplotlib to not use any Xwindows backend
@@ -66,6 +97,7 @@ VERBOSE = False
 DRYRUN = False
 FIGDPI = 144
 REWRITE = False
+INCREMENTAL = False
 
 # adds qascripts to the environment
 ASSETS = '{}/assets'.format(os.path.dirname(dm.utils.script_path()))
@@ -74,6 +106,17 @@ os.environ['PATH'] += os.pathsep + ASSETS + '/qascripts_version2'
 class Document:
     pass
 
+class QCMetrics:
+    """
+    Collects the values a QC handler computes for the QC database, so that
+    they can be written by a single process.
+    """
+    def __init__(self):
+        self.values = []
+
+    def add(self, table, subj, colname, value):
+        self.values.append((table, subj, colname, value))
+
 ###############################################################################
 # HELPERS
 
@@ -84,32 +127,32 @@ def makedirs(path):
 def run(cmd):
     logger.debug("exec: {}".format(cmd))
     if not DRYRUN:
-        p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            logger.error("Error {} while executing: {}".format(p.returncode, cmd))
+        result = dm.runner.run(cmd)
+        out, err = result.out, result.err
+        if result.returncode != 0:
+            logger.error("Error {} while executing: {}".format(result.returncode, cmd))
             out and logger.error("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and logger.error("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
         else:
-            logger.debug("rtnval: {}".format(p.returncode))
+            logger.debug("rtnval: {}".format(result.returncode))
             out and logger.debug("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and logger.debug("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
 
-def create_db(cur):
-    cur.execute('CREATE TABLE fmri (subj TEXT, site TEXT)')
-    cur.execute('CREATE TABLE dti (subj TEXT, site TEXT)')
-    cur.execute('CREATE TABLE t1 (subj TEXT, site TEXT)')
-
-def found_files_df(config, scanpath, subject):
+def found_files_df(config, scanpath, subject, catalog=None):
     '''
     reads in the export info from the config file and
     compares it to the contents of the subjects nii folder (scanpath)
     write the results out info a pandas dataframe
+    (the contents are looked up in the catalog, if one is given)
     '''
     ## get a list of files
     allfiles = []
-    for filetype in ('*.nii.gz', '*.nii'):
-        allfiles.extend(glob.glob(scanpath + '/*' + filetype))
+    if catalog:
+        allfiles = [entry.path for entry in catalog.files(folder=scanpath)
+                    if entry.path.endswith(('.nii.gz', '.nii'))]
+    else:
+        for filetype in ('*.nii.gz', '*.nii'):
+            allfiles.extend(glob.glob(scanpath + '/*' + filetype))
     allbfiles = []
     for file in allfiles: allbfiles.append(os.path.basename(file))
 
@@ -180,44 +223,79 @@ def nifti_basename(fpath):
     stem = basefpath.replace('.nii.gz','')
     return(stem)
 
-def insert_value(cur, table, subj, colname, value):
-    """
-    Insets values into the database (differently for numeric and string data).
+class QCDatabase:
     """
+    The subject QC database: a table for each kind of scan (fmri, dti, t1),
+    with a row per subject and a column per metric.
 
-    # check if column exits, add if it does not
-    cur.execute('PRAGMA table_info({})'.format(table))
-    d = cur.fetchall()
-
-    cols = []
-    for col in d:
-        cols.append(str(col[1]))
-
-    if colname not in cols:
-        cur.execute('ALTER TABLE {table} ADD COLUMN {colname} FLOAT DEFAULT null'.format(
-                           table=table, colname=colname))
+    The columns of each table are read once and cached, and new columns are
+    added as metrics appear. All of the metrics for a subject are written in a
+    single transaction, using parameterized statements.
 
-    # check if subject exists
-    cur.execute("""SELECT * FROM {table} WHERE subj='{subj}'""".format(
-                       table=table, subj=subj))
-    d = cur.fetchall()
+    If wal is True, the database is switched to write-ahead logging so that
+    readers (e.g. web-build.py) are not locked out while QC writes to it. WAL
+    needs shared memory, so don't use it for databases on network filesystems.
+    """
 
-    # if subject does not exist, insert row
-    if len(d) == 0:
-        if type(value) == str:
-            cur.execute("""INSERT INTO {table}(subj, {colname}) VALUES('{subj}', '{value}')""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-        else:
-            cur.execute("""INSERT INTO {table}(subj, {colname}) VALUES('{subj}', {value})""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-    # otherwise, update row
-    else:
-        if type(value) == str:
-            cur.execute("""UPDATE {table} SET {colname} = '{value}' WHERE subj='{subj}'""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-        else:
-            cur.execute("""UPDATE {table} SET {colname} = {value} WHERE subj='{subj}'""".format(
-                           table=table, subj=subj, colname=colname, value=value))
+    TABLES = ('fmri', 'dti', 't1')
+
+    def __init__(self, filename, wal=False, timeout=60):
+        self.db = sqlite3.connect(filename, timeout=timeout)
+        if wal:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for table in self.TABLES:
+                self.db.execute('CREATE TABLE IF NOT EXISTS {} '
+                                '(subj TEXT, site TEXT)'.format(table))
+        self.columns = {}
+
+    def get_columns(self, table):
+        if table not in self.columns:
+            rows = self.db.execute('PRAGMA table_info("{}")'.format(table))
+            self.columns[table] = [str(row[1]) for row in rows]
+        return self.columns[table]
+
+    def write(self, metrics):
+        """
+        Inserts or updates values, given as a list of (table, subj, colname,
+        value), in one transaction.
+        """
+        rows = collections.OrderedDict()
+        for table, subj, colname, value in metrics:
+            if isinstance(value, np.generic):
+                value = value.item()
+            rows.setdefault((table, subj), collections.OrderedDict())
+            rows[(table, subj)][colname] = value
+
+        if DRYRUN or not rows: return
+
+        with self.db:
+            for (table, subj), values in rows.items():
+                self.upsert(table, subj, values)
+
+    def upsert(self, table, subj, values):
+        columns = self.get_columns(table)
+        for colname in values:
+            if colname not in columns:
+                self.db.execute('ALTER TABLE "{}" ADD COLUMN "{}" '
+                                'FLOAT DEFAULT null'.format(table, colname))
+                columns.append(colname)
+
+        colnames = values.keys()
+        params = [values[c] for c in colnames]
+        updated = self.db.execute(
+            'UPDATE "{}" SET {} WHERE subj = ?'.format(table,
+                ', '.join('"{}" = ?'.format(c) for c in colnames)),
+            params + [subj])
+        if updated.rowcount == 0:
+            self.db.execute(
+                'INSERT INTO "{}" (subj, {}) VALUES (?, {})'.format(table,
+                    ', '.join('"{}"'.format(c) for c in colnames),
+                    ', '.join('?' for c in colnames)),
+                [subj] + params)
+
+    def close(self):
+        self.db.close()
 
 def factors(n):
     """
@@ -277,18 +355,7 @@ def load_masked_data(func, mask):
     Accepts 'functional.nii.gz' and 'mask.nii.gz', and returns a voxels x
     timepoints matrix of the functional data in non-zero mask locations.
     """
-    func = nib.load(func).get_data()
-    mask = nib.load(mask).get_data()
-
-    mask = mask.reshape(mask.shape[0]*mask.shape[1]*mask.shape[2])
-    func = func.reshape(func.shape[0]*func.shape[1]*func.shape[2],
-                                                    func.shape[3])
-
-    # find within-brain timeseries
-    idx = np.where(mask > 0)[0]
-    func = func[idx, :]
-
-    return func
+    return dm.utils.load_masked_nii(func, mask)
 
 def check_n_trs(fpath):
     """
@@ -354,32 +421,6 @@ def bounding_box(filename):
 
     return box
 
-def reorient_4d_image(image):
-    """
-    Reorients the data to radiological, one TR at a time
-    """
-    for i in np.arange(image.shape[3]):
-
-        if i == 0:
-            newimage = np.transpose(image[:, :, :, i], (2,0,1))
-            newimage = np.rot90(newimage, 2)
-
-        elif i == 1:
-            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
-            tmpimage = np.rot90(tmpimage, 2)
-            newimage = np.concatenate((newimage[...,np.newaxis],
-                                       tmpimage[...,np.newaxis]), axis=3)
-
-        else:
-            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
-            tmpimage = np.rot90(tmpimage, 2)
-            newimage = np.concatenate((newimage,
-                                       tmpimage[...,np.newaxis]), axis=3)
-
-    image = copy(newimage)
-
-    return image
-
 ###############################################################################
 # PLOTTERS / CALCULATORS
 
@@ -418,8 +459,7 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
         if len(image.shape) > 3: # if image is 4D, only keep the first time-point
             image = image[:, :, :, 0]
 
-        image = np.transpose(image, (2,0,1))
-        image = np.rot90(image, 2)
+        image = dm.utils.reorient_to_radiological(image)
         steps = np.round(np.linspace(0,np.shape(image)[0]-2, 36)) # coronal plane
         factor = 6
 
@@ -432,7 +472,7 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
         image = image[box[0,0]:box[0,1], box[1,0]:box[1,1], box[2,0]:box[2,1]]
 
     if mode == '4d':
-        image = reorient_4d_image(image)
+        image = dm.utils.reorient_to_radiological(image)
         midslice = np.floor((image.shape[2]-1)/2) # print a single plane across all slices
         factor = np.ceil(np.sqrt(image.shape[3])) # print all timepoints
         factor = factor.astype(int)
@@ -485,43 +525,55 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
     fig.savefig(pic, format='png', dpi=FIGDPI)
     plt.close()
 
-def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
+# per-slice, per-TR statistics of the centre of an EPI (see epi_spike_stats)
+SpikeStats = collections.namedtuple(
+    'SpikeStats', ['mean', 'sd', 'spikes', 'spikecount'])
 
+def epi_spike_stats(image, bvec=None):
     """
-    Plots, for each axial slice, the mean instensity over all TRs.
-    Strong deviations are an indication of the presence of spike
-    noise.
-
-    If bvec is supplied, we remove all time points that are 0 in the bvec
-    vector.
-
-    Usage:
-        find_epi_spikes(image, filename, picpath)
+    Computes the mean and SD of the centre of every axial slice at every TR
+    of a radiologically oriented 4D image (see
+    datman.utils.reorient_to_radiological).
+
+    The centre is the middle half of the slice in both in-plane directions. If
+    bvec is supplied, all time points that are 0 in the bvec vector are
+    removed.
+
+    Returns a SpikeStats, where mean and sd are slices x TRs arrays, spikes is
+    a boolean slices x TRs array marking time points whose mean is more than
+    the slice's mean SD above the slice's mean, and spikecount is the number
+    of these.
+    """
+    x = image.shape[1]
 
-        image    -- submitted image file name
-        filename -- qc image file name
-        pic      -- path to save the .png figure to
-        ftype    -- 'fmri' or 'dti'
-        cur      -- cursor object for subject qc database (if None, don't use)
-        bvec     -- numpy array of bvecs (for finding direction = 0)
+    # sets the bounds of the image
+    c1 = int(np.round(x*0.25))
+    c2 = int(np.round(x*0.75))
 
-    """
+    roi = image[:, c1:c2, c1:c2, :]
+    mean = roi.mean(axis=(1,2))
+    sd = roi.std(axis=(1,2))
 
-    image = str(image)             # input checks
-    opath = os.path.dirname(image) # grab the image folder
+    # crop out b0 images
+    if bvec is not None:
+        idx = np.where(bvec != 0)[0]
+        mean = mean[:, idx]
+        sd = sd[:, idx]
 
-    # load in the daterbytes
-    output = str(image)
-    image = nib.load(image).get_data()
-    image = reorient_4d_image(image)
+    # keep track of spikes
+    threshold = mean.mean(axis=1) + sd.mean(axis=1)
+    spikes = mean > threshold[:, np.newaxis]
 
-    x = image.shape[1]
-    y = image.shape[2]
-    z = image.shape[0]
-    t = image.shape[3]
+    return SpikeStats(mean=mean, sd=sd, spikes=spikes,
+                      spikecount=int(np.sum(spikes)))
 
-    # initialize the spikecount
-    spikecount = 0
+def plot_epi_spikes(stats, filename, pic):
+    """
+    Plots, for each axial slice, the mean and SD (see epi_spike_stats) over
+    all TRs.
+    """
+    z, t = stats.mean.shape
+    v_t = np.arange(t)
 
     # find the most square set of factors for n_trs
     factor = np.ceil(np.sqrt(z))
@@ -529,45 +581,11 @@ def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
 
     fig, axes = plt.subplots(nrows=factor, ncols=factor, facecolor='white')
 
-    # sets the bounds of the image
-    c1 = np.round(x*0.25)
-    c2 = np.round(x*0.75)
-
     # for each axial slice
     for i, ax in enumerate(axes.flat):
         if i < z:
-
-            v_mean = np.array([])
-            v_sd = np.array([])
-
-            # find the mean, STD, of each dir and concatenate w. vector
-            for j in np.arange(t):
-
-                # gives us a subset of the image
-                sample = image[i, c1:c2, c1:c2, j]
-                mean = np.mean(sample)
-                sd = np.std(sample)
-
-                if j == 0:
-                    v_mean = copy(mean)
-                    v_sd = copy(sd)
-                else:
-                    v_mean = np.hstack((v_mean, mean))
-                    v_sd = np.hstack((v_sd, sd))
-
-            # crop out b0 images
-            if bvec is None:
-                v_t = np.arange(t)
-            else:
-                idx = np.where(bvec != 0)[0]
-                v_mean = v_mean[idx]
-                v_sd = v_sd[idx]
-                v_t = np.arange(len(idx))
-
-            # keep track of spikes
-            v_spikes = np.where(v_mean > np.mean(v_mean)+np.mean(v_sd))[0]
-            spikecount = spikecount + len(v_spikes)
-
+            v_mean = stats.mean[i]
+            v_sd = stats.sd[i]
             ax.plot(v_mean, color='black')
             ax.fill_between(v_t, v_mean-v_sd, v_mean+v_sd, alpha=0.5, color='black')
             ax.set_frame_on(False)
@@ -576,20 +594,53 @@ def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
         else:
             ax.set_axis_off()
 
-    if cur:
-        subj = filename.split('_')[0:4]
-        subj = '_'.join(subj)
-
-        insert_value(cur, ftype, subj, 'spikecount', spikecount)
-
     plt.subplots_adjust(left=0, right=1, top=0.9, bottom=0)
     plt.suptitle('{}\nDTI Slice/TR Wise Abnormalities'.format(filename), size=10)
 
-
     fig.savefig(pic, format='png', dpi=FIGDPI)
     plt.close()
 
-def fmri_plots(func, mask, f, filename, pic, cur=None):
+def find_epi_spikes(image, filename, pic, ftype, metrics=None, bvec=None):
+
+    """
+    Plots, for each axial slice, the mean instensity over all TRs.
+    Strong deviations are an indication of the presence of spike
+    noise.
+
+    If bvec is supplied, we remove all time points that are 0 in the bvec
+    vector.
+
+    Usage:
+        find_epi_spikes(image, filename, picpath)
+
+        image    -- submitted image file name
+        filename -- qc image file name
+        pic      -- path to save the .png figure to
+        ftype    -- 'fmri' or 'dti'
+        metrics  -- QCMetrics to add the spike count to (if None, don't use)
+        bvec     -- numpy array of bvecs (for finding direction = 0)
+
+    Returns the SpikeStats computed.
+    """
+
+    image = str(image)             # input checks
+
+    # load in the daterbytes
+    image = nib.load(image).get_data()
+    image = dm.utils.reorient_to_radiological(image)
+
+    stats = epi_spike_stats(image, bvec)
+
+    if metrics is not None:
+        subj = filename.split('_')[0:4]
+        subj = '_'.join(subj)
+
+        metrics.add(ftype, subj, 'spikecount', stats.spikecount)
+
+    plot_epi_spikes(stats, filename, pic)
+    return stats
+
+def fmri_plots(func, mask, f, filename, pic, metrics=None):
     """
     Calculates and plots:
          + Mean and SD of normalized spectra across brain.
@@ -641,15 +692,15 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
     plt.ylabel('Framewise displacement (mm/TR)', size=6)
     plt.title('Head motion', size=6)
 
-    if cur:
+    if metrics is not None:
         fdtot = np.sum(f) # total framewise displacement
         fdnum = len(np.where(f > fd_thresh)[0]) # number of TRs above 0.5 mm FD
 
         subj = filename.split('_')[0:4]
         subj = '_'.join(subj)
 
-        insert_value(cur, 'fmri', subj, 'fdtot', fdtot)
-        insert_value(cur, 'fmri', subj, 'fdnum', fdnum)
+        metrics.add('fmri', subj, 'fdtot', fdtot)
+        metrics.add('fmri', subj, 'fdnum', fdnum)
 
     ##############################################################################
     # whole brain correlation
@@ -671,12 +722,12 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
         tick.set_fontsize(6)
     plt.title('Whole-brain r mean={}, SD={}'.format(str(mean), str(std)), size=6)
 
-    if cur:
+    if metrics is not None:
         subj = filename.split('_')[0:4]
         subj = '_'.join(subj)
 
-        insert_value(cur, 'fmri', subj, 'corrmean', mean)
-        insert_value(cur, 'fmri', subj, 'corrsd', std)
+        metrics.add('fmri', subj, 'corrmean', mean)
+        metrics.add('fmri', subj, 'corrsd', std)
 
     plt.suptitle(filename)
     plt.savefig(pic, format='png', dpi=FIGDPI)
@@ -685,10 +736,10 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
 ###############################################################################
 # PIPELINES
 
-def ignore(fpath, qcpath, qchtml, cur):
+def ignore(fpath, qcpath, qchtml, metrics):
     pass
 
-def fmri_qc(fpath, qcpath, qchtml, cur):
+def fmri_qc(fpath, qcpath, qchtml, metrics):
     """
     This takes an input image, motion corrects, and generates a brain mask.
     It then calculates a signal to noise ratio map and framewise displacement
@@ -705,86 +756,83 @@ def fmri_qc(fpath, qcpath, qchtml, cur):
     
     filename = os.path.basename(fpath)
     filestem = nifti_basename(fpath)
-    tmpdir = tempfile.mkdtemp(prefix='qc-')
-
-    run('3dvolreg \
-         -prefix {t}/mcorr.nii.gz \
-         -twopass -twoblur 3 -Fourier \
-         -1Dfile {t}/motion.1D {f}'.format(t=tmpdir, f=fpath))
-    run('3dTstat -prefix {t}/mean.nii.gz {t}/mcorr.nii.gz'.format(t=tmpdir))
-    run('3dAutomask \
-         -prefix {t}/mask.nii.gz \
-         -clfrac 0.5 -peels 3 {t}/mean.nii.gz'.format(t=tmpdir))
-    run('3dTstat -prefix {t}/std.nii.gz  -stdev {t}/mcorr.nii.gz'.format(t=tmpdir))
-    run("""3dcalc \
-           -prefix {t}/sfnr.nii.gz \
-           -a {t}/mean.nii.gz -b {t}/std.nii.gz -expr 'a/b'""".format(t=tmpdir))
-
-    # output BOLD-contrast qc-pic
-    BOLDpic = os.path.join(qcpath, filestem + '_BOLD.png')
-    montage(fpath, 'BOLD-contrast', filename, BOLDpic, maxval=0.75)
-    add_pic_to_html(qchtml, BOLDpic)
-
-    # output fMRI plots
-    fMRIplotspic = os.path.join(qcpath,filestem + '_fmriplots.png')
-    fmri_plots('{t}/mcorr.nii.gz'.format(t=tmpdir),
-                     '{t}/mask.nii.gz'.format(t=tmpdir),
-                     '{t}/motion.1D'.format(t=tmpdir), filename, fMRIplotspic, cur)
-    add_pic_to_html(qchtml, fMRIplotspic)
-
-    SNRpic = os.path.join(qcpath,filestem + '_SNR.png')
-    montage('{t}/sfnr.nii.gz'.format(t=tmpdir),
-                  'SFNR', filename, SNRpic, cmaptype='hot', maxval=0.75)
-    add_pic_to_html(qchtml, SNRpic)
-
-
-    Spikespic = os.path.join(qcpath,filestem + '_Spikes.png')
-    find_epi_spikes(fpath, filename, Spikespic, 'fmri', cur=cur)
-    add_pic_to_html(qchtml, Spikespic)
-
-    # run metrics from qascripts toolchain
-    run('ln -s {fpath} {t}/fmri.nii.gz'.format(fpath=fpath, t=tmpdir))
-    run('qa_bold_v2.sh {t}/fmri.nii.gz {t}/qc_fmri.csv'.format(t=tmpdir))
-    run('mv {t}/qc_fmri.csv {qcpath}/{filestem}_qascript_fmri.csv'.format(t=tmpdir, filestem=filestem, qcpath=qcpath))
-
-    run('rm -r {}'.format(tmpdir))
-
-def rest_qc(fpath, qcpath, qchtml, cur):
+    with dm.scratch.Scratch(prefix='qc-') as tmpdir:
+        run('3dvolreg \
+             -prefix {t}/mcorr.nii.gz \
+             -twopass -twoblur 3 -Fourier \
+             -1Dfile {t}/motion.1D {f}'.format(t=tmpdir, f=fpath))
+        run('3dTstat -prefix {t}/mean.nii.gz {t}/mcorr.nii.gz'.format(t=tmpdir))
+        run('3dAutomask \
+             -prefix {t}/mask.nii.gz \
+             -clfrac 0.5 -peels 3 {t}/mean.nii.gz'.format(t=tmpdir))
+        run('3dTstat -prefix {t}/std.nii.gz  -stdev {t}/mcorr.nii.gz'.format(t=tmpdir))
+        run("""3dcalc \
+               -prefix {t}/sfnr.nii.gz \
+               -a {t}/mean.nii.gz -b {t}/std.nii.gz -expr 'a/b'""".format(t=tmpdir))
+
+        # output BOLD-contrast qc-pic
+        BOLDpic = os.path.join(qcpath, filestem + '_BOLD.png')
+        montage(fpath, 'BOLD-contrast', filename, BOLDpic, maxval=0.75)
+        add_pic_to_html(qchtml, BOLDpic)
+
+        # output fMRI plots
+        fMRIplotspic = os.path.join(qcpath,filestem + '_fmriplots.png')
+        fmri_plots('{t}/mcorr.nii.gz'.format(t=tmpdir),
+                         '{t}/mask.nii.gz'.format(t=tmpdir),
+                         '{t}/motion.1D'.format(t=tmpdir), filename, fMRIplotspic, metrics)
+        add_pic_to_html(qchtml, fMRIplotspic)
+
+        SNRpic = os.path.join(qcpath,filestem + '_SNR.png')
+        montage('{t}/sfnr.nii.gz'.format(t=tmpdir),
+                      'SFNR', filename, SNRpic, cmaptype='hot', maxval=0.75)
+        add_pic_to_html(qchtml, SNRpic)
+
+
+        Spikespic = os.path.join(qcpath,filestem + '_Spikes.png')
+        find_epi_spikes(fpath, filename, Spikespic, 'fmri', metrics=metrics)
+        add_pic_to_html(qchtml, Spikespic)
+
+        # run metrics from qascripts toolchain
+        run('ln -s {fpath} {t}/fmri.nii.gz'.format(fpath=fpath, t=tmpdir))
+        run('qa_bold_v2.sh {t}/fmri.nii.gz {t}/qc_fmri.csv'.format(t=tmpdir))
+        run('mv {t}/qc_fmri.csv {qcpath}/{filestem}_qascript_fmri.csv'.format(t=tmpdir, filestem=filestem, qcpath=qcpath))
+
+def rest_qc(fpath, qcpath, qchtml, metrics):
     """
     This takes an input image, motion corrects, and generates a brain mask.
     It then calculates a signal to noise ratio map and framewise displacement
     plot for the file.
     """
-    fmri_qc(fpath, qcpath, qchtml, cur)
+    fmri_qc(fpath, qcpath, qchtml, metrics)
 
-def pdt2_qc(fpath,qcpath, qchtml, cur):
+def pdt2_qc(fpath,qcpath, qchtml, metrics):
     ## split PD and T2 image
     pdpath = fpath.replace('_PDT2_','_PD_')
     t2path = fpath.replace('_PDT2_','_T2_')
-    pd_qc(pdpath,qcpath, qchtml, cur)
-    t2_qc(t2path,qcpath, qchtml, cur)
+    pd_qc(pdpath,qcpath, qchtml, metrics)
+    t2_qc(t2path,qcpath, qchtml, metrics)
 
-def t1_qc(fpath, qcpath, qchtml, cur):
+def t1_qc(fpath, qcpath, qchtml, metrics):
     pic=os.path.join(qcpath, nifti_basename(fpath) + '.png')
     fslslicer_pic(fpath,pic,5,1600)
     add_pic_to_html(qchtml, pic)
 
-def pd_qc(fpath,qcpath, qchtml, cur):
+def pd_qc(fpath,qcpath, qchtml, metrics):
     pic=os.path.join(qcpath, nifti_basename(fpath) + '.png')
     fslslicer_pic(fpath,pic,2,1600)
     add_pic_to_html(qchtml, pic)
 
-def t2_qc(fpath, qcpath, qchtml, cur):
+def t2_qc(fpath, qcpath, qchtml, metrics):
     pic=os.path.join(qcpath, nifti_basename(fpath) + '.png')
     fslslicer_pic(fpath,pic,2,1600)
     add_pic_to_html(qchtml, pic)
 
-def flair_qc(fpath,qcpath, qchtml, cur):
+def flair_qc(fpath,qcpath, qchtml, metrics):
     pic=os.path.join(qcpath, nifti_basename(fpath) + '.png')
     fslslicer_pic(fpath,pic,2,1600)
     add_pic_to_html(qchtml, pic)
 
-def dti_qc(fpath, qcpath, qchtml, cur):
+def dti_qc(fpath, qcpath, qchtml, metrics):
     """
     Runs the QC pipeline on the DTI inputs. We use the BVEC (not BVAL)
     file to find B0 images (in some scans, mid-sequence B0s are coded
@@ -816,18 +864,16 @@ def dti_qc(fpath, qcpath, qchtml, cur):
     add_pic_to_html(qchtml, dti4dpic)
 
     spikespic = os.path.join(qcpath, filestem + '_spikes.png')
-    find_epi_spikes(fpath, filename, spikespic, 'dti', cur=cur, bvec=bvec)
+    find_epi_spikes(fpath, filename, spikespic, 'dti', metrics=metrics, bvec=bvec)
     add_pic_to_html(qchtml, spikespic)
 
     # run metrics from qascripts toolchain
-    tmpdir = tempfile.mkdtemp(prefix='qc-')
-    run('ln -s {fpath} {t}/dti.nii.gz'.format(fpath=fpath, t=tmpdir))
-    run('ln -s {bvecfile} {t}/dti.bvec'.format(bvecfile=bvecfile, t=tmpdir))
-    run('ln -s {bvalfile} {t}/dti.bval'.format(bvalfile=bvalfile, t=tmpdir))
-    run('qa_dti_v2.sh {t}/dti.nii.gz {t}/dti.bval {t}/dti.bvec {t}/qc_dti.csv'.format(t=tmpdir))
-    run('mv {t}/qc_dti.csv {qcpath}/{filestem}_qascript_dti.csv'.format(t=tmpdir, filestem=filestem, qcpath=qcpath))
-
-    run('rm -r {}'.format(tmpdir))
+    with dm.scratch.Scratch(prefix='qc-') as tmpdir:
+        run('ln -s {fpath} {t}/dti.nii.gz'.format(fpath=fpath, t=tmpdir))
+        run('ln -s {bvecfile} {t}/dti.bvec'.format(bvecfile=bvecfile, t=tmpdir))
+        run('ln -s {bvalfile} {t}/dti.bval'.format(bvalfile=bvalfile, t=tmpdir))
+        run('qa_dti_v2.sh {t}/dti.nii.gz {t}/dti.bval {t}/dti.bvec {t}/qc_dti.csv'.format(t=tmpdir))
+        run('mv {t}/qc_dti.csv {qcpath}/{filestem}_qascript_dti.csv'.format(t=tmpdir, filestem=filestem, qcpath=qcpath))
 
 def add_header_checks(fpath, qchtml, logdata):
     filestem = os.path.basename(fpath).replace(dm.utils.get_extension(fpath),'')
@@ -853,6 +899,62 @@ def add_bvec_checks(fpath, qchtml, logdata):
         qchtml.write('<tr><td>{}</td></tr>'.format(l))
     qchtml.write('</table>\n')
     
+def qc_inputs(fpath):
+    """
+    Returns a [path, size, mtime] list for each file the QC of a series is
+    computed from: the nifti itself, and any files that share its name (e.g.
+    .bvec/.bval). PDT2 series are QC'd from their split PD and T2 images, so
+    those are included as well.
+    """
+    stem = fpath[:-len(dm.utils.get_extension(fpath))]
+    paths = set(glob.glob(stem + '.*'))
+    if '_PDT2_' in stem:
+        paths.update(glob.glob(stem.replace('_PDT2_','_PD_') + '.*'))
+        paths.update(glob.glob(stem.replace('_PDT2_','_T2_') + '.*'))
+
+    inputs = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        inputs.append([path, st.st_size, st.st_mtime])
+    return inputs
+
+def load_manifest(manifestfile):
+    """
+    Loads the record of the inputs and html of each QC'd series of a subject.
+    """
+    if not os.path.exists(manifestfile):
+        return {}
+    with open(manifestfile, 'r') as stream:
+        return yaml.load(stream) or {}
+
+def save_manifest(manifestfile, manifest):
+    if DRYRUN: return
+    with open(manifestfile, 'w') as stream:
+        yaml.dump(manifest, stream, default_flow_style=False)
+
+def is_up_to_date(entry, inputs, qcpath):
+    """
+    Checks that a series' manifest entry was made from the given inputs, and
+    that all the images its html refers to still exist.
+    """
+    if not entry or entry.get('inputs') != inputs:
+        return False
+    for pic in re.findall('src="([^"]+)"', entry.get('html', '')):
+        if not os.path.exists(os.path.join(qcpath, pic)):
+            return False
+    return True
+
+def qc_series(handler, fpath, qcpath, htmlfile):
+    """
+    Runs a QC handler on a series and returns the html it produces, along with
+    the metrics it computed (as a list of (table, subj, colname, value)).
+    """
+    fragment = StringIO()
+    fragment.name = htmlfile  # so that images are linked relative to the page
+    metrics = QCMetrics()
+    handler(fpath, qcpath, fragment, metrics)
+    return fragment.getvalue(), metrics.values
+
 def add_old_image(fpath, qcpath, qchtml, tag):
     fname = nifti_basename(fpath)
     fname = os.path.join(qcpath, fname)
@@ -877,14 +979,18 @@ def add_old_image(fpath, qcpath, qchtml, tag):
 ###############################################################################
 # MAIN
 
-def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
+def qc_folder(scanpath, subject, qcdir, pconfig, QC_HANDLERS, pool=None,
+              catalog=None):
     """
     QC all the images in a folder (scanpath).
 
     Outputs PDF and other files to outputdir. All files named startng with
     subject.
 
-    'cur' is a cursor pointing to the QC database.
+    The QC of each series is run straight away, or submitted to pool (a
+    multiprocessing.Pool) if given. Returns a Document describing the qc page,
+    which write_qc_page() writes once the QC has finished, or None if the
+    subject is skipped.
 
     pconfig is loaded from the project_settings.yml file
     """
@@ -893,15 +999,72 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
     qcpath = dm.utils.define_folder(os.path.join(qcdir,subject))
 
     htmlfile = os.path.join(qcpath, 'qc_{}.html'.format(subject))
-    if os.path.exists(htmlfile) and not REWRITE:
+    manifestfile = os.path.join(qcpath, 'qc_{}_manifest.yml'.format(subject))
+    if os.path.exists(htmlfile) and not (REWRITE or INCREMENTAL):
         logger.debug("{} exists, skipping.".format(htmlfile))
         return
 
+    page = Document()
+    page.subject = subject
+    page.scanpath = scanpath
+    page.qcdir = qcdir
+    page.qcpath = qcpath
+    page.htmlfile = htmlfile
+    page.manifestfile = manifestfile
+    page.manifest = load_manifest(manifestfile)
+
+    ## now read exportinfo from config_yml
+    page.exportinfo = found_files_df(pconfig, scanpath, subject, catalog)
+
+    # the html and metrics (or pending QC result) of each series, by file name
+    page.results = {}
+    for idx in range(0,len(page.exportinfo)):
+        bname = page.exportinfo.loc[idx,'File']
+        if bname == '':
+            continue
+        fname = os.path.join(scanpath, bname)
+        ident, tag, series, description = dm.scanid.parse_filename(fname)
+        if tag not in QC_HANDLERS or REWRITE:
+            continue
+
+        inputs = qc_inputs(fname)
+        entry = page.manifest.get(bname)
+        if INCREMENTAL and is_up_to_date(entry, inputs, qcpath):
+            logger.debug("{} is up to date, skipping.".format(fname))
+            page.results[bname] = (entry['html'], [])
+            continue
+
+        logger.info("QC scan {}".format(fname))
+        args = (QC_HANDLERS[tag], fname, qcpath, htmlfile)
+        if pool:
+            page.results[bname] = pool.apply_async(qc_series, args)
+        else:
+            page.results[bname] = qc_series(*args)
+        page.manifest[bname] = {'inputs': inputs}
+
+    return page
+
+def write_qc_page(page, db, QC_HANDLERS):
+    """
+    Writes the qc page for a subject (see qc_folder), and the metrics computed
+    for it to the QC database. Waits for any QC still running in the pool.
+
+    'db' is the QCDatabase.
+    """
+    subject = page.subject
+    scanpath = page.scanpath
+    qcdir = page.qcdir
+    qcpath = page.qcpath
+    htmlfile = page.htmlfile
+    exportinfo = page.exportinfo
+
     if REWRITE:
         try: 
             os.remove(htmlfile)
         except:
             print("{} does not exist. Reconstructing html file from any images present.".format(htmlfile))
+    elif INCREMENTAL and os.path.exists(htmlfile):
+        os.remove(htmlfile)
 
     qchtml = open(htmlfile,'a')
     qchtml.write('<HTML><TITLE>{} qc</TITLE>\n'.format(subject))
@@ -930,12 +1093,9 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
     qchtml.write('<h1> QC report for {} <h1/>'.format(subject))
 
     # add in sites to the database
-    insert_value(cur, 'fmri', subject, 'site', subject.split('_')[1])
-    insert_value(cur, 'dti', subject, 'site', subject.split('_')[1])
-    insert_value(cur, 't1', subject, 'site', subject.split('_')[1])
+    site = subject.split('_')[1]
+    subject_metrics = [(table, subject, 'site', site) for table in db.TABLES]
 
-    ## now read exportinfo from config_yml
-    exportinfo = found_files_df(pconfig, scanpath, subject)
     qchtml_writetable(qchtml, exportinfo)
 
     ## hack job - find and add a link to the technotes..
@@ -972,7 +1132,6 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
         bname = exportinfo.loc[idx,'File']
         if bname!='' :
             fname = os.path.join(scanpath, bname)
-            logger.info("QC scan {}".format(fname))
             ident, tag, series, description = dm.scanid.parse_filename(fname)
             qchtml.write('<h2 id="{}">{}</h2>\n'.format(exportinfo.loc[idx,'bookmark'], bname))
             if tag not in QC_HANDLERS:
@@ -984,14 +1143,26 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
             if bvecs_check_log:
                 add_bvec_checks(fname, qchtml, bvecs_check_log)
                 
-            if not REWRITE:    
-                QC_HANDLERS[tag](fname, qcpath, qchtml, cur)
-            else:
+            if REWRITE:
                 add_old_image(fname, qcpath, qchtml, tag)
+            else:
+                result = page.results[bname]
+                if isinstance(result, multiprocessing.pool.AsyncResult):
+                    result = result.get()
+                html, metrics = result
+                subject_metrics.extend(metrics)
+                page.manifest[bname]['html'] = html
+                qchtml.write(html)
                 
             qchtml.write('<br>')
 
     qchtml.close()
+    db.write(subject_metrics)
+
+    # forget about series that are no longer in the folder
+    bnames = exportinfo.File.tolist()
+    manifest = dict((k, v) for k, v in page.manifest.items() if k in bnames)
+    save_manifest(page.manifestfile, manifest)
 
 def main():
     """
@@ -1001,6 +1172,7 @@ def main():
     global DEBUG
     global DRYRUN
     global REWRITE
+    global INCREMENTAL
 
     QC_HANDLERS = {   # map from tag to QC function
             "T1"            : t1_qc,
@@ -1044,41 +1216,46 @@ def main():
     ymlfile   = arguments['--project-settings']
     scanid    = arguments['--subject']
     REWRITE   = arguments['--rewrite']
+    INCREMENTAL = arguments['--incremental']
     VERBOSE   = arguments['--verbose']
     DEBUG     = arguments['--debug']
     DRYRUN    = arguments['--dry-run']
+    jobs      = int(arguments['--jobs'])
 
     if VERBOSE:
         logging.getLogger().setLevel(logging.INFO)
     if DEBUG:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    catalog = dm.catalog.open_catalog(arguments['--catalog'],
+                                      os.path.join(datadir, 'nii'))
     if scanid:
-        timepoint_glob = '{}/nii/{}'.format(datadir, scanid)
+        timepoints = glob.glob('{}/nii/{}'.format(datadir, scanid))
+    elif catalog:
+        timepoints = [os.path.join(datadir, 'nii', timepoint)
+                      for timepoint in catalog.subjects()]
     else:
-        timepoint_glob = '{}/nii/*'.format(datadir)
+        timepoints = glob.glob('{}/nii/*'.format(datadir))
 
     if not dbdir: dbdir = qcdir
     db_filename = '{}/subject-qc.db'.format(dbdir)
-    db_is_new = not os.path.exists(db_filename)
 
     try:
-        db = sqlite3.connect(db_filename)
-    except:
+        db = QCDatabase(db_filename, wal=arguments['--wal'])
+    except sqlite3.Error:
         logger.error('Invalid database path, or permissions issue.')
         sys.exit('Invalid database path, or permissions issue.')
 
-    cur = db.cursor()
-
-    # initialize the tables if the database does not yet exist
-    if db_is_new == True:
-        create_db(cur)
-
     # load the yml of project settings
     with open(ymlfile, 'r') as stream:
         pconfig = yaml.load(stream)
 
-    for path in glob.glob(timepoint_glob):
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+    pages = []
+    for path in timepoints:
         subject = os.path.basename(path)
 
         # skip phantoms
@@ -1086,10 +1263,21 @@ def main():
             pass
         else:
             logger.info("QCing folder {}".format(path))
-            qc_folder(path, subject, qcdir, cur, pconfig, QC_HANDLERS)
+            page = qc_folder(path, subject, qcdir, pconfig, QC_HANDLERS, pool,
+                             catalog)
+            if page and pool:
+                pages.append(page)
+            elif page:
+                write_qc_page(page, db, QC_HANDLERS)
+
+    # with a pool, the QC has only been queued so far
+    for page in pages:
+        write_qc_page(page, db, QC_HANDLERS)
+
+    if pool:
+        pool.close()
+        pool.join()
 
-    # close database properly
-    cur.close()
     db.close()
 
 if __name__ == "__main__":
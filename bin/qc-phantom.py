@@ -50,9 +50,10 @@ import time, datetime
 import csv, yaml
 
 import datman as dm
+import datman.scratch
+import datman.utils
 import dicom as dcm
 from docopt import docopt
-import tempfile
 
 import numpy as np
 import nibabel as nib
@@ -235,14 +236,13 @@ def find_adni_t1_vals(project, data):
     title = copy(data)
 
     # convert data to LPI orientation
-    tmpdir = tempfile.mkdtemp(prefix='adni-')
-    os.system('3daxialize -prefix {}/adni-lpi.nii.gz -orient LPI {}'.format(
-                                                               tmpdir, data))
-    os.system('flirt -in {tmpdir}/adni-lpi.nii.gz -ref {template} -out {tmpdir}/adni-lpi-reg.nii.gz'.format(
-                                              tmpdir=tmpdir, template=template))
+    with dm.scratch.Scratch(prefix='adni-') as tmpdir:
+        dm.utils.run('3daxialize -prefix {}/adni-lpi.nii.gz -orient LPI {}'.format(
+                                                    tmpdir, data), echo=True)
+        dm.utils.run('flirt -in {tmpdir}/adni-lpi.nii.gz -ref {template} -out {tmpdir}/adni-lpi-reg.nii.gz'.format(
+                                tmpdir=tmpdir, template=template), echo=True)
 
-    data = nib.load(os.path.join(tmpdir, 'adni-lpi-reg.nii.gz')).get_data() # import
-    os.system('rm -r {}'.format(tmpdir))
+        data = nib.load(os.path.join(tmpdir, 'adni-lpi-reg.nii.gz')).get_data() # import
 
     data = data[:, :, data.shape[2]/2] # take central axial slice
     data = np.fliplr(np.rot90(data)) # rotate 90 deg --> flip l-r
@@ -329,7 +329,7 @@ def find_fmri_vals(base_path, subj, phantom):
     if os.path.isfile(outputfile) == False:
         cmd = (r"addpath(genpath('{}')); analyze_fmri_phantom('{}','{}','{}')".format(
                                               qc_code, base_path, subj, phantom))
-        os.system('matlab -nodisplay -nosplash -r "' + cmd + '"')
+        dm.utils.run('matlab -nodisplay -nosplash -r "' + cmd + '"', echo=True)
 
     data = np.genfromtxt(outputfile, delimiter=',',dtype=np.float, skip_header=1)
 
@@ -353,7 +353,7 @@ def find_dti_vals(base_path, subj, raw, bval, fa):
     if os.path.isfile(outputfile) == False:
         cmd = (r"addpath(genpath('{}')); analyze_dti_phantom('{}','{}','{}', '{}', {})".format(
                                                qc_code, raw, fa, bval, output, 1))
-        os.system('matlab -nodisplay -nosplash -r "' + cmd + '"')
+        dm.utils.run('matlab -nodisplay -nosplash -r "' + cmd + '"', echo=True)
 
     data = np.genfromtxt(outputfile, delimiter=',',dtype=np.float, skip_header=1)
 
@@ -13,6 +13,12 @@ Options:
     --exportinfo FILE       Table listing acquisitions to export by format
                             [default: ./metadata/exportinfo.csv]
     --blacklist FILE        Table listing series to ignore
+    --header-index FILE     sqlite index of archive headers to read from and
+                            update (see datman.headerindex)
+    -j, --jobs N            Number of series conversions to run in parallel
+                            [default: 1]
+    --cache DIR             Folder to keep converted series in, so that they
+                            can be reused (see CONVERSION CACHE)
     -v, --verbose           Show intermediate steps
     --debug                 Show debug messages
     -n, --dry-run           Do nothing
@@ -90,6 +96,20 @@ EXPORT TABLE FORMAT
     DTI-33-b3000  b3000   no          yes         yes          1
     DTI-33-b1000  b1000   no          yes         yes          1
 
+    A format can be converted by another program than the usual one for some
+    tags, named in an optional "converter_<format>" column. The converters
+    are:
+
+        nii   dcm2nii (default), or pydicom to convert in-process (see
+              NIFTI CONVERSION)
+
+    For example:
+
+    pattern       tag     export_nii  converter_nii  count
+    T1            T1      yes         pydicom        1
+    DTI-60        DTI-60  yes         pydicom        3
+    Resting       RES     yes         dcm2nii        1
+
 NON-DICOM DATA
     XNAT puts "other" (i.e. non-DICOM data) into the RESOURCES folder. This
     data will be copied to a subfolder of the data directory named
@@ -106,28 +126,91 @@ NON-DICOM DATA
             SPN01_CMH_0001_01_01_CAT_002_catalog.xml
             ...
 
+PARALLEL EXPORT
+    Every series is converted to each export format by a separate task, and
+    the non-DICOM data of each archive is copied by another. When the --jobs
+    option is given, these tasks (from all of the given archives) are run by
+    a pool of worker processes. Messages from a task are prefixed with the
+    name of the file it is producing, and a summary of the tasks that failed
+    is printed once all of them have finished.
+
+CONVERSION CACHE
+    Normally a series is only converted if its output file does not exist yet.
+    With --cache, each series is instead converted once into the cache folder
+    and hard-linked (or copied, across filesystems) into the data folder.
+    Cached conversions are looked up by a fingerprint of:
+
+        the export format and the version of its converter
+        the SOPInstanceUID and size of each dicom in the series
+        the name and size of any other files in the series folder
+
+    so a series that is re-sent or changed on XNAT gets reconverted even if
+    its output exists. An unchanged series is reused without conversion, even
+    under a different project or timepoint name.
+
+    The outputs in the data folder are checked against the cache each time.
+    The first run with --cache therefore reconverts everything once.
+
+    A series that is to be converted with pydicom but turns out not to be
+    supported is cached as a dcm2nii conversion, under dcm2nii's version.
+
+    Cache entries are never removed, so the cache keeps the conversions of
+    series that have since changed, and of older converter versions. Files
+    that were hard-linked into a data folder and are no longer used there
+    have a link count of 1, so stale entries can be found with e.g.
+
+        find <cachedir> -mindepth 3 -type f -links 1
+
+    (entries that were copied across filesystems always look unused).
+
+NIFTI CONVERSION
+    With the pydicom converter each series is assembled into a NIfTI volume
+    (with .bvec and .bval files for diffusion series) in-process, and written
+    straight to its output, rather than by running dcm2nii (see
+    datman.dicom2nifti). Series it does not support (e.g. mosaics, multi-frame
+    or compressed dicoms) are converted with dcm2nii instead. Most of these
+    are recognised from the headers already read to find the series' tag, so
+    they are sent to dcm2nii without reading their slices.
+
+    Its output differs from dcm2nii's: the volume is not reoriented, so the
+    voxels are in the order they were acquired in.
+
 EXAMPLES
 
     xnat-extract.py /xnat/spred/archive/SPINS/arc001/SPN01_CMH_0001_01_01
 
+    xnat-extract.py --jobs 16 /xnat/spred/archive/SPINS/arc001/SPN01_CMH_*
+
 """
 from docopt import docopt
 import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headerindex
+import datman.dicom2nifti
+import datman.scratch
+import datman.runner
+import dicom
 import os.path
 import sys
+import hashlib
 import subprocess as proc
 import tempfile
 import glob
 import shutil
+import itertools
+import multiprocessing
 
 DEBUG  = False
 VERBOSE= False
 DRYRUN = False
+CACHEDIR = None  # conversion cache folder, if any
+TASK   = None    # name of the export task running in this process, if any
+FAILURES = []    # commands that failed during the current export task
 
 def log(message):
+    if TASK: message = "[{}] {}".format(TASK, message)
     print message
     sys.stdout.flush()
 
@@ -149,14 +232,16 @@ def makedirs(path):
 def run(cmd):
     debug("exec: {}".format(cmd))
     if not DRYRUN:
-        p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            log("Error {} while executing: {}".format(p.returncode, cmd))
+        result = dm.runner.run(cmd)
+        out, err = result.out, result.err
+        if result.returncode != 0:
+            FAILURES.append("Error {} while executing: {}".format(
+                result.returncode, cmd))
+            log("Error {} while executing: {}".format(result.returncode, cmd))
             out and log("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and log("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
         else:
-            debug("rtnval: {}".format(p.returncode))
+            debug("rtnval: {}".format(result.returncode))
             out and debug("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and debug("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
 
@@ -164,14 +249,18 @@ def main():
     global DEBUG
     global DRYRUN
     global VERBOSE
+    global CACHEDIR
     arguments = docopt(__doc__)
     archives       = arguments['<archivedir>']
     exportinfofile = arguments['--exportinfo']
     datadir        = arguments['--datadir']
     blacklist      = arguments['--blacklist'] or []
+    index          = dm.headerindex.open_index(arguments['--header-index'])
     VERBOSE        = arguments['--verbose']
     DEBUG          = arguments['--debug']
     DRYRUN         = arguments['--dry-run']
+    jobs           = int(arguments['--jobs'])
+    CACHEDIR       = arguments['--cache']
 
     try:
         exportinfo = pd.read_table(exportinfofile, sep='\s*', engine="python")
@@ -187,12 +276,76 @@ def main():
                     blacklist))
             bl = []
 
+    tagmatcher = get_tagmatcher(exportinfo)
+
+    tasks = []
     for archivepath in archives:
         verbose("Exporting {}".format(archivepath))
-        extract_archive(exportinfo, archivepath, datadir, blacklist)
+        tasks.extend(extract_archive(exportinfo, archivepath, datadir,
+                blacklist, index, tagmatcher))
+
+    failures = run_export_tasks(tasks, jobs)
+    if failures:
+        error("{} of {} export tasks failed:".format(len(failures), len(tasks)))
+        for (fmt, src, outputdir, stem, converter), messages in failures:
+            log("\t{} ({}) from {}".format(stem, fmt, src))
+            for message in messages:
+                log("\t\t{}".format(message))
+
+def run_export_tasks(tasks, jobs=1):
+    """
+    Runs the given export tasks, in a pool of jobs worker processes if jobs > 1.
+
+    Returns a list of (task, messages) for each task that failed.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap_unordered(run_export_task, tasks)
+    else:
+        pool = None
+        results = itertools.imap(run_export_task, tasks)
+
+    failures = [(task, messages) for task, messages in results if messages]
 
+    if pool:
+        pool.close()
+        pool.join()
+    return failures
 
-def extract_archive(exportinfo, archivepath, exportdir, blacklist):
+def run_export_task(task):
+    """
+    Converts a single series to a single format.
+
+    The task is a (format, seriesdir, outputdir, stem, converter) tuple, as
+    returned by export_series(), or by export_resources() for the RESOURCES
+    format. Returns the task and a list of the failures encountered.
+    """
+    global TASK
+    fmt, src, outputdir, stem, converter = task
+    TASK = "{}.{}".format(stem, fmt)
+    del FAILURES[:]
+    try:
+        if fmt == RESOURCES:
+            sync_resources(src, outputdir)
+        elif CACHEDIR:
+            export_cached(fmt, src, outputdir, stem, converter)
+        else:
+            get_exporter(fmt, converter)(src, outputdir, stem)
+    except Exception, e:
+        error("{}: {}".format(type(e).__name__, e))
+        FAILURES.append("{}: {}".format(type(e).__name__, e))
+    TASK = None
+    return task, FAILURES[:]
+
+def get_tagmatcher(exportinfo):
+    """
+    Returns a datman.utils.TagMatcher for the patterns in an exportinfo table.
+    """
+    return dm.utils.TagMatcher(dict(zip(exportinfo['pattern'].tolist(),
+                                        exportinfo['tag'].tolist())))
+
+def extract_archive(exportinfo, archivepath, exportdir, blacklist, index=None,
+        tagmatcher=None):
     """
     Exports an XNAT archive to various file formats.
 
@@ -201,8 +354,14 @@ def extract_archive(exportinfo, archivepath, exportdir, blacklist):
     according to our data naming scheme.
 
     This function searches through the SCANS subfolder (archivepath) for series
-    and converts each series, placing them in an appropriately named folder
-    under exportdir.
+    and returns a list of tasks to convert each series, placing them in an
+    appropriately named folder under exportdir (see run_export_tasks()), and
+    a task to copy the non-dicom resources.
+
+    If index is given (a datman.headerindex.HeaderIndex) series headers are
+    looked up there rather than re-read from the archive. If tagmatcher is
+    given (see get_tagmatcher()) it is used rather than building one from
+    exportinfo.
     """
 
     archivepath = os.path.normpath(archivepath)
@@ -213,13 +372,13 @@ def extract_archive(exportinfo, archivepath, exportdir, blacklist):
     except datman.scanid.ParseException, e:
         error("{} folder is not named according to the data naming policy. " \
               "Skipping".format(archivepath))
-        return
+        return []
 
     scanspath = os.path.join(archivepath,'SCANS')
     if not os.path.isdir(scanspath):
         error("{} doesn't exist. Not an XNAT archive. "\
               "Skipping.".format(scanspath))
-        return
+        return []
 
     fmts         = get_formats_from_exportinfo(exportinfo)
     unknown_fmts = [fmt for fmt in fmts if fmt not in exporters]
@@ -227,30 +386,34 @@ def extract_archive(exportinfo, archivepath, exportdir, blacklist):
     if len(unknown_fmts) > 0:
         error("Unknown formats requested for export of {}: {}. " \
               "Skipping.".format(archivepath, ",".join(unknown_fmts)))
-        return
+        return []
 
     # export each series to datadir/fmt/subject/
     timepoint = scanid.get_full_subjectid_with_timepoint()
 
     stem  = str(scanid)
-    for src, header in dm.utils.get_archive_headers(archivepath).items():
-        export_series(exportinfo, src, header, fmts, timepoint, stem,
-                exportdir, blacklist)
+    tasks = []
+    tagmatcher = tagmatcher or get_tagmatcher(exportinfo)
+    headers = dm.utils.get_archive_headers(archivepath, index=index)
+    for src, header in headers.items():
+        tasks.extend(export_series(exportinfo, src, header, fmts, timepoint,
+                stem, exportdir, blacklist, tagmatcher))
 
     # export non dicom resources
-    export_resources(archivepath, exportdir, scanid)
+    tasks.extend(export_resources(archivepath, exportdir, scanid))
+    return tasks
 
 def export_series(exportinfo, src, header, formats, timepoint, stem,
-        exportdir, blacklist):
+        exportdir, blacklist, tagmatcher):
     """
-    Exports the given DICOM folder into the given formats.
+    Returns a list of (format, seriesdir, outputdir, stem, converter) tasks
+    that export the given DICOM folder into the given formats. The converter
+    is None for the format's usual converter (see get_converter()).
     """
     description   = header.get("SeriesDescription")
     mangled_descr = dm.utils.mangle(description)
     series        = str(header.get("SeriesNumber")).zfill(2)
-    tagmap        = dict(zip(exportinfo['pattern'].tolist(),
-                             exportinfo['tag'].tolist()))
-    tag           = dm.utils.guess_tag(mangled_descr, tagmap)
+    tag           = tagmatcher.guess(mangled_descr)
 
     debug("{}: description = {}, series = {}, tag = {}".format(
         src, description, series, tag))
@@ -258,11 +421,13 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
     if not tag:
         verbose("No matching export pattern for {}, descr: {}. Skipping".format(
             src, description))
-        return
+        return []
     elif type(tag) is list:
+        conflicts = tagmatcher.conflicts(mangled_descr)
         error("Multiple export patterns match for {}, descr: {}, tags: {}".format(
-            src, description, tag))
-        return
+            src, description, "; ".join("{} (pattern {})".format(
+                t, ", ".join(conflicts[t])) for t in tag)))
+        return []
 
     tag_exportinfo = exportinfo[exportinfo['tag'] == tag]
 
@@ -271,18 +436,65 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
 
     if blacklist and stem in blacklist:
         debug("{} in blacklist. Skipping.".format(stem))
-        return
+        return []
 
+    tasks = []
     for fmt in formats:
         if all(tag_exportinfo['export_'+fmt] == 'no'):
             debug("{}: export_{} set to 'no' for tag {} so skipping".format(
                 src, fmt, tag))
             continue
 
+        try:
+            converter = get_converter(tag_exportinfo, fmt, header)
+        except ValueError, e:
+            error("{}: {}. Skipping.".format(src, e))
+            continue
+
         outputdir  = os.path.join(exportdir,fmt,timepoint)
         if not os.path.exists(outputdir): makedirs(outputdir)
 
-        exporters[fmt](src,outputdir,stem)
+        tasks.append((fmt, src, outputdir, stem, converter))
+    return tasks
+
+def get_converter(tag_exportinfo, fmt, header):
+    """
+    Returns the converter named for a format in the converter_<fmt> column of
+    a tag's exportinfo, or None for the format's usual converter.
+
+    A series that the pydicom converter can be seen not to support from its
+    header is given to the usual converter. Raises a ValueError if the
+    converter is unknown.
+    """
+    column = 'converter_' + fmt
+    if column not in tag_exportinfo:
+        return None
+    names = [n for n in tag_exportinfo[column].dropna().tolist() if n]
+    if not names:
+        return None
+
+    converter = names[0]
+    if (fmt, converter) not in converters:
+        raise ValueError("Unknown {} converter {}".format(fmt, converter))
+    if converters[(fmt, converter)] is exporters[fmt]:
+        return None
+
+    if converter == 'pydicom':
+        try:
+            dm.dicom2nifti.check_header(header)
+        except dm.dicom2nifti.ConversionError, e:
+            verbose("{}, using dcm2nii instead of pydicom".format(e))
+            return None
+    return converter
+
+def get_exporter(fmt, converter=None):
+    """
+    Returns the function that exports a series to a format with a converter
+    (or the format's usual converter, if None).
+    """
+    if converter:
+        return converters[(fmt, converter)]
+    return exporters[fmt]
 
 def get_formats_from_exportinfo(dataframe):
     """
@@ -298,18 +510,25 @@ def get_formats_from_exportinfo(dataframe):
 
 def export_resources(archivepath, exportdir, scanid):
     """
-    Exports all the non-dicom resources for an exam archive.
+    Returns a list of the tasks (see run_export_task()) that export the
+    non-dicom resources for an exam archive: one, or none if it has none.
     """
     sourcedir = os.path.join(archivepath, "RESOURCES")
 
     if not os.path.isdir(sourcedir):
         debug("{} isn't a directory, so won't export resources".format(
             sourcedir))
-        return
+        return []
 
-    debug("Exporting non-dicom stuff from {}".format(archivepath))
     outputdir = os.path.join(exportdir,"RESOURCES",str(scanid))
     if not os.path.exists(outputdir): makedirs(outputdir)
+    return [(RESOURCES, sourcedir, outputdir, str(scanid), None)]
+
+def sync_resources(sourcedir, outputdir):
+    """
+    Copies the non-dicom resources of an exam archive.
+    """
+    debug("Exporting non-dicom stuff from {}".format(sourcedir))
     run("rsync -a {}/ {}/".format(sourcedir, outputdir))
 
 def export_mnc_command(seriesdir,outputdir,stem):
@@ -341,19 +560,46 @@ def export_nii_command(seriesdir,outputdir,stem):
 
     verbose("Exporting series {} to {}".format(seriesdir, outputfile))
 
-    # convert into tempdir
-    tmpdir = tempfile.mkdtemp()
-    run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
+    # convert into scratch space
+    with dm.scratch.Scratch(prefix='dcm2nii-') as tmpdir:
+        run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
 
-    # move nii in tempdir to proper location
-    for f in glob.glob("{}/*".format(tmpdir)):
-        bn = os.path.basename(f)
-        ext = dm.utils.get_extension(f)
-        if bn.startswith("o") or bn.startswith("co"):
-            continue
-        else:
-            run("mv {} {}/{}{}".format(f, outputdir, stem, ext))
-    shutil.rmtree(tmpdir)
+        # move nii in scratch space to proper location
+        for f in glob.glob("{}/*".format(tmpdir)):
+            bn = os.path.basename(f)
+            ext = dm.utils.get_extension(f)
+            if bn.startswith("o") or bn.startswith("co"):
+                continue
+            else:
+                run("mv {} {}/{}{}".format(f, outputdir, stem, ext))
+
+def export_nii_pydicom(seriesdir,outputdir,stem,fallback=True):
+    """
+    Converts a DICOM series to NifTi format in-process (see NIFTI CONVERSION),
+    or with dcm2nii if the series isn't supported. With fallback=False, a
+    dm.dicom2nifti.ConversionError is raised instead.
+    """
+    outputfile = os.path.join(outputdir,stem) + ".nii.gz"
+
+    if os.path.exists(outputfile):
+        debug("{}: output {} exists. skipping.".format(
+            seriesdir, outputfile))
+        return
+
+    verbose("Exporting series {} to {} with pydicom".format(
+        seriesdir, outputfile))
+    if DRYRUN: return
+
+    try:
+        outputs = dm.dicom2nifti.convert_series(seriesdir,
+                os.path.join(outputdir,stem))
+    except dm.dicom2nifti.ConversionError, e:
+        if not fallback: raise
+        verbose("{}: {}, using dcm2nii instead".format(seriesdir, e))
+        export_nii_command(seriesdir,outputdir,stem)
+        return
+    for output in outputs:
+        debug("wrote {}".format(output))
 
 def export_nrrd_command(seriesdir,outputdir,stem):
     """
@@ -383,11 +629,10 @@ def export_dcm_command(seriesdir,outputdir,stem):
             seriesdir, outputfile))
         return
 
-    import dicom
     dcmfile = None
     for path in glob.glob(seriesdir + '/*'):
         try:
-            dicom.read_file(path)
+            dm.utils.read_dicom_header(path)
             dcmfile = path
             break
         except dicom.filereader.InvalidDicomError, e:
@@ -398,6 +643,148 @@ def export_dcm_command(seriesdir,outputdir,stem):
     cmd = 'cp {} {}'.format(dcmfile, outputfile)
     run(cmd)
 
+def converter_version(fmt, converter=None):
+    """
+    Returns the version of the converter used for the given format, as the
+    first line it prints when asked for its version.
+    """
+    if converter == 'pydicom':
+        return "datman.dicom2nifti {} (pydicom {}, nibabel {})".format(
+                dm.dicom2nifti.VERSION, dm.dicom2nifti.dicom.__version__,
+                dm.dicom2nifti.nib.__version__)
+
+    if fmt not in CONVERTER_VERSIONS:
+        version = ''
+        cmd = CONVERTER_VERSION_COMMANDS.get(fmt)
+        if cmd:
+            p = proc.Popen(cmd, shell=True, stdout=proc.PIPE,
+                           stderr=proc.STDOUT)
+            out, _ = p.communicate()
+            lines = [l.strip() for l in out.splitlines() if l.strip()]
+            version = lines and lines[0] or ''
+        CONVERTER_VERSIONS[fmt] = version
+    return CONVERTER_VERSIONS[fmt]
+
+def series_fingerprint(seriesdir, fmt, converter=None):
+    """
+    Returns a fingerprint of the conversion of a series to the given format,
+    with the given converter (see get_exporter()).
+
+    Dicoms are identified by their SOPInstanceUID and size rather than their
+    names, since XNAT names dicoms after the session they were uploaded to.
+    """
+    files = []
+    for path in glob.glob(seriesdir + '/*'):
+        uid = ''
+        if dm.utils.is_dicom_candidate(path):
+            try:
+                header = dm.utils.read_dicom_header(path, ['SOPInstanceUID'])
+                uid = header.get('SOPInstanceUID', '')
+            except dicom.filereader.InvalidDicomError, e:
+                pass
+        name = uid and 'uid:' + uid or os.path.basename(path)
+        files.append((name, os.path.getsize(path)))
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update('{}\n{}\n'.format(fmt,
+            converter_version(fmt, converter)))
+    for name, size in sorted(files):
+        fingerprint.update('{}\t{}\n'.format(name, size))
+    return fingerprint.hexdigest()
+
+def export_cached(fmt, seriesdir, outputdir, stem, converter=None):
+    """
+    Exports a series through the conversion cache (see CONVERSION CACHE).
+
+    Each conversion is kept in CACHEDIR/<fmt>/<fingerprint>/, with its
+    outputs named after CACHE_STEM, and linked into outputdir under stem.
+
+    A series the pydicom converter turns out not to support is cached as a
+    dcm2nii conversion (under dcm2nii's fingerprint), and an empty
+    <fingerprint>.dcm2nii file is left in place of the pydicom entry so that
+    later runs go straight to dcm2nii.
+    """
+    fingerprint = series_fingerprint(seriesdir, fmt, converter)
+    entry = os.path.join(CACHEDIR, fmt, fingerprint)
+    debug("{}: fingerprint {}".format(seriesdir, fingerprint))
+
+    if converter == 'pydicom' and os.path.exists(entry + FALLBACK_SUFFIX):
+        debug("{}: not supported by pydicom, using dcm2nii".format(seriesdir))
+        return export_cached(fmt, seriesdir, outputdir, stem)
+
+    if not os.path.isdir(entry):
+        verbose("Converting series {} into cache {}".format(seriesdir, entry))
+        if DRYRUN: return
+
+        if not os.path.isdir(os.path.dirname(entry)):
+            try:
+                os.makedirs(os.path.dirname(entry))
+            except OSError, e:
+                pass    # made by another task in the meantime
+        tmpdir = tempfile.mkdtemp(prefix='.', dir=os.path.dirname(entry))
+        try:
+            if converter == 'pydicom':
+                export_nii_pydicom(seriesdir, tmpdir, CACHE_STEM,
+                                   fallback=False)
+            else:
+                get_exporter(fmt, converter)(seriesdir, tmpdir, CACHE_STEM)
+            if FAILURES or not os.listdir(tmpdir):
+                error("Conversion of {} failed, not caching it".format(
+                    seriesdir))
+                return
+            try:
+                os.rename(tmpdir, entry)
+            except OSError, e:
+                debug("{} was cached by another task".format(entry))
+        except dm.dicom2nifti.ConversionError, e:
+            verbose("{}: {}, using dcm2nii instead".format(seriesdir, e))
+            open(entry + FALLBACK_SUFFIX, 'w').close()
+            return export_cached(fmt, seriesdir, outputdir, stem)
+        finally:
+            if os.path.isdir(tmpdir): shutil.rmtree(tmpdir)
+
+    for name in sorted(os.listdir(entry)):
+        cached = os.path.join(entry, name)
+        output = os.path.join(outputdir, stem + name[len(CACHE_STEM):])
+        if is_same_file(cached, output):
+            debug("{}: output {} is up to date. skipping.".format(
+                seriesdir, output))
+            continue
+
+        verbose("Linking {} to {}".format(cached, output))
+        if DRYRUN: continue
+        if os.path.lexists(output): os.remove(output)
+        try:
+            os.link(cached, output)
+        except OSError, e:
+            shutil.copy2(cached, output)
+
+def is_same_file(cached, output):
+    """
+    Returns True if output is a link to, or a copy (by size and modification
+    time) of, the cached file.
+    """
+    if not os.path.exists(output):
+        return False
+    if os.path.samefile(cached, output):
+        return True
+    a, b = os.stat(cached), os.stat(output)
+    return (a.st_size, int(a.st_mtime)) == (b.st_size, int(b.st_mtime))
+
+# the name given to outputs in the conversion cache
+CACHE_STEM = "series"
+# the format of the tasks that copy non-dicom resources
+RESOURCES = "RESOURCES"
+# marks a pydicom cache entry whose series is converted with dcm2nii instead
+FALLBACK_SUFFIX = ".dcm2nii"
+
+CONVERTER_VERSION_COMMANDS = {
+    "mnc" : "dcm2mnc -version",
+    "nii" : "dcm2nii",
+    "nrrd": "DWIConvert --version",
+}
+CONVERTER_VERSIONS = {}
+
 exporters = {
     "mnc" : export_mnc_command,
     "nii" : export_nii_command,
@@ -405,6 +792,12 @@ exporters = {
     "dcm" : export_dcm_command,
 }
 
+# the converters that can be chosen for a format in the exportinfo table
+converters = {
+    ("nii", "dcm2nii"): export_nii_command,
+    ("nii", "pydicom"): export_nii_pydicom,
+}
+
 if __name__ == '__main__':
     main()
 
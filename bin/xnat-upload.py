@@ -21,40 +21,43 @@ Options:
     -u,--username USER    XNAT username. If specified then the credentials
                           file is ignored and you are prompted for password.
 
+    --jobs N              Number of non-dicom files to upload at once
+                          [default: 4]
+
+    --retries N           Number of times to retry a failed request
+                          [default: 5]
+
+    --timeout SECS        Seconds to wait for the server to answer a request
+                          before it counts as failed [default: 600]
+
+    --journal DIR         Folder to record the completed steps of each upload
+                          in, so that an interrupted upload resumes where it
+                          stopped when run again
+
     -v,--verbose          Be chatty
 
+DETAILS
+
+    Requests that fail to connect, time out or that get a server error are
+    retried, waiting twice as long before each retry. An import of the dicoms
+    that times out is left to carry on in XNAT rather than sent again, and is
+    not counted as a failure. See datman.xnat for details.
 """
 from docopt import docopt
 import datman as dm
 import datman.scanid
 import datman.utils
-import dicom as dcm
+import datman.xnat
 import getpass
-import io
 import logging
 import os.path
 import requests
-import urllib
 import sys
-import zipfile
-import time
 
 logging.basicConfig(level=logging.WARN,
                     format="[%(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(os.path.basename(__file__))
 
-CREATE_URL = "{server}/REST/projects/{project}/subjects/{subject}"
-
-UPLOAD_URL = "{server}/data/services/import?" \
-             "project={project}&subject={subject}&session={session}" \
-             "&overwrite=delete&prearchive=false&inbody=true"
-
-ATTACH_URL = "{server}/data/archive/projects/{project}/subjects/{subject}" \
-             "/experiments/{session}/files/{filename}?" \
-             "inbody=true"
-
-dcm_exts = ('dcm','img')
-
 def main():
     arguments = docopt(__doc__)
     server   = arguments['--server']
@@ -63,9 +66,14 @@ def main():
     verbose  = arguments['--verbose']
     username = arguments['--username']
     credfile = arguments['--credfile']
+    jobs     = int(arguments['--jobs'])
+    retries  = int(arguments['--retries'])
+    timeout  = float(arguments['--timeout'])
+    journal  = arguments['--journal']
 
     if verbose:
         logger.setLevel(logging.INFO)
+        dm.xnat.logger.setLevel(logging.INFO)
 
     if username:
         password = getpass.getpass()
@@ -80,74 +88,15 @@ def main():
         logger.error("{} is not a valid scan identifier".format(scanid))
         sys.exit(1)
 
-    subject = scanid
-    session = scanid
-    auth = (username, password)
-    url_params = { 'server'  : server,
-                   'project' : project,
-                   'subject' : subject,
-                   'session' : session }
-
-    # Upload - https://wiki.xnat.org/pages/viewpage.action?pageId=5017279
-
-    # create the subject
-    logger.info("Creating subject {}".format(subject))
-    r = requests.put(CREATE_URL.format(**url_params), auth=auth)
-
-    if r.status_code is not 200 and r.status_code is not 201:
-        logger.error("{} http client error at folder creation: {}".format(scanid,r.status_code))
+    if journal:
+        dm.utils.makedirs(journal)
 
-    # NOTE: If your project is not set to auto archive, then this will end up in the prearchive
-    logger.info("Uploading dicom data...")
-    r = requests.post(UPLOAD_URL.format(**url_params),
-            auth=auth,
-            headers={'Content-Type' : 'application/zip'},
-            data=open(archive))
-
-    if r.status_code is not 200:
-        logger.error("{} http client error dicom data upload: {}".format(scanid,r.status_code))
-
-        if r.status_code is 504:
-            time.sleep(30)
-
-    # upload non-dicom stuff
-    logger.info("Scanning for non-dicom data...")
-    zf = zipfile.ZipFile(archive)
-
-    # filter dirs
-    files = zf.namelist()
-    files = filter(lambda f: not f.endswith('/'), files)
-
-    # filter files named like dicoms
-    files = filter(lambda f: not is_named_like_a_dicom(f), files)
-
-    # filter actual dicoms :D
-    files = filter(lambda f: not is_dicom(io.BytesIO(zf.read(f))), files)
-
-    logger.info("Uploading non-dicom data...")
-    for f in files:
-        # convert to HTTP language
-        uploadname = urllib.quote(f)
-        r = None
-        try:
-            r = requests.post(ATTACH_URL.format(filename=uploadname, **url_params), data=zf.read(f), auth=auth)
-            r.raise_for_status()
-
-        except requests.exceptions.HTTPError, e:
-            logger.error("ERROR uploading file {}".format(f))
-            raise e
-
-    print("Subject {} uploaded to xnat".format(subject))
-
-def is_named_like_a_dicom(path):
-    return any(map(lambda x: path.lower().endswith(x), dcm_exts))
+    uploader = dm.xnat.Uploader(server, (username, password), jobs=jobs,
+                                retries=retries, timeout=timeout)
+    if not uploader.upload(project, archive, journaldir=journal):
+        sys.exit(1)
 
-def is_dicom(fileobj):
-    try:
-        dcm.read_file(fileobj)
-        return True
-    except dcm.filereader.InvalidDicomError:
-        return False
+    print("Subject {} uploaded to xnat".format(scanid))
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,256 @@
+"""
+A persistent, on-disk listing of the files in a project's data folders.
+
+Many of our scripts look through the same data/nii/<timepoint>/ folders to
+find which subjects and series exist, each globbing and stat-ing every file.
+On the archive's network filesystem this takes minutes per script. This
+module keeps a sqlite catalog of every file below a root folder (its path,
+the scan id, tag, series and description parsed from its name, and its size
+and modification time) that scripts can query instead.
+
+The catalog is refreshed incrementally. A folder is only listed again when its
+modification time has changed since it was catalogued, which happens whenever
+a file or folder is added to, removed from or renamed within it. Unchanged
+folders cost one stat() each. Files that are rewritten in place do not change
+their folder, so their size and mtime are only brought up to date by a full
+refresh (refresh(full=True)).
+
+Usage:
+
+    import datman as dm
+
+    catalog = dm.catalog.open_catalog('metadata/catalog.db', 'data/nii')
+    for entry in catalog.files(subject='SPN01_CMH_0001_01', tag='T1'):
+        print entry.path, entry.series, entry.size
+"""
+import os
+import stat
+import time
+import sqlite3
+import collections
+import datman.scanid as scanid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name      TEXT PRIMARY KEY,
+    value     TEXT
+);
+CREATE TABLE IF NOT EXISTS folders (
+    path      TEXT PRIMARY KEY,
+    parent    TEXT,
+    mtime     REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,
+    folder      TEXT,
+    subject     TEXT,
+    scanid      TEXT,
+    tag         TEXT,
+    series      TEXT,
+    description TEXT,
+    size        INTEGER,
+    mtime       REAL
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, tag);
+"""
+
+# folders modified this recently (in seconds) are listed again on the next
+# refresh, in case they change again within the filesystem's mtime resolution
+RACY_MTIME = 2
+
+# the root folder is stored as '.', like os.path.relpath() does
+ROOT = '.'
+
+Entry = collections.namedtuple('Entry', ['path', 'subject', 'scanid', 'tag',
+        'series', 'description', 'size', 'mtime'])
+
+class Catalog:
+    """
+    A sqlite-backed listing of the files below root.
+
+    Paths are stored relative to root, so the catalog can be kept alongside
+    the data it lists. Entries are returned with absolute paths. The subject
+    of a file is the name of the folder directly below root that holds it
+    (e.g. the timepoint folder in data/nii). The scan id, tag, series and
+    description are None for files that don't follow the naming scheme.
+    """
+
+    def __init__(self, filename, root, timeout=60):
+        self.filename = filename
+        self.root = os.path.abspath(root)
+        self.db = sqlite3.connect(filename, timeout=timeout)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+        # a catalog of some other folder is of no use to us
+        row = self.db.execute(
+            "SELECT value FROM settings WHERE name = 'root'").fetchone()
+        if row is None or row[0] != self.root:
+            self.db.execute('DELETE FROM folders')
+            self.db.execute('DELETE FROM files')
+            self.db.execute('INSERT OR REPLACE INTO settings (name, value) '
+                            "VALUES ('root', ?)", (self.root,))
+        self.db.commit()
+
+    def refresh(self, full=False):
+        """
+        Brings the catalog up to date with the folders below root.
+
+        Only folders that have changed are listed again, unless full=True, in
+        which case every folder is listed and every file stat-ed.
+        """
+        known = dict(self.db.execute('SELECT path, mtime FROM folders'))
+        seen = set()
+
+        folders = [ROOT]
+        while folders:
+            folder = folders.pop()
+            try:
+                mtime = os.stat(self.abspath(folder)).st_mtime
+            except OSError:
+                continue
+            seen.add(folder)
+
+            if not full and known.get(folder) == mtime:
+                folders.extend(row[0] for row in self.db.execute(
+                    'SELECT path FROM folders WHERE parent = ?', (folder,)))
+            else:
+                folders.extend(self._index_folder(folder, mtime))
+
+        for folder in set(known) - seen:
+            self.db.execute('DELETE FROM folders WHERE path = ?', (folder,))
+            self.db.execute('DELETE FROM files WHERE folder = ?', (folder,))
+        self.db.commit()
+
+    def _index_folder(self, folder, mtime):
+        """
+        Lists a folder into the catalog, and returns its subfolders.
+        """
+        subfolders = []
+        rows = []
+        for name in os.listdir(self.abspath(folder)):
+            path = os.path.normpath(os.path.join(folder, name))
+            try:
+                st = os.lstat(self.abspath(path))
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(self.abspath(path))
+                    if stat.S_ISDIR(st.st_mode):
+                        continue  # don't follow links to other folders
+            except OSError:
+                continue  # removed, or a broken link
+
+            if stat.S_ISDIR(st.st_mode):
+                subfolders.append(path)
+            elif stat.S_ISREG(st.st_mode):
+                rows.append(self._file_row(path, folder, st))
+
+        if time.time() - mtime < RACY_MTIME:
+            mtime = None
+
+        parent = None
+        if folder != ROOT:
+            parent = os.path.dirname(folder) or ROOT
+        self.db.execute('DELETE FROM files WHERE folder = ?', (folder,))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO files (path, folder, subject, scanid, tag, '
+            'series, description, size, mtime) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('INSERT OR REPLACE INTO folders (path, parent, mtime) '
+                        'VALUES (?, ?, ?)', (folder, parent, mtime))
+        return subfolders
+
+    def _file_row(self, path, folder, st):
+        subject = None
+        if folder != ROOT:
+            subject = path.split(os.path.sep)[0]
+
+        try:
+            ident, tag, series, description = scanid.parse_filename(path)
+            ident = str(ident)
+        except scanid.ParseException:
+            ident = tag = series = description = None
+
+        return (path, folder, subject, ident, tag, series, description,
+                st.st_size, st.st_mtime)
+
+    def abspath(self, path):
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def relpath(self, path):
+        """
+        Returns the path relative to root, as it is stored in the catalog.
+        """
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == os.pardir or rel.startswith(os.pardir + os.path.sep):
+            raise ValueError('{} is not within {}'.format(path, self.root))
+        return rel
+
+    def files(self, subject=None, tag=None, series=None, folder=None,
+              fuzzy=False):
+        """
+        Returns the Entry of each catalogued file, sorted by path.
+
+        The files can be limited to those of a subject, tag or series, or to
+        those directly within a folder (given as a path). If fuzzy is True,
+        tags are matched if the given tag is found within the file's tag.
+        """
+        query = ('SELECT path, subject, scanid, tag, series, description, '
+                 'size, mtime FROM files')
+        where, params = [], []
+        if subject is not None:
+            where.append('subject = ?')
+            params.append(subject)
+        if tag is not None and not fuzzy:
+            where.append('tag = ?')
+            params.append(tag)
+        if series is not None:
+            where.append('series = ?')
+            params.append(series)
+        if folder is not None:
+            where.append('folder = ?')
+            params.append(self.relpath(folder))
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        entries = []
+        for row in self.db.execute(query + ' ORDER BY path', params):
+            if fuzzy and tag is not None and (row[3] is None or
+                                              tag not in row[3]):
+                continue
+            entries.append(Entry(self.abspath(row[0]), *row[1:]))
+        return entries
+
+    def subfolders(self, folder=ROOT):
+        """
+        Returns the sorted names of the folders directly within a folder
+        (root, by default).
+        """
+        if folder != ROOT:
+            folder = self.relpath(folder)
+        return sorted(os.path.basename(row[0]) for row in self.db.execute(
+            'SELECT path FROM folders WHERE parent = ?', (folder,)))
+
+    def subjects(self):
+        """
+        Returns the names of the subject folders directly within root.
+        """
+        return self.subfolders()
+
+    def close(self):
+        self.db.close()
+
+def open_catalog(filename, root):
+    """
+    Convenience method that returns a freshly refreshed Catalog of root, or
+    None if no filename is given (so that scripts can pass their --catalog
+    option straight through).
+    """
+    if not filename:
+        return None
+    catalog = Catalog(filename, root)
+    catalog.refresh()
+    return catalog
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,310 @@
+"""
+Converts a series of dicoms to NIfTI in-process, with pydicom and nibabel.
+
+This is an alternative to running dcm2nii for each series. It reads every
+slice once and writes the volume (and, for diffusion series, the .bvec and
+.bval files in FSL's format) straight to the output path, without a temporary
+folder or any outside programs.
+
+Only the common case is handled: a series of single-frame slices sharing one
+orientation and size, possibly repeated over time (fMRI) or gradient
+directions (DWI). Anything else (Siemens mosaics, enhanced multi-frame
+dicoms, compressed pixel data, GE diffusion headers, ...) raises a
+ConversionError, so that the caller can fall back to dcm2nii.
+
+Images are written in the order they are stored in the dicoms (the first
+voxel axis along the rows, the second down the columns, the third through
+the slices), with the affine taking them to RAS+ world coordinates.
+
+Usage:
+
+    import datman as dm
+
+    # header is the dicom header of any slice, e.g. from get_archive_headers
+    dm.dicom2nifti.check_header(header)
+    outputs = dm.dicom2nifti.convert_series('SCANS/5/DICOM', 'data/DTI60')
+"""
+import os
+import glob
+import struct
+import dicom
+import numpy as np
+import nibabel as nib
+import datman.utils
+
+# bumped whenever the output changes, so that cached conversions are redone
+VERSION = '2'
+
+# how far apart (in mm) slice positions can be and still count as the same
+POSITION_TOLERANCE = 0.01
+
+# diffusion headers: the standard ones, then Siemens' private ones
+DIFFUSION_BVALUE = (0x0018, 0x9087)
+DIFFUSION_DIRECTION = (0x0018, 0x9089)
+SIEMENS_BVALUE = (0x0019, 0x100c)
+SIEMENS_DIRECTION = (0x0019, 0x100e)
+GE_BVALUE = (0x0043, 0x1039)
+
+# the characters of numbers written out as text (e.g. in an IS or DS header)
+NUMERIC_TEXT = '0123456789+-.eE \\'
+
+class ConversionError(Exception):
+    pass
+
+def check_header(header):
+    """
+    Raises a ConversionError if a series can be seen to be unsupported from
+    the header of one of its slices, so that it can be sent to dcm2nii
+    without reading the rest of the series.
+    """
+    image_type = [str(t).upper() for t in header.get('ImageType') or []]
+    if 'MOSAIC' in image_type:
+        raise ConversionError("Mosaic images are not supported")
+    if int(header.get('NumberOfFrames') or 1) > 1:
+        raise ConversionError("Multi-frame images are not supported")
+    if GE_BVALUE in header:
+        raise ConversionError("GE diffusion headers are not supported")
+    for name in ('ImagePositionPatient', 'ImageOrientationPatient',
+                 'PixelSpacing'):
+        if name not in header:
+            raise ConversionError("No {} header".format(name))
+
+def read_series(seriesdir):
+    """
+    Reads every dicom (header and pixels) in a series folder.
+    """
+    slices = []
+    for path in sorted(glob.glob(os.path.join(seriesdir, '*'))):
+        if not os.path.isfile(path): continue
+        if not datman.utils.is_dicom_candidate(path): continue
+        try:
+            slices.append(dicom.read_file(path))
+        except dicom.filereader.InvalidDicomError, e:
+            continue
+    if not slices:
+        raise ConversionError("No dicoms found in {}".format(seriesdir))
+    return slices
+
+def floats(value):
+    return np.array([float(v) for v in value])
+
+def sort_slices(slices):
+    """
+    Sorts the slices of a series into volumes.
+
+    Returns a list of volumes, each a list of slices ordered along the slice
+    normal, and the direction cosines of the rows, columns and normal. Raises
+    a ConversionError unless every volume has the same, evenly spaced, slice
+    positions.
+    """
+    orientation = floats(slices[0].ImageOrientationPatient)
+    rows, cols = orientation[:3], orientation[3:]
+    normal = np.cross(rows, cols)
+    shape = (slices[0].Rows, slices[0].Columns)
+
+    positions = []
+    for ds in slices:
+        check_header(ds)
+        if not np.allclose(floats(ds.ImageOrientationPatient), orientation,
+                           atol=1e-4):
+            raise ConversionError("Slices have different orientations")
+        if (ds.Rows, ds.Columns) != shape:
+            raise ConversionError("Slices have different sizes")
+        position = np.dot(normal, floats(ds.ImagePositionPatient))
+        positions.append((position, int(ds.get('InstanceNumber') or 0), ds))
+    positions.sort(key=lambda p: p[:2])
+
+    # group the slices by position, each group in acquisition order
+    groups = []
+    for position, _, ds in positions:
+        if groups and position - groups[-1][0] < POSITION_TOLERANCE:
+            groups[-1][1].append(ds)
+        else:
+            groups.append((position, [ds]))
+
+    nvolumes = len(groups[0][1])
+    if any(len(group) != nvolumes for _, group in groups):
+        raise ConversionError("Slice positions are repeated unevenly")
+
+    # the affine assumes evenly spaced slices, so a missing slice (or a
+    # series with gaps) has to go to dcm2nii
+    spacings = np.diff([position for position, _ in groups])
+    if len(spacings) and np.ptp(spacings) > POSITION_TOLERANCE:
+        raise ConversionError("Slices are not evenly spaced")
+
+    volumes = [[group[t] for _, group in groups] for t in range(nvolumes)]
+    return volumes, np.array([rows, cols, normal]).T
+
+def series_affine(volume, cosines):
+    """
+    Returns the voxel to RAS+ affine of a volume (a sorted list of slices).
+    """
+    first = floats(volume[0].ImagePositionPatient)
+    row_spacing, col_spacing = floats(volume[0].PixelSpacing)
+    if len(volume) > 1:
+        step = (floats(volume[-1].ImagePositionPatient) - first) / \
+               (len(volume) - 1)
+    else:
+        thickness = float(volume[0].get('SpacingBetweenSlices') or
+                          volume[0].get('SliceThickness') or 1)
+        step = cosines[:, 2] * thickness
+
+    affine = np.eye(4)
+    affine[:3, 0] = cosines[:, 0] * col_spacing
+    affine[:3, 1] = cosines[:, 1] * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = first
+
+    # dicom is LPS+, nifti is RAS+
+    return np.dot(np.diag([-1, -1, 1, 1]), affine)
+
+def pixel_array(ds):
+    try:
+        return ds.pixel_array
+    except (NotImplementedError, TypeError, ValueError), e:
+        # e.g. compressed transfer syntaxes, which pydicom can't decode
+        raise ConversionError("Cannot read pixel data: {}".format(e))
+
+def series_data(volumes):
+    """
+    Returns the image data of the volumes as an (x, y, z, t) array, with the
+    rescale slope and intercept if every slice shares them (or None, None if
+    they don't, in which case the data is rescaled to floats).
+    """
+    rescales = set((float(ds.get('RescaleSlope') or 1),
+                    float(ds.get('RescaleIntercept') or 0))
+                   for volume in volumes for ds in volume)
+    first = volumes[0][0]
+    dtype = pixel_array(first).dtype if len(rescales) == 1 else np.float32
+
+    shape = (first.Columns, first.Rows, len(volumes[0]), len(volumes))
+    data = np.empty(shape, dtype=dtype)
+    for t, volume in enumerate(volumes):
+        for z, ds in enumerate(volume):
+            pixels = pixel_array(ds)
+            if len(rescales) > 1:
+                pixels = pixels * float(ds.get('RescaleSlope') or 1) + \
+                         float(ds.get('RescaleIntercept') or 0)
+            data[:, :, z, t] = pixels.T
+
+    if len(rescales) == 1:
+        return data, rescales.pop()
+    return data, (None, None)
+
+def header_values(ds, tag, count):
+    """
+    Returns the count numbers in a header, or None if it is missing. Private
+    headers read without their VR come as raw little-endian doubles (or, for
+    Siemens' b-value, as text).
+    """
+    if tag not in ds:
+        return None
+    value = ds[tag].value
+    if isinstance(value, str):
+        text = value.strip('\0 ')
+        if len(value) == 8 * count and text.strip(NUMERIC_TEXT):
+            return list(struct.unpack('<{}d'.format(count), value))
+        value = text.split('\\')
+    elif not isinstance(value, (list, tuple, dicom.multival.MultiValue)):
+        value = [value]
+    try:
+        value = [float(v) for v in value]
+    except ValueError:
+        return None
+    return value if len(value) == count else None
+
+def diffusion_gradient(ds):
+    """
+    Returns the b-value and gradient direction (in LPS+ patient coordinates)
+    of a diffusion image, or None if the image has no b-value. The direction
+    is zero for b=0 images.
+    """
+    bvalue = header_values(ds, DIFFUSION_BVALUE, 1) or \
+             header_values(ds, SIEMENS_BVALUE, 1)
+    if bvalue is None:
+        return None
+    direction = header_values(ds, DIFFUSION_DIRECTION, 3) or \
+                header_values(ds, SIEMENS_DIRECTION, 3)
+    if direction is None:
+        if bvalue[0] > 0:
+            raise ConversionError("No gradient direction for b={}".format(
+                bvalue[0]))
+        direction = [0, 0, 0]
+    return bvalue[0], np.array(direction)
+
+def series_gradients(volumes, affine):
+    """
+    Returns the b-values and gradient directions of a diffusion series, as
+    FSL expects them: the directions are in voxel coordinates, with x flipped
+    if the affine has a positive determinant. Returns None, None if the
+    series is not a diffusion series.
+    """
+    gradients = [diffusion_gradient(volume[0]) for volume in volumes]
+    if all(g is None for g in gradients):
+        return None, None
+    if any(g is None for g in gradients):
+        raise ConversionError("Only some volumes have diffusion headers")
+
+    # patient LPS+ to voxel axes
+    rotation = np.dot(np.diag([-1, -1, 1]), affine[:3, :3])
+    rotation = rotation / np.sqrt((rotation ** 2).sum(axis=0))
+    bvecs = np.array([np.dot(rotation.T, g) for _, g in gradients]).T
+    if np.linalg.det(affine[:3, :3]) > 0:
+        bvecs[0] = -bvecs[0]
+    bvals = np.array([b for b, _ in gradients])
+    return bvals, bvecs
+
+def write_rows(filename, rows):
+    with open(filename, 'w') as f:
+        for row in rows:
+            f.write(' '.join('{:g}'.format(round(v, 6) + 0) for v in row))
+            f.write('\n')
+
+def convert_series(seriesdir, outputstem, header=None):
+    """
+    Converts the dicoms in seriesdir to outputstem.nii.gz, and (for diffusion
+    series) outputstem.bvec and outputstem.bval.
+
+    If the header of one of the slices is given, it is checked first (see
+    check_header). Returns the list of files written, or raises a
+    ConversionError if the series is not supported.
+    """
+    if header is not None:
+        check_header(header)
+
+    volumes, cosines = sort_slices(read_series(seriesdir))
+    affine = series_affine(volumes[0], cosines)
+    data, (slope, intercept) = series_data(volumes)
+    bvals, bvecs = series_gradients(volumes, affine)
+
+    if data.shape[3] == 1:
+        data = data[:, :, :, 0]
+    image = nib.Nifti1Image(data, affine)
+    image.header.set_xyzt_units('mm', 'sec')
+    if slope is not None:
+        image.header.set_slope_inter(slope, intercept)
+    if data.ndim == 4:
+        tr = float(volumes[0][0].get('RepetitionTime') or 0) / 1000.0
+        image.header.set_zooms(image.header.get_zooms()[:3] + (tr,))
+    description = volumes[0][0].get('SeriesDescription') or ''
+    image.header['descrip'] = str(description)[:79]
+
+    outputs = [(outputstem + '.nii.gz', lambda f: nib.save(image, f))]
+    if bvals is not None:
+        outputs.append((outputstem + '.bvec', lambda f: write_rows(f, bvecs)))
+        outputs.append((outputstem + '.bval', lambda f: write_rows(f, [bvals])))
+
+    # each output is written alongside and renamed into place, so that an
+    # interrupted conversion doesn't leave an output that looks complete
+    written = []
+    for filename, write in outputs:
+        base, ext = filename, ''
+        if filename.endswith('.nii.gz'):
+            base, ext = filename[:-len('.nii.gz')], '.nii.gz'
+        tmpfile = base + '.part' + ext   # nibabel goes by the extension
+        write(tmpfile)
+        os.rename(tmpfile, filename)
+        written.append(filename)
+    return written
+
+# vim: ts=4 sw=4:
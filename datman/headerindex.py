@@ -0,0 +1,172 @@
+"""
+A persistent, on-disk index of the DICOM headers found in exam archives.
+
+Reading headers out of an exam archive (see datman.utils.get_archive_headers)
+means opening the tarball/zip/folder and parsing a dicom from every series.
+Several of our scripts do this over the same archives every night, so this
+module keeps the manifest (series path -> headers) for each archive in a
+sqlite database keyed by the archive path, and reuses it for as long as the
+archive itself is unchanged.
+
+An archive is considered unchanged when its signature (modification time and
+size) matches the one recorded with the manifest. For a file the signature is
+taken from os.stat(). For a folder it is the newest modification time of any
+folder within it and the total number of files, since adding or removing a
+series or dicom changes the mtime of the folder that holds it.
+
+The manifest of a folder maps the paths of its series folders to headers, and
+those paths are spelled the way the caller spelled the archive's path. The
+index stores them relative to the archive, and joins them back onto the path
+given to lookup(), so that an archive indexed through a relative path or a
+symlink can be looked up from anywhere.
+
+Usage:
+
+    import datman as dm
+
+    index = dm.headerindex.HeaderIndex('/archive/headers.db')
+    manifest = dm.utils.get_archive_headers(archivepath, index=index)
+"""
+import os
+import copy
+import sqlite3
+import cPickle as pickle
+
+# (7fe0,0010) -- we never want to keep pixel data around in the index
+PIXEL_DATA_TAG = 0x7fe00010
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    path      TEXT PRIMARY KEY,
+    mtime     REAL,
+    size      INTEGER,
+    complete  INTEGER,
+    manifest  BLOB
+)
+"""
+
+def archive_signature(path):
+    """
+    Returns a (mtime, size) tuple that changes whenever the archive does.
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+
+    mtime = os.stat(path).st_mtime
+    size  = 0
+    for dirname, dirnames, filenames in os.walk(path):
+        mtime = max(mtime, os.stat(dirname).st_mtime)
+        size += len(filenames)
+    return mtime, size
+
+def join_series(path, series):
+    """
+    Returns the path of a series folder stored relative to the archive at
+    path.
+    """
+    if series == os.curdir:
+        return path
+    return os.path.join(path, series)
+
+class HeaderIndex:
+    """
+    A sqlite-backed cache of archive manifests.
+
+    Manifests are stored as they are returned by get_archive_headers(), minus
+    any pixel data. A manifest gathered with stop_after_first=True is marked
+    as incomplete, and is only used to answer later stop_after_first lookups.
+    """
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def lookup(self, path, stop_after_first=False):
+        """
+        Returns the stored manifest for the archive at path, or None if the
+        archive is not in the index or has changed since it was indexed.
+        """
+        key = os.path.realpath(path)
+        row = self.db.execute(
+            'SELECT mtime, size, complete, manifest FROM headers '
+            'WHERE path = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        mtime, size, complete, manifest = row
+        if (mtime, size) != archive_signature(key):
+            return None
+        if not (complete or stop_after_first):
+            return None
+
+        manifest = pickle.loads(str(manifest))
+        if os.path.isdir(key):
+            manifest = dict((join_series(path, series), headers)
+                            for series, headers in manifest.items())
+        if stop_after_first and len(manifest) > 1:
+            first = sorted(manifest.keys())[0]
+            manifest = {first: manifest[first]}
+        return manifest
+
+    def store(self, path, manifest, stop_after_first=False, signature=None):
+        """
+        Records the manifest for the archive at path.
+
+        signature is the archive_signature() of the archive taken before the
+        manifest was read from it, so that a manifest read from an archive
+        that changed meanwhile (e.g. while it was being uploaded) is not
+        served as current. If it is not given, it is taken now.
+
+        An incomplete manifest (stop_after_first=True) never replaces a
+        complete one for the same version of the archive. The caller's
+        datasets are left as they are.
+        """
+        key = os.path.realpath(path)
+        mtime, size = signature or archive_signature(key)
+
+        if stop_after_first and self.lookup(key) is not None:
+            return
+
+        stored = {}
+        for series, dataset in manifest.items():
+            if PIXEL_DATA_TAG in dataset:
+                dataset = copy.copy(dataset)
+                del dataset[PIXEL_DATA_TAG]
+            if os.path.isdir(key):
+                series = os.path.relpath(series, path)
+            stored[series] = dataset
+        manifest = stored
+
+        blob = sqlite3.Binary(pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+        self.db.execute(
+            'INSERT OR REPLACE INTO headers '
+            '(path, mtime, size, complete, manifest) VALUES (?, ?, ?, ?, ?)',
+            (key, mtime, size, int(not stop_after_first), blob))
+        self.db.commit()
+
+    def forget(self, path):
+        """
+        Removes the archive at path from the index.
+        """
+        self.db.execute('DELETE FROM headers WHERE path = ?',
+                        (os.path.realpath(path),))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def open_index(filename):
+    """
+    Convenience method that returns a HeaderIndex, or None if no filename is
+    given (so that scripts can pass their --header-index option straight
+    through).
+    """
+    if not filename:
+        return None
+    return HeaderIndex(filename)
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,366 @@
+"""
+Runs external programs (AFNI, FSL, dcm2nii, matlab, ...) and keeps a record of
+what each run cost.
+
+Every command run through run() has its wall time, CPU time (user and
+system), peak resident memory, exit status and arguments measured. The
+resource usage is that reported by the kernel for the command's process when
+it is reaped (see wait4(2)), so for a command run through the shell it covers
+the shell and everything it ran.
+
+The kernel counts the memory a process used before it exec'd a program
+towards its peak. A program forked straight from a python process that has
+loaded numpy, matplotlib and so on would be charged for all of that. Commands
+are therefore started by a small launcher (a bare python interpreter), which
+forks and execs the command and reports its resource usage back on a pipe.
+
+If the DM_RUNLOG environment variable names a file (or a RunLog is given),
+each run is recorded in a sqlite database there, along with the host, queue
+job and folder it ran in. The log can be summarized by program, to find which
+of the tools run for each exam are slowest or most memory-hungry (see
+RunLog.summary(), or the dm-runlog.py script). A run that cannot be recorded
+(e.g. because the log is locked for too long) is logged as a warning and
+otherwise ignored.
+
+Usage:
+
+    import datman as dm
+
+    result = dm.runner.run('3dvolreg -prefix mcorr.nii.gz ... func.nii.gz')
+    if result.returncode != 0:
+        print result.err
+
+    runlog = dm.runner.RunLog('/archive/logs/runlog.db')
+    for row in runlog.summary():
+        print row.program, row.runs, row.wall, row.maxrss
+"""
+import os
+import sys
+import json
+import fcntl
+import time
+import errno
+import shlex
+import socket
+import sqlite3
+import logging
+import threading
+import collections
+import subprocess as proc
+import datman.scratch
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id          INTEGER PRIMARY KEY,
+    started     REAL,
+    host        TEXT,
+    job         TEXT,
+    pid         INTEGER,
+    cwd         TEXT,
+    program     TEXT,
+    argv        TEXT,
+    returncode  INTEGER,
+    wall        REAL,
+    user        REAL,
+    sys         REAL,
+    maxrss      INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_program ON runs (program, started);
+"""
+
+# runs argv[2:], and writes its [wall, user, sys, maxrss] as JSON to the fd in
+# argv[1]. It exits as the command did, and passes the terminal's interrupts
+# on to it.
+LAUNCHER = r"""
+import os, sys, json, time, signal
+report, argv = int(sys.argv[1]), sys.argv[2:]
+started = time.time()
+pid = os.fork()
+if pid == 0:
+    os.close(report)
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    try:
+        os.execvp(argv[0], argv)
+    except OSError, e:
+        sys.stderr.write('%s: %s\n' % (argv[0], e.strerror))
+        os._exit(127)
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+while True:
+    try:
+        _, status, usage = os.wait4(pid, 0)
+        break
+    except OSError:
+        continue
+os.write(report, json.dumps([time.time() - started, usage.ru_utime,
+                             usage.ru_stime, usage.ru_maxrss]))
+os.close(report)
+if os.WIFSIGNALED(status):
+    try:
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+    except (RuntimeError, ValueError):
+        pass  # SIGKILL and SIGSTOP can't be handled anyway
+    os.kill(os.getpid(), os.WTERMSIG(status))
+    os._exit(128 + os.WTERMSIG(status))
+os._exit(os.WEXITSTATUS(status))
+"""
+
+# wall, user and sys are in seconds, maxrss in kilobytes
+Result = collections.namedtuple('Result', ['argv', 'returncode', 'out', 'err',
+        'started', 'wall', 'user', 'sys', 'maxrss'])
+
+Run = collections.namedtuple('Run', ['started', 'host', 'job', 'pid', 'cwd',
+        'program', 'argv', 'returncode', 'wall', 'user', 'sys', 'maxrss'])
+
+Summary = collections.namedtuple('Summary', ['program', 'runs', 'failures',
+        'wall', 'max_wall', 'cpu', 'maxrss'])
+
+def command_argv(cmd):
+    """
+    Returns the arguments of a command, given as a list or as a shell command
+    line. Shell syntax (pipes, redirections, ...) is left in as words.
+    """
+    if not isinstance(cmd, basestring):
+        return [str(arg) for arg in cmd]
+    try:
+        return shlex.split(cmd)
+    except ValueError:
+        return cmd.split()
+
+def program_name(argv):
+    """
+    Returns the name of the program a command runs, skipping any leading
+    environment settings (e.g. OMP_NUM_THREADS=1 3dvolreg ...).
+    """
+    for arg in argv:
+        if '=' in arg and not arg.startswith(('/', '.')):
+            continue
+        return os.path.basename(arg)
+    return ''
+
+def read_output(p):
+    """
+    Reads a process' stdout and stderr to the end, from both at once so that
+    neither pipe fills up.
+    """
+    chunks = {}
+    def drain(name, stream):
+        chunks[name] = stream.read()
+        stream.close()
+
+    reader = threading.Thread(target=drain, args=('err', p.stderr))
+    reader.start()
+    drain('out', p.stdout)
+    reader.join()
+    return chunks['out'], chunks['err']
+
+def launcher_argv(cmd, shell, report):
+    """
+    Returns the arguments that run cmd (as Popen would) through the launcher,
+    reporting to the fd report.
+    """
+    if isinstance(cmd, basestring):
+        cmd = [cmd]
+    argv = ['/bin/sh', '-c'] + list(cmd) if shell else list(cmd)
+    return [sys.executable, '-S', '-E', '-c', LAUNCHER, str(report)] + argv
+
+def wait(p):
+    """
+    Reaps a process, and returns its exit status and resource usage.
+    """
+    while True:
+        try:
+            _, status, usage = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return p.returncode, usage
+
+def read_report(fd):
+    """
+    Returns the resource usage the launcher wrote to fd, as (wall, user, sys,
+    maxrss), or None if it wrote none.
+
+    Only to be called once the launcher has exited. The write end of the pipe
+    may still be open in children that other threads started meanwhile (and
+    that inherited it), so the read does not wait for the end of the pipe.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    try:
+        measured = os.read(fd, 1024)
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+        return None
+    try:
+        wall, user, system, maxrss = json.loads(measured)
+    except (ValueError, TypeError):
+        logger.warning("Cannot read the launcher's report {!r}".format(
+            measured))
+        return None
+    return wall, user, system, maxrss
+
+def run(cmd, capture=True, shell=None, cwd=None, env=None, runlog=None):
+    """
+    Runs a command, and returns a Result.
+
+    <cmd> is a command line, which is run by the shell, or a list of
+    arguments, which is not (unless shell=True). If capture is True the
+    output of the command is returned in the Result, otherwise it goes to
+    ours. The run is recorded in runlog, or the log named by DM_RUNLOG if
+    runlog is None.
+    """
+    if shell is None:
+        shell = isinstance(cmd, basestring)
+    pipe = proc.PIPE if capture else None
+
+    started = time.time()
+    report, report_w = os.pipe()
+    fcntl.fcntl(report, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    try:
+        p = proc.Popen(launcher_argv(cmd, shell, report_w), stdout=pipe,
+                       stderr=pipe, cwd=cwd, env=env, close_fds=False)
+    finally:
+        os.close(report_w)
+    try:
+        out, err = read_output(p) if capture else ('', '')
+        returncode, usage = wait(p)
+        measured = read_report(report)
+    finally:
+        os.close(report)
+
+    if measured:
+        wall, user, system, maxrss = measured
+    else:
+        # the launcher died before the command did
+        wall, user, system, maxrss = (time.time() - started, usage.ru_utime,
+                                      usage.ru_stime, usage.ru_maxrss)
+
+    result = Result(command_argv(cmd), returncode, out, err, started,
+                    wall, user, system, int(maxrss))
+
+    runlog = runlog or default_runlog()
+    if runlog is not None:
+        runlog.record(result, cwd=cwd)
+    return result
+
+class RunLog:
+    """
+    A sqlite database of the commands that have been run.
+
+    A connection is made for each run recorded, so that one RunLog can be
+    used from several threads or forked processes.
+    """
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.timeout = timeout
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=self.timeout)
+        db.text_factory = str
+        return db
+
+    def record(self, result, cwd=None):
+        """
+        Records a Result.
+        """
+        row = (result.started, socket.gethostname(),
+               datman.scratch.queue_job_id(), os.getpid(),
+               os.path.abspath(cwd or os.getcwd()),
+               program_name(result.argv), json.dumps(result.argv),
+               result.returncode, result.wall, result.user, result.sys,
+               result.maxrss)
+        try:
+            db = self.connect()
+            try:
+                db.execute('INSERT INTO runs (started, host, job, pid, cwd, '
+                           'program, argv, returncode, wall, user, sys, '
+                           'maxrss) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           row)
+                db.commit()
+            finally:
+                db.close()
+        except sqlite3.Error, e:
+            logger.warning("Cannot record {} in {}: {}".format(
+                program_name(result.argv), self.filename, e))
+
+    def runs(self, program=None, since=None, failed=False):
+        """
+        Returns the recorded Runs (oldest first), of a program, or started
+        since a time (in seconds since the epoch), or that failed.
+        """
+        where, params = self._where(program, since)
+        if failed:
+            where.append('returncode != 0')
+        query = ('SELECT started, host, job, pid, cwd, program, argv, '
+                 'returncode, wall, user, sys, maxrss FROM runs')
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        db = self.connect()
+        try:
+            rows = db.execute(query + ' ORDER BY started', params).fetchall()
+        finally:
+            db.close()
+        return [Run(*(row[:6] + (json.loads(row[6]),) + row[7:]))
+                for row in rows]
+
+    def summary(self, program=None, since=None):
+        """
+        Returns a Summary of the runs of each program: the number of runs and
+        failures, total and longest wall time, total CPU time and the largest
+        peak memory use, sorted by total wall time (largest first).
+        """
+        where, params = self._where(program, since)
+        query = ('SELECT program, COUNT(*), SUM(returncode != 0), SUM(wall), '
+                 'MAX(wall), SUM(user + sys), MAX(maxrss) FROM runs')
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        db = self.connect()
+        try:
+            rows = db.execute(query + ' GROUP BY program ORDER BY SUM(wall) '
+                              'DESC', params).fetchall()
+        finally:
+            db.close()
+        return [Summary(*row) for row in rows]
+
+    def _where(self, program, since):
+        where, params = [], []
+        if program is not None:
+            where.append('program = ?')
+            params.append(program)
+        if since is not None:
+            where.append('started >= ?')
+            params.append(since)
+        return where, params
+
+_runlogs = {}
+
+def default_runlog():
+    """
+    Returns the RunLog named by the DM_RUNLOG environment variable, or None.
+    """
+    filename = os.environ.get('DM_RUNLOG')
+    if not filename:
+        return None
+    if filename not in _runlogs:
+        try:
+            _runlogs[filename] = RunLog(filename)
+        except sqlite3.Error, e:
+            logger.warning("Cannot open run log {}: {}".format(filename, e))
+            return None
+    return _runlogs[filename]
+
+# vim: ts=4 sw=4:
@@ -1,6 +1,12 @@
 """
 Represents scan identifiers that conform to the TIGRLab naming scheme
+
+Parsing is memoized: parse() and parse_filename() keep the results for the
+most recently seen identifiers and filenames (see CACHE_SIZE), and return
+the same Identifier object for the same string. Identifiers are therefore
+immutable.
 """
+import collections
 import os.path
 import re
 
@@ -35,64 +41,145 @@ FILENAME_PHA_PATTERN = re.compile('^'+FILENAME_PHA_RE+'$')
 class ParseException(Exception):
     pass
 
-class Identifier:
+# number of identifiers and filenames to remember the parse of
+CACHE_SIZE = 100000
+
+class Identifier(object):
+    """
+    An immutable scan identifier. The subject id strings are worked out once,
+    when the identifier is made.
+    """
+    __slots__ = ('study', 'site', 'subject', 'timepoint', 'session',
+                 '_subjectid', '_subjectid_with_timepoint', '_str')
+
     def __init__(self, study, site, subject, timepoint, session):
-        self.study = study
-        self.site = site
-        self.subject = subject
-        self.timepoint = timepoint
-        self.session = session
+        subjectid = "_".join([study, site, subject])
+        if timepoint:
+            subjectid_with_timepoint = subjectid + "_" + timepoint
+            string = "_".join([subjectid_with_timepoint, session])
+        else:  # it's a phantom, so no timepoints
+            subjectid_with_timepoint = string = subjectid
+
+        for name, value in [('study', study), ('site', site),
+                            ('subject', subject), ('timepoint', timepoint),
+                            ('session', session), ('_subjectid', subjectid),
+                            ('_subjectid_with_timepoint',
+                                subjectid_with_timepoint),
+                            ('_str', string)]:
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Identifier objects are immutable")
+
+    def __reduce__(self):
+        return (Identifier, (self.study, self.site, self.subject,
+                             self.timepoint, self.session))
 
     def get_full_subjectid(self):
-        return "_".join([self.study, self.site, self.subject])
+        return self._subjectid
 
     def get_full_subjectid_with_timepoint(self):
-        ident = self.get_full_subjectid()
-        if self.timepoint:
-            ident += "_"+self.timepoint
-        return ident 
+        return self._subjectid_with_timepoint
 
     def __str__(self):
-        if self.timepoint:
-            return "_".join([self.study, 
-                             self.site, 
-                             self.subject, 
-                             self.timepoint,
-                             self.session])
-        else:  # it's a phantom, so no timepoints
-            return self.get_full_subjectid() 
-                  
+        return self._str
+
+    def __eq__(self, other):
+        return isinstance(other, Identifier) and self._str == other._str
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._str)
+
+class LRUCache:
+    """
+    A dict that only keeps the most recently used maxsize entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+_identifiers = LRUCache(CACHE_SIZE)
+_filenames = LRUCache(CACHE_SIZE)
+
+# stored in the caches for strings that don't parse
+_INVALID = object()
+
+def _identifier(match):
+    """
+    Returns the (shared) Identifier for a scan id or filename match.
+    """
+    key = match.group("study", "site", "subject", "timepoint", "session")
+    ident = _identifiers.get(key)
+    if ident is None:
+        ident = Identifier(*key)
+        _identifiers.put(key, ident)
+    return ident
+
 def parse(identifier):
     if type(identifier) is not str: raise ParseException()
 
-    match = SCANID_PATTERN.match(identifier)
-    if not match: match = SCANID_PHA_PATTERN.match(identifier)
-    if not match: raise ParseException()
-
-    ident = Identifier(study    = match.group("study"), 
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
+    ident = _identifiers.get(identifier)
+    if ident is None:
+        match = SCANID_PATTERN.match(identifier)
+        if not match: match = SCANID_PHA_PATTERN.match(identifier)
+        ident = match and _identifier(match) or _INVALID
+        _identifiers.put(identifier, ident)
 
+    if ident is _INVALID: raise ParseException()
     return ident
 
 def parse_filename(path):
     fname = os.path.basename(path)
-    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
-    if not match: match = FILENAME_PATTERN.match(fname)
-    if not match: raise ParseException()
-
-    ident = Identifier(study    = match.group("study"), 
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
-
-    tag = match.group("tag")
-    series = match.group("series")
-    description = match.group("description")
-    return ident, tag, series, description
+
+    parsed = _filenames.get(fname)
+    if parsed is None:
+        match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
+        if not match: match = FILENAME_PATTERN.match(fname)
+        if match:
+            parsed = (_identifier(match), match.group("tag"),
+                      match.group("series"), match.group("description"))
+        else:
+            parsed = _INVALID
+        _filenames.put(fname, parsed)
+
+    if parsed is _INVALID: raise ParseException()
+    return parsed
+
+def parse_many(paths):
+    """
+    Parses a list of filenames, as parse_filename() does.
+
+    Returns a list with the (ident, tag, series, description) for each path,
+    or None in place of the paths that do not follow the naming scheme.
+    """
+    parsed = []
+    for path in paths:
+        try:
+            parsed.append(parse_filename(path))
+        except ParseException:
+            parsed.append(None)
+    return parsed
 
 def make_filename(ident, tag, series, description, ext = None):
     filename = "_".join([str(ident), tag, series, description])
@@ -0,0 +1,562 @@
+"""
+Submits jobs to a queue (or to the local machine) on behalf of the pipeline
+scripts.
+
+The dm-proc-* scripts all need to do the same few things: send a list of
+commands off to run, optionally as an array job or in chunks, and then send a
+final job that waits for those to finish. This module does that through one
+interface, with one backend per kind of queue:
+
+    local    runs jobs on this machine, in a pool of worker processes
+    qbatch   submits through qbatch (the default)
+    sge      submits straight to Sun Grid Engine with qsub
+    pbs      submits straight to PBS/Torque with qsub
+
+The backend is chosen by name, or by the DM_SCHEDULER environment variable
+when no name is given. Setting DM_SCHEDULER=local runs a whole pipeline on a
+workstation with no queue at all.
+
+Usage:
+
+    import datman as dm
+
+    sched = dm.scheduler.get_scheduler(dryrun=DRYRUN)
+    jobs = [sched.submit([cmd], name=prefix + subject, logdir=logdir,
+                         walltime='2:00:00') for subject, cmd in ...]
+    sched.submit([final_cmd], name=prefix + 'post', logdir=logdir,
+                 afterok=[prefix + '*'])
+    sched.wait(jobs)
+
+Dependencies (afterok) are given as job ids returned by submit(), or as job
+name patterns (as qbatch --afterok and SGE -hold_jid take them). Backends that
+can only hold on ids resolve patterns against the jobs they have submitted.
+
+A job with several commands is an array job with one task per chunk of
+chunksize commands, unless individual=True, in which case each chunk is sent
+as a job of its own. The commands in a chunk run one after the other, and the
+chunk fails if any of them fails.
+
+PACKING
+
+Scheduler overhead and queue waits dominate for commands that only run for
+a minute or so. A job submitted with packed=True keeps the output of each
+command in its own log, <logdir>/<name>.<n>.log, and records its exit status
+and runtime in seconds in <logdir>/<name>.<n>.status. packed_chunksize()
+then uses the runtimes recorded by earlier jobs to work out how many
+commands fit in each task:
+
+    chunksize = dm.scheduler.packed_chunksize(logdir, 'dm_dtifit_', walltime)
+    sched.submit(commands, 'dm_dtifit_' + timestamp, logdir=logdir,
+                 walltime=walltime, chunksize=chunksize, packed=True)
+"""
+import os
+import re
+import fnmatch
+import glob
+import logging
+import multiprocessing
+import multiprocessing.pool
+import pipes
+import subprocess as proc
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = 'active'
+DONE = 'done'
+FAILED = 'failed'
+
+def chunk(commands, chunksize=1):
+    """
+    Splits a list of commands into a list of chunks of chunksize commands.
+    """
+    chunksize = max(int(chunksize), 1)
+    return [commands[i:i+chunksize] for i in range(0, len(commands), chunksize)]
+
+class Scheduler:
+    """
+    Base class for the scheduler backends.
+
+    Subclasses implement _submit(), which does the actual submission and
+    returns a job id, and status().
+    """
+
+    def __init__(self, dryrun=False):
+        self.dryrun = dryrun
+        self.jobs = {}     # job name -> job id, for everything we've submitted
+
+    def submit(self, commands, name, logdir=None, walltime=None, afterok=None,
+               chunksize=1, individual=False, packed=False):
+        """
+        Submits a job running the given commands, and returns its job id.
+
+        name        the job name
+        logdir      folder for the job's output logs
+        walltime    walltime for the job (or each task of it), as H:MM:SS
+        afterok     list of job ids or name patterns that must complete
+                    successfully before this job starts
+        chunksize   number of commands run by each task of the job
+        individual  submit each chunk as a job of its own, rather than as an
+                    array job
+        packed      keep a separate log and status file for each command
+                    (see PACKING above)
+        """
+        if isinstance(commands, basestring):
+            commands = [commands]
+        afterok = afterok or []
+        if logdir and not os.path.isdir(logdir) and not self.dryrun:
+            os.makedirs(logdir)
+        if packed:
+            commands = [packed_command(c, logdir, name, n)
+                        for n, c in enumerate(commands, 1)]
+
+        chunks = chunk(list(commands), chunksize)
+        if individual and len(chunks) > 1:
+            return self.submit_individual(chunks, name, logdir, walltime,
+                                          afterok)
+
+        logger.debug("Submitting job {} ({} commands in {} tasks)".format(
+                name, len(commands), len(chunks)))
+        if self.dryrun:
+            for c in chunks:
+                logger.info("{}: {}".format(name, '; '.join(c)))
+            jobid = name
+        else:
+            jobid = self._submit(chunks, name, logdir, walltime, afterok)
+        self.jobs[name] = jobid
+        return jobid
+
+    def submit_individual(self, chunks, name, logdir, walltime, afterok):
+        """
+        Submits each chunk as a job named <name>-<n>, and returns a pattern
+        matching all of them.
+        """
+        for i, c in enumerate(chunks, 1):
+            self.submit(c, '{}-{}'.format(name, i), logdir, walltime, afterok,
+                        chunksize=len(c))
+        return name + '-*'
+
+    def resolve(self, afterok):
+        """
+        Returns the ids of the jobs we have submitted that match the given
+        ids or name patterns.
+        """
+        ids = []
+        for dep in afterok:
+            matches = [self.jobs[n] for n in sorted(self.jobs)
+                       if fnmatch.fnmatchcase(n, dep)]
+            if not matches and dep in self.jobs.values():
+                matches = [dep]
+            if not matches:
+                logger.warning("No submitted job matches {}".format(dep))
+            ids.extend(matches)
+        return ids
+
+    def status(self, jobid):
+        """
+        Returns ACTIVE, DONE or FAILED for the given job.
+        """
+        raise NotImplementedError
+
+    def wait(self, jobids, interval=30):
+        """
+        Polls until none of the given jobs (ids or name patterns) are active.
+
+        Returns True if they all completed, and False if any of them failed
+        (as far as the backend can tell).
+        """
+        if isinstance(jobids, basestring):
+            jobids = [jobids]
+        if self.dryrun:
+            return True
+        while True:
+            states = [self.status(j) for j in jobids]
+            if ACTIVE not in states:
+                return FAILED not in states
+            time.sleep(interval)
+
+def packed_command(command, logdir, name, n):
+    """
+    Wraps a command so that its output goes to <logdir>/<name>.<n>.log, and
+    its exit status and runtime (in seconds) to <logdir>/<name>.<n>.status.
+    The wrapped command exits with the status of the original.
+    """
+    stem = os.path.join(os.path.abspath(logdir or os.getcwd()),
+                        '{}.{}'.format(name, n))
+    return ('start=$(date +%s); ( {cmd} ) > {log} 2>&1; rtn=$?; '
+            'echo $rtn $(( $(date +%s) - start )) > {status}; '
+            '[ $rtn -eq 0 ]').format(cmd = command,
+                                    log = pipes.quote(stem + '.log'),
+                                    status = pipes.quote(stem + '.status'))
+
+def read_status(filename):
+    """
+    Returns the (exit status, runtime) recorded for a packed command, or None
+    if it has not finished.
+    """
+    try:
+        with open(filename) as f:
+            rtn, runtime = f.read().split()
+        return int(rtn), int(runtime)
+    except (IOError, ValueError):
+        return None
+
+def walltime_seconds(walltime):
+    """
+    Converts a walltime given as [[H:]M:]S to seconds.
+    """
+    seconds = 0
+    for part in str(walltime).split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+def packed_chunksize(logdir, prefix, walltime, fill=0.5, maximum=50,
+                     history=500):
+    """
+    Returns how many packed commands to run in each task of a job, so that a
+    task is expected to take up about fill of the walltime.
+
+    The runtime of a command is estimated as the 90th percentile runtime of
+    the most recent (up to history) packed commands recorded in logdir by
+    jobs whose names start with prefix. With no history to go on, commands
+    are not packed (1 is returned).
+    """
+    statuses = glob.glob(os.path.join(logdir, prefix + '*.status'))
+    statuses = sorted(statuses, key=os.path.getmtime)[-history:]
+    runtimes = sorted(s[1] for s in map(read_status, statuses) if s)
+    if not runtimes:
+        return 1
+
+    runtime = max(runtimes[int(0.9 * (len(runtimes) - 1))], 1)
+    chunksize = int(walltime_seconds(walltime) * fill / runtime)
+    return min(max(chunksize, 1), maximum)
+
+class LocalScheduler(Scheduler):
+    """
+    Runs jobs on this machine.
+
+    The tasks of all jobs share one pool of <processes> threads, each running
+    its chunk of commands in a shell. submit() queues a job and returns its
+    id straight away: the job starts once the jobs it depends on (which are
+    always submitted first) have finished, and is not run if any of them
+    failed. Only wait() blocks. Each task's output is written to
+    <logdir>/<name>.o<task>.
+
+    Jobs still running when the script ends are waited for before it exits.
+    """
+
+    def __init__(self, processes=None, dryrun=False):
+        Scheduler.__init__(self, dryrun)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+        self.states = {}
+        self.finished = {}   # job id -> threading.Event, set when it ends
+        self.lock = threading.Lock()
+
+    def _submit(self, chunks, name, logdir, walltime, afterok):
+        with self.lock:
+            jobid = '{}.{}'.format(name, len(self.states) + 1)
+            self.states[jobid] = ACTIVE
+            self.finished[jobid] = threading.Event()
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(self.processes)
+
+        tasks = [(c, log_filename(logdir, name, i))
+                 for i, c in enumerate(chunks, 1)]
+        # not a daemon, so that the interpreter waits for the job at exit
+        thread = threading.Thread(target=self.run_job, args=(jobid, name,
+                tasks, logdir, self.resolve(afterok)))
+        thread.start()
+        return jobid
+
+    def run_job(self, jobid, name, tasks, logdir, afterok):
+        """
+        Waits for the jobs in afterok, then runs the tasks of a job in the
+        pool and records whether it succeeded.
+        """
+        ok = False
+        try:
+            for dep in afterok:
+                wait_for(self.finished[dep])
+            failed = [d for d in afterok if self.states[d] != DONE]
+            if failed:
+                logger.error("Not running {}, dependencies failed: "
+                             "{}".format(name, ', '.join(failed)))
+                return
+            returncodes = self.pool.map(run_task, tasks)
+            ok = all(rtn == 0 for rtn in returncodes)
+            if not ok:
+                logger.error("Job {} failed, see logs in {}".format(
+                        name, logdir or os.getcwd()))
+        except Exception, e:
+            logger.error("Job {} failed: {}".format(name, e))
+        finally:
+            self.states[jobid] = ok and DONE or FAILED
+            self.finished[jobid].set()
+
+    def status(self, jobid):
+        ids = self.resolve([jobid]) if jobid not in self.states else [jobid]
+        states = [self.states.get(i, DONE) for i in ids]
+        if ACTIVE in states:
+            return ACTIVE
+        return FAILED in states and FAILED or DONE
+
+    def wait(self, jobids, interval=None):
+        if isinstance(jobids, basestring):
+            jobids = [jobids]
+        if self.dryrun:
+            return True
+        ids = []
+        for jobid in jobids:
+            ids.extend(self.resolve([jobid]) if jobid not in self.states
+                       else [jobid])
+        for jobid in ids:
+            wait_for(self.finished[jobid])
+        return all(self.states[jobid] == DONE for jobid in ids)
+
+def wait_for(event):
+    # waiting with a timeout, since an untimed wait can't be interrupted
+    while not event.wait(1):
+        pass
+
+def log_filename(logdir, name, task):
+    return os.path.join(logdir or os.getcwd(), '{}.o{}'.format(name, task))
+
+def run_task(task):
+    """
+    Runs a chunk of commands one after the other in a shell, with their
+    output going to a log file. Returns the exit status of the chunk, which
+    is non-zero if any of the commands failed.
+    """
+    commands, logfile = task
+    rtn = 0
+    with open(logfile, 'a') as log:
+        for cmd in commands:
+            log.write('+ {}\n'.format(cmd))
+            log.flush()
+            rtn = proc.call(cmd, shell=True, stdout=log, stderr=proc.STDOUT) or rtn
+    return rtn
+
+class QsubScheduler(Scheduler):
+    """
+    Base class for the backends that submit a generated job script with qsub.
+
+    The job script runs the chunk for its array task (or the only chunk) with
+    bash. Job scripts are written to .dmjobs/ under the current folder, as
+    qbatch does with .qbatch/.
+    """
+
+    TASK_ID = None
+
+    def script(self, chunks):
+        """
+        Returns the job script for the given chunks. As with run_task(), each
+        command runs in a shell of its own, and the script exits non-zero if
+        any of the commands in its chunk failed, so that afterok holds.
+        """
+        lines = ['#!/bin/bash', 'cd "{}"'.format(os.getcwd()), 'rtn=0']
+        if len(chunks) == 1:
+            lines.extend(checked(chunks[0]))
+        else:
+            lines.append('case ${{{}}} in'.format(self.TASK_ID))
+            for i, c in enumerate(chunks, 1):
+                lines.append('{})'.format(i))
+                lines.extend(checked(c, '    '))
+                lines.append('    ;;')
+            lines.append('esac')
+        lines.append('exit $rtn')
+        return '\n'.join(lines) + '\n'
+
+    def _submit(self, chunks, name, logdir, walltime, afterok):
+        jobdir = os.path.join(os.getcwd(), '.dmjobs')
+        if not os.path.isdir(jobdir):
+            os.makedirs(jobdir)
+        scriptfile = os.path.join(jobdir, '{}.sh'.format(name))
+        with open(scriptfile, 'w') as f:
+            f.write(self.script(chunks))
+
+        cmd = ['qsub'] + self.options(len(chunks), name, logdir, walltime,
+                                      afterok) + [scriptfile]
+        p = proc.Popen(cmd, stdout=proc.PIPE, stderr=proc.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise SchedulerException("Submitting {} failed: {}".format(
+                    name, err.strip()))
+        return self.parse_jobid(out)
+
+def checked(commands, indent=''):
+    """
+    Returns script lines running each command in a subshell, and setting rtn
+    to 1 if it fails.
+    """
+    return ['{}( {} ) || rtn=1'.format(indent, cmd) for cmd in commands]
+
+class SGEScheduler(QsubScheduler):
+    """
+    Submits jobs to Sun Grid Engine. Dependencies are passed to -hold_jid as
+    given, since it accepts both ids and name patterns.
+    """
+
+    TASK_ID = 'SGE_TASK_ID'
+
+    def options(self, ntasks, name, logdir, walltime, afterok):
+        opts = ['-terse', '-V', '-S', '/bin/bash', '-j', 'y', '-N', name]
+        if logdir:
+            opts += ['-o', logdir]
+        if walltime:
+            opts += ['-l', 'h_rt={}'.format(walltime)]
+        if ntasks > 1:
+            opts += ['-t', '1-{}'.format(ntasks)]
+        if afterok:
+            opts += ['-hold_jid', ','.join(afterok)]
+        return opts
+
+    def parse_jobid(self, out):
+        # -terse prints "<id>" or "<id>.<first>-<last>:<step>" for arrays
+        return out.strip().split('.')[0]
+
+    def status(self, jobid):
+        return sge_status(jobid)
+
+def sge_status(jobid):
+    """
+    Returns ACTIVE if SGE knows of the job (by id or name), else DONE.
+    """
+    with open(os.devnull, 'w') as devnull:
+        rtn = proc.call(['qstat', '-j', jobid], stdout=devnull,
+                        stderr=proc.STDOUT)
+    return rtn == 0 and ACTIVE or DONE
+
+class PBSScheduler(QsubScheduler):
+    """
+    Submits jobs to PBS/Torque. Name patterns in dependencies are resolved
+    against the jobs submitted by this scheduler.
+    """
+
+    TASK_ID = 'PBS_ARRAYID'
+
+    def options(self, ntasks, name, logdir, walltime, afterok):
+        opts = ['-V', '-j', 'oe', '-N', name]
+        if logdir:
+            opts += ['-o', logdir]
+        if walltime:
+            opts += ['-l', 'walltime={}'.format(walltime)]
+        if ntasks > 1:
+            opts += ['-t', '1-{}'.format(ntasks)]
+        depends = []
+        for jobid in self.resolve(afterok):
+            kind = '[]' in jobid and 'afterokarray' or 'afterok'
+            depends.append('{}:{}'.format(kind, jobid))
+        if depends:
+            opts += ['-W', 'depend=' + ','.join(depends)]
+        return opts
+
+    def parse_jobid(self, out):
+        return out.strip()
+
+    def status(self, jobid):
+        ids = self.resolve([jobid]) or [jobid]
+        states = qstat_states()
+        active = any(states.get(i, 'C') != 'C' for i in ids)
+        return active and ACTIVE or DONE
+
+def qstat_states():
+    """
+    Returns a dict of job id -> state letter (Q, R, C, ...) from a PBS
+    qstat -f listing, with job names mapped as well as ids.
+    """
+    p = proc.Popen(['qstat', '-f'], stdout=proc.PIPE, stderr=proc.PIPE)
+    out, _ = p.communicate()
+
+    states = {}
+    jobid = name = None
+    for line in out.splitlines():
+        if line.startswith('Job Id:'):
+            jobid = line.split(':', 1)[1].strip()
+        m = re.match(r'\s*Job_Name = (.*)', line)
+        if m:
+            name = m.group(1).strip()
+        m = re.match(r'\s*job_state = (.*)', line)
+        if m and jobid:
+            states[jobid] = states[name] = m.group(1).strip()
+    return states
+
+class QbatchScheduler(Scheduler):
+    """
+    Submits jobs through qbatch, which takes care of arrays, chunking and
+    walltimes for whichever queue it is set up for. Jobs are identified by
+    name, which is what qbatch --afterok takes.
+
+    Chunks are run with -j 1, so that their commands run one after the other
+    as they do on the other backends.
+
+    Status polling goes to the underlying queue, as set by QBATCH_SYSTEM.
+    """
+
+    def _submit(self, chunks, name, logdir, walltime, afterok,
+                individual=False):
+        cmd = ['qbatch', '-N', name]
+        if individual:
+            cmd += ['-i']
+        if logdir:
+            cmd += ['--logdir', logdir]
+        if walltime:
+            cmd += ['--walltime', walltime]
+        if len(chunks[0]) > 1:
+            # qbatch runs the commands in a chunk in parallel unless told
+            # otherwise, and packed_chunksize() sizes chunks to run serially
+            cmd += ['-c', str(len(chunks[0])), '-j', '1']
+        if afterok:
+            cmd += ['--afterok', ','.join(afterok)]
+        cmd += ['-']
+
+        commands = [c for chunk in chunks for c in chunk]
+        p = proc.Popen(cmd, stdin=proc.PIPE, stdout=proc.PIPE, stderr=proc.PIPE)
+        out, err = p.communicate('\n'.join(commands) + '\n')
+        if p.returncode != 0:
+            raise SchedulerException("Submitting {} failed: {}".format(
+                    name, err.strip()))
+        return name
+
+    def submit_individual(self, chunks, name, logdir, walltime, afterok):
+        logger.debug("Submitting {} individual jobs {}".format(
+                len(chunks), name))
+        if not self.dryrun:
+            self._submit(chunks, name, logdir, walltime, afterok,
+                         individual=True)
+        self.jobs[name] = name
+        return name
+
+    def status(self, jobid):
+        if os.environ.get('QBATCH_SYSTEM', 'pbs') == 'sge':
+            return sge_status(jobid)
+        states = qstat_states()
+        active = any(state != 'C' for name, state in states.items()
+                     if fnmatch.fnmatchcase(name, jobid))
+        return active and ACTIVE or DONE
+
+class SchedulerException(Exception):
+    pass
+
+BACKENDS = {'local'  : LocalScheduler,
+            'qbatch' : QbatchScheduler,
+            'sge'    : SGEScheduler,
+            'pbs'    : PBSScheduler}
+
+def get_scheduler(name=None, **kwargs):
+    """
+    Returns a scheduler for the named backend (see BACKENDS). If no name is
+    given, the DM_SCHEDULER environment variable is used, and failing that,
+    qbatch.
+
+    Any keyword arguments (e.g. dryrun, or processes for the local backend)
+    are passed to the backend.
+    """
+    name = name or os.environ.get('DM_SCHEDULER', 'qbatch')
+    if name not in BACKENDS:
+        raise SchedulerException("Unknown scheduler {}, expected one of: "
+                "{}".format(name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name](**kwargs)
+
+# vim: ts=4 sw=4:
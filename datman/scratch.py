@@ -0,0 +1,335 @@
+"""
+Scratch folders for the intermediate files of pipeline steps.
+
+tempfile.mkdtemp() puts folders wherever TMPDIR points, which on our cluster
+is often an NFS mount, and the scripts that use it do not always clean up
+after themselves. Writing AFNI and FSL intermediates (motion corrected series,
+mean and standard deviation volumes, ...) over NFS only to delete them again
+is a large share of the time QC takes.
+
+This module hands out scratch folders on a fast local disk or tmpfs instead,
+and makes sure they are removed. The scratch space is configured with
+environment variables:
+
+    DM_SCRATCH        the folders to put scratch folders in, separated by ':'
+                      (e.g. /dev/shm:/local/scratch). The first that exists,
+                      is writable and has room for the quota is used. When
+                      none do, tempfile.gettempdir() is used.
+    DM_SCRATCH_QUOTA  how much scratch space (e.g. 20G, 512M) a job expects
+                      to use
+    DM_SCRATCH_KEEP   set to 'always' (or 1) to keep scratch folders rather
+                      than remove them, or to 'failed' to keep only those
+                      left by steps that raised an exception. Kept folders
+                      are logged, for debugging.
+    DM_SCRATCH_SIGTERM
+                      set to 0 to leave SIGTERM alone (see below)
+
+Each process gets a job folder in the scratch space, named after the queue's
+job id and its process id (datman-<job>.<pid>, or datman-<pid> outside a
+queue), and makes its scratch folders in there. Worker processes forked from
+it (e.g. by multiprocessing.Pool) after it was made share it, and those forked
+before make their own. The quota is for the whole job, i.e. the job folders of
+all of the job's processes. It is not a hard limit: it is used to pick a
+scratch root with that much free space, making a scratch folder raises
+ScratchQuotaExceeded while the job is already over it, and a warning is
+logged when a scratch folder is cleaned up while the job is over it
+(check_quota() raises ScratchQuotaExceeded instead, for callers that want to
+stop).
+
+Scratch folders are removed when the 'with' block that made them exits. A
+process' job folder is removed once the last of its scratch folders is, if
+nothing else is using it, so that workers (which exit without running atexit
+handlers) do not leave theirs behind. Otherwise the job folder, with anything
+left in it, is removed when the process that made it exits, including when it
+is stopped by the queue with SIGTERM. Kept folders are moved out of the job
+folder, to datman-kept-<name> in the scratch root, and scratch folders still
+open at exit count as failed.
+
+For the SIGTERM case, making the first scratch folder installs a SIGTERM
+handler that exits the process (so that atexit handlers run), if SIGTERM has
+not been handled already. Programs that handle SIGTERM themselves, or want
+the default, set DM_SCRATCH_SIGTERM=0, or call install_cleanup(sigterm=False)
+before making any scratch folders.
+
+Usage:
+
+    import datman as dm
+
+    with dm.scratch.Scratch(prefix='qc-') as tmpdir:
+        run('3dvolreg -prefix {}/mcorr.nii.gz ...'.format(tmpdir))
+        ...
+
+    # or, in place of tempfile.mkdtemp()/shutil.rmtree()
+    tmpdir = dm.scratch.mkdtemp(prefix='qc-')
+    ...
+    dm.scratch.remove(tmpdir)
+"""
+import os
+import re
+import glob
+import atexit
+import shutil
+import signal
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# job id variables set by the queues we run under, in order of preference
+JOB_ID_VARIABLES = ('PBS_JOBID', 'JOB_ID', 'SLURM_JOB_ID')
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+KEEP_ALWAYS = 'always'
+KEEP_FAILED = 'failed'
+
+# the job folder in each scratch root, and the process that made it
+_jobdirs = {}
+# the open scratch folders
+_scratches = []
+
+class ScratchError(Exception):
+    pass
+
+class ScratchQuotaExceeded(ScratchError):
+    pass
+
+def parse_size(size):
+    """
+    Returns the number of bytes in a size like '20G', '512M' or '1024'.
+    """
+    if size is None or size == '':
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size),
+                     re.IGNORECASE)
+    if not match:
+        raise ScratchError("Cannot read size {}".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def disk_usage(path):
+    """
+    Returns the number of bytes used by the files below path.
+    """
+    total = 0
+    for dirname, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirname, filename)).st_size
+            except OSError:
+                continue  # removed since listed
+    return total
+
+def queue_job_id():
+    """
+    Returns the id of the queue job we are running in, or None.
+    """
+    for variable in JOB_ID_VARIABLES:
+        if os.environ.get(variable):
+            return re.sub(r'[^\w-]', '_', os.environ[variable])
+    return None
+
+def scratch_roots():
+    roots = [r for r in os.environ.get('DM_SCRATCH', '').split(':') if r]
+    return roots + [tempfile.gettempdir()]
+
+def choose_root(roots, quota=None):
+    """
+    Returns the first of roots that is a writable folder with at least quota
+    bytes free. The last root is used if none are.
+    """
+    for root in roots:
+        if not (os.path.isdir(root) and os.access(root, os.W_OK | os.X_OK)):
+            logger.debug("Scratch folder {} is not usable".format(root))
+            continue
+        if quota and free_space(root) < quota:
+            logger.debug("Scratch folder {} has less than {} bytes "
+                         "free".format(root, quota))
+            continue
+        return root
+    logger.warning("None of the scratch folders {} have room, using "
+                   "{}".format(roots, roots[-1]))
+    return roots[-1]
+
+def job_dir(root):
+    """
+    Returns (making it, if need be) this process' job folder in a scratch
+    root.
+    """
+    if root in _jobdirs and not os.path.isdir(_jobdirs[root][0]):
+        del _jobdirs[root]   # released by the process we were forked from
+    if root not in _jobdirs:
+        job = queue_job_id()
+        name = 'datman-{}.{}'.format(job, os.getpid()) if job else \
+               'datman-{}'.format(os.getpid())
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        _jobdirs[root] = (path, os.getpid())
+        install_cleanup()
+    return _jobdirs[root][0]
+
+class Scratch:
+    """
+    A scratch folder, removed when cleaned up (or when used as a context
+    manager, on leaving the 'with' block), unless it is kept.
+
+    <quota> is a size in bytes or like '20G', <keep> one of 'always',
+    'failed' or None. They, and the <roots> to choose from, default to the
+    environment's settings (see the module documentation).
+    """
+
+    def __init__(self, prefix='tmp', quota=None, keep=None, roots=None):
+        if quota is None:
+            quota = os.environ.get('DM_SCRATCH_QUOTA')
+        if keep is None:
+            keep = os.environ.get('DM_SCRATCH_KEEP', '').lower()
+        if keep in ('1', 'yes', 'true'):
+            keep = KEEP_ALWAYS
+        self.quota = parse_size(quota)
+        self.keep = keep or None
+        self.jobdir = job_dir(choose_root(roots or scratch_roots(),
+                                          self.quota))
+        try:
+            self.check_quota()
+        except ScratchQuotaExceeded:
+            release_job_dir(self.jobdir)
+            raise
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=self.jobdir)
+        self.pid = os.getpid()
+        _scratches.append(self)
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, type, value, traceback):
+        self.cleanup(failed=type is not None)
+        return False
+
+    def usage(self):
+        """
+        Returns the bytes used by this job in the scratch root.
+        """
+        job = queue_job_id()
+        if not job:
+            return disk_usage(self.jobdir)
+        root = os.path.dirname(self.jobdir)
+        return sum(disk_usage(path) for path in
+                   glob.glob(os.path.join(root, 'datman-{}.*'.format(job))))
+
+    def check_quota(self):
+        """
+        Raises ScratchQuotaExceeded if the job is using more than its quota.
+        """
+        if not self.quota:
+            return
+        used = self.usage()
+        if used > self.quota:
+            raise ScratchQuotaExceeded("Job is using {} bytes of scratch "
+                    "space in {}, over its quota of {}".format(used,
+                    self.jobdir, self.quota))
+
+    def cleanup(self, failed=False):
+        """
+        Removes the scratch folder, unless it is to be kept.
+        """
+        if self in _scratches:
+            _scratches.remove(self)
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            self.check_quota()
+        except ScratchQuotaExceeded, e:
+            logger.warning(str(e))
+
+        if self.keep == KEEP_ALWAYS or (failed and self.keep == KEEP_FAILED):
+            kept = os.path.join(os.path.dirname(self.jobdir),
+                                'datman-kept-' + os.path.basename(self.path))
+            os.rename(self.path, kept)
+            logger.warning("Keeping scratch folder {}".format(kept))
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        release_job_dir(self.jobdir)
+
+def release_job_dir(path):
+    """
+    Removes a job folder made by this process once none of its scratch
+    folders are open, unless something (e.g. a worker's scratch folder) is
+    still in it.
+    """
+    if any(s.jobdir == path and s.pid == os.getpid() for s in _scratches):
+        return
+    for root, (jobdir, pid) in _jobdirs.items():
+        if jobdir != path or pid != os.getpid():
+            continue
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        del _jobdirs[root]
+
+def mkdtemp(prefix='tmp', **kwargs):
+    """
+    Makes a scratch folder and returns its path, like tempfile.mkdtemp().
+    It is removed by remove(), or when the process exits.
+    """
+    return Scratch(prefix=prefix, **kwargs).path
+
+def remove(path):
+    """
+    Removes a scratch folder made by mkdtemp() (unless it is to be kept).
+    """
+    for scratch in list(_scratches):
+        if scratch.path == path:
+            scratch.cleanup()
+            return
+    shutil.rmtree(path, ignore_errors=True)
+
+def cleanup_all():
+    """
+    Cleans up the open scratch folders of this process, and removes the job
+    folders it made.
+    """
+    for scratch in list(_scratches):
+        if scratch.pid == os.getpid():
+            scratch.cleanup(failed=True)
+    for root, (path, pid) in _jobdirs.items():
+        if pid != os.getpid():
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        del _jobdirs[root]
+
+def _terminated(signum, frame):
+    raise SystemExit(128 + signum)
+
+_installed = []
+
+def install_cleanup(sigterm=None):
+    """
+    Arranges for cleanup_all() to run when the process exits, including when
+    the queue stops the job with SIGTERM (if nothing else handles SIGTERM,
+    and unless <sigterm> is False). <sigterm> defaults to DM_SCRATCH_SIGTERM.
+
+    Only the first call has any effect.
+    """
+    if _installed:
+        return
+    _installed.append(True)
+    atexit.register(cleanup_all)
+    if sigterm is None:
+        sigterm = os.environ.get('DM_SCRATCH_SIGTERM', '1').lower() not in \
+                  ('0', 'no', 'false')
+    if not sigterm:
+        return
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _terminated)
+    except ValueError:
+        pass   # not the main thread
+
+# vim: ts=4 sw=4:
@@ -11,8 +11,10 @@ import io
 import glob
 import numpy as np
 import logging
-import subprocess as proc
 import scanid
+import scheduler
+import runner
+import headerindex
 import nibabel as nib
 
 SERIES_TAGS_MAP = {
@@ -47,6 +49,86 @@ def script_path():
     """
     return os.path.abspath(os.path.dirname(sys.argv[0]))
 
+class TagMatcher:
+    """
+    Matches series descriptions against a tagmap (see guess_tag) in a single
+    pass.
+
+    All of the patterns are compiled into one regex, as a sequence of
+    optional lookaheads from the start of the description, each capturing a
+    named group:
+
+        (?=[\s\S]*?(?P<p0>pattern0))?(?=[\s\S]*?(?P<p1>pattern1))?...
+
+    so one match tells us every pattern that is found anywhere in the
+    description (as re.search would). Python limits the number of groups in
+    a regex, so very large tagmaps are split over several regexes.
+
+    Patterns that would not behave the same inside the combined regex, i.e.
+    those with groups of their own (and so maybe backreferences) or with
+    (?...) extensions such as inline flags, are searched for one by one.
+
+    Results are cached by description, so build one matcher per tagmap and
+    reuse it.
+    """
+
+    GROUPS_PER_REGEX = 90
+
+    def __init__(self, tagmap = SERIES_TAGS_MAP):
+        self.patterns = sorted(tagmap.items())
+        combined = []
+        self.separate = []
+        for i, (p, tag) in enumerate(self.patterns):
+            regex = re.compile(p)
+            if regex.groups or '(?' in p:
+                self.separate.append((i, regex))
+            else:
+                combined.append(i)
+        self.regexes = []
+        for start in range(0, len(combined), self.GROUPS_PER_REGEX):
+            chunk = combined[start:start + self.GROUPS_PER_REGEX]
+            self.regexes.append(re.compile(''.join(
+                '(?=[\\s\\S]*?(?P<p{}>{}))?'.format(i, self.patterns[i][0])
+                for i in chunk)))
+        self.cache = {}
+
+    def matches(self, description):
+        """
+        Returns a list of the (pattern, tag) pairs that match description.
+        """
+        if description not in self.cache:
+            found = []
+            for regex in self.regexes:
+                groups = regex.match(description).groupdict()
+                found.extend(int(g[1:]) for g, v in groups.items()
+                             if v is not None)
+            found.extend(i for i, regex in self.separate
+                         if regex.search(description))
+            self.cache[description] = [self.patterns[i] for i in sorted(found)]
+        return self.cache[description]
+
+    def guess(self, description):
+        """
+        Returns the tag for description, None if there is no match, or a
+        list of tags if patterns for more than one tag match.
+        """
+        tags = sorted(set(tag for p, tag in self.matches(description)))
+        if len(tags) == 0: return None
+        if len(tags) == 1: return tags[0]
+        return tags
+
+    def conflicts(self, description):
+        """
+        Returns the patterns behind an ambiguous guess(), as a dict mapping
+        each tag to the patterns that matched for it.
+        """
+        conflicts = {}
+        for p, tag in self.matches(description):
+            conflicts.setdefault(tag, []).append(p)
+        return conflicts
+
+_tagmatchers = {}
+
 def guess_tag(description, tagmap = SERIES_TAGS_MAP):
     """
     Given a series description return a list of series tags this might be.
@@ -58,13 +140,14 @@ def guess_tag(description, tagmap = SERIES_TAGS_MAP):
     <tagmap> is a dictionary that maps a regex to a series tag, where the regex
     matches the series description dicom header. If not specified this modules
     SERIES_TAGS_MAP is used.
+
+    A TagMatcher is kept for each tagmap seen, so repeated calls with the same
+    tagmap do not recompile its patterns.
     """
-    matches = list(set(
-        [tag for p,tag in tagmap.iteritems() if re.search(p,description)]
-        ))
-    if len(matches) == 0: return None
-    if len(matches) == 1: return matches[0]
-    return matches
+    key = tuple(sorted(tagmap.items()))
+    if key not in _tagmatchers:
+        _tagmatchers[key] = TagMatcher(tagmap)
+    return _tagmatchers[key].guess(description)
 
 def mangle_basename(base_path):
     """
@@ -101,7 +184,111 @@ def get_extension(path):
     else:
         return os.path.splitext(path)[1]
 
-def get_archive_headers(path, stop_after_first = False):
+PIXEL_DATA_TAG = 0x7fe00010
+
+# files in exam archives that are never dicoms (e.g. XNAT catalogs, reports)
+NON_DICOM_EXTENSIONS = ('.xml', '.pdf', '.txt', '.log', '.csv', '.json',
+                        '.html', '.jpg', '.png', '.gif', '.nii', '.nii.gz')
+
+class StreamBuffer:
+    """
+    A seekable file-like view of a stream that can only be read forwards (e.g.
+    a zip or tar member).
+
+    Data is pulled from the stream only as far as it is read or seeked to,
+    and what has been read is kept so that it can be read again. This lets
+    pydicom parse the headers at the start of a member without the whole
+    member being decompressed.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = io.BytesIO()
+        self.pos = 0
+
+    def _fill(self, end):
+        self.buffer.seek(0, os.SEEK_END)
+        while end is None or self.buffer.tell() < end:
+            size = None if end is None else end - self.buffer.tell()
+            data = self.stream.read(size)
+            if not data: break
+            self.buffer.write(data)
+
+    def read(self, size=-1):
+        self._fill(None if size is None or size < 0 else self.pos + size)
+        self.buffer.seek(self.pos)
+        data = self.buffer.read(-1 if size is None else size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            self._fill(None)
+            offset += self.buffer.tell()
+        self._fill(offset)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+def is_dicom_candidate(filename):
+    """
+    Returns False for files that are obviously not dicoms, going by their name.
+    """
+    basename = os.path.basename(filename)
+    return not (basename.startswith('.') or
+                basename.lower().endswith(NON_DICOM_EXTENSIONS))
+
+def has_dicom_magic(fp):
+    """
+    Checks for the 'DICM' marker that follows the 128 byte dicom preamble.
+
+    The file is rewound to where it started.
+    """
+    start = fp.tell()
+    fp.seek(start + 128)
+    magic = fp.read(4)
+    fp.seek(start)
+    return magic == 'DICM'
+
+def read_dicom_header(fp, tags = None):
+    """
+    Reads the headers of a dicom file, stopping before the pixel data.
+
+    <fp> is a filename or a file-like object. If <tags> is given, it is a list
+    of header names (e.g. ['SeriesDescription', 'SeriesNumber']) or tag
+    numbers to read. Reading then stops as soon as the last of these tags has
+    been passed, and only these headers are kept in the returned dataset.
+
+    Raises dicom.filereader.InvalidDicomError if fp is not a dicom file.
+    """
+    if not tags:
+        return dcm.read_file(fp, stop_before_pixels=True)
+
+    wanted = set()
+    for tag in tags:
+        if isinstance(tag, basestring):
+            tag = dcm.datadict.tag_for_name(tag)
+        if tag is not None:
+            wanted.add(dcm.tag.Tag(tag))
+    last = max(wanted or [PIXEL_DATA_TAG])
+    stop_when = lambda tag, VR, length: tag > last or tag == PIXEL_DATA_TAG
+
+    if isinstance(fp, basestring):
+        with open(fp, 'rb') as fileobj:
+            dataset = dcm.filereader.read_partial(fileobj, stop_when)
+    else:
+        dataset = dcm.filereader.read_partial(fp, stop_when)
+
+    for tag in dataset.keys():
+        if tag not in wanted:
+            del dataset[tag]
+    return dataset
+
+def get_archive_headers(path, stop_after_first = False, index = None,
+        tags = None):
     """
     Get dicom headers from a scan archive.
 
@@ -115,54 +302,121 @@ def get_archive_headers(path, stop_after_first = False):
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    Only the headers are read from each dicom (see read_dicom_header), and if
+    tags is given only those headers are kept.
+
+    If index is given (a datman.headerindex.HeaderIndex) then the headers are
+    looked up there first, and the archive is only read if it is new or has
+    changed since it was indexed. The index is not used when tags is given.
     """
+    if tags:
+        index = None
+
+    if index is not None:
+        manifest = index.lookup(path, stop_after_first)
+        if manifest is not None:
+            return manifest
+        signature = headerindex.archive_signature(path)
+
     if os.path.isdir(path):
-        return get_folder_headers(path, stop_after_first)
+        manifest = get_folder_headers(path, stop_after_first, tags)
     elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
+        manifest = get_zipfile_headers(path, stop_after_first, tags)
     elif os.path.isfile(path) and path.endswith('.tar.gz'):
-        return get_tarfile_headers(path, stop_after_first)
+        manifest = get_tarfile_headers(path, stop_after_first, tags)
     else:
-	raise Exception("{} must be a file (zip/tar) or folder.".format(path))
+        raise Exception("{} must be a file (zip/tar) or folder.".format(path))
 
-def get_tarfile_headers(path, stop_after_first = False):
+    if index is not None:
+        index.store(path, manifest, stop_after_first, signature)
+    return manifest
+
+def get_tarfile_headers(path, stop_after_first = False, tags = None):
     """
     Get headers for dicom files within a tarball
     """
-    tar = tarfile.open(path)
-    members = tar.getmembers()
-
     manifest = {}
-    # for each dir, we want to inspect files inside of it until we find a dicom
-    # file that has header information
-    for f in filter(lambda x: x.isfile(), members):
-        dirname = os.path.dirname(f.name)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError, e:
-            continue
+    for dirname, headers in iter_tarfile_headers(path, tags):
+        manifest[dirname] = headers
+        if stop_after_first: break
     return manifest
 
-def get_zipfile_headers(path, stop_after_first = False):
+def iter_tarfile_headers(path, tags = None):
+    """
+    Yields (dirname, headers) for the first dicom found in each folder of a
+    tarball.
+
+    The tarball is read as a stream, so nothing beyond the current member is
+    decompressed, and of each member only as much as is needed to read its
+    headers.
+    """
+    tar = tarfile.open(path, mode='r|*')
+    seen = set()
+    try:
+        # for each dir, we want to inspect files inside of it until we find a
+        # dicom file that has header information
+        for member in tar:
+            dirname = os.path.dirname(member.name)
+            if dirname in seen or not member.isfile(): continue
+            if not is_dicom_candidate(member.name): continue
+            headers = read_member_header(tar.extractfile(member), tags)
+            if headers is None: continue
+            seen.add(dirname)
+            yield dirname, headers
+    finally:
+        tar.close()
+
+def get_zipfile_headers(path, stop_after_first = False, tags = None):
     """
     Get headers for a dicom file within a zipfile
     """
-    zf = zipfile.ZipFile(path)
-
     manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError, e:
-            continue
+    for dirname, headers in iter_zipfile_headers(path, tags):
+        manifest[dirname] = headers
+        if stop_after_first: break
     return manifest
 
-def get_folder_headers(path, stop_after_first = False):
+def iter_zipfile_headers(path, tags = None):
+    """
+    Yields (dirname, headers) for the first dicom found in each folder of a
+    zipfile.
+
+    Members are decompressed only as far as is needed to read their headers.
+    """
+    zf = zipfile.ZipFile(path)
+    seen = set()
+    try:
+        for info in zf.infolist():
+            dirname = os.path.dirname(info.filename)
+            if dirname in seen or info.filename.endswith('/'): continue
+            if not is_dicom_candidate(info.filename): continue
+            headers = read_member_header(zf.open(info), tags)
+            if headers is None: continue
+            seen.add(dirname)
+            yield dirname, headers
+    finally:
+        zf.close()
+
+def read_member_header(stream, tags = None):
+    """
+    Reads the dicom headers from an archive member stream.
+
+    Only the start of the stream is read: members without the 'DICM' marker
+    are rejected after the first 132 bytes. Returns None if the member is not
+    a dicom.
+    """
+    fp = StreamBuffer(stream)
+    try:
+        if not has_dicom_magic(fp):
+            return None
+        return read_dicom_header(fp, tags)
+    except dcm.filereader.InvalidDicomError, e:
+        return None
+    finally:
+        stream.close()
+
+def get_folder_headers(path, stop_after_first = False, tags = None):
     """
     Generate a dictionary of subfolders and dicom headers.
     """
@@ -178,7 +432,8 @@ def get_folder_headers(path, stop_after_first = False):
             if os.path.isdir(filepath):
                 subdirs.append(filepath)
                 continue
-            manifest[path] = dcm.read_file(filepath)
+            if not is_dicom_candidate(filename): continue
+            manifest[path] = read_dicom_header(filepath, tags)
             break
         except dcm.filereader.InvalidDicomError, e:
             pass
@@ -187,15 +442,15 @@ def get_folder_headers(path, stop_after_first = False):
 
     # recurse
     for subdir in subdirs:
-        manifest.update(get_folder_headers(subdir, stop_after_first))
+        manifest.update(get_folder_headers(subdir, stop_after_first, tags))
     return manifest
 
-def get_all_headers_in_folder(path, recurse = False):
+def get_all_headers_in_folder(path, recurse = False, tags = None):
     """
     Get DICOM headers for all files in the given path.
 
     Returns a dictionary mapping path->headers for *all* files (headers == None
-    for files that are not dicoms).
+    for files that are not dicoms). See read_dicom_header for <tags>.
     """
 
     manifest = {}
@@ -204,7 +459,7 @@ def get_all_headers_in_folder(path, recurse = False):
             filepath = os.path.join(dirname,filename)
             headers = None
             try:
-                headers = dcm.read_file(filepath)
+                headers = read_dicom_header(filepath, tags)
             except dcm.filereader.InvalidDicomError, e:
                 continue
             manifest[filepath] = headers
@@ -245,11 +500,17 @@ def subject_type(subject):
     except:
         return None
 
-def get_subjects(path):
+def get_subjects(path, catalog=None):
     """
     Finds all of the subject folders in the supplied directory, and returns
     their basenames.
+
+    If a datman.catalog.Catalog is given, the folders are looked up in it
+    rather than on disk.
     """
+    if catalog:
+        return catalog.subfolders(path)
+
     subjects = filter(os.path.isdir, glob.glob(os.path.join(path, '*')))
     for i, subj in enumerate(subjects):
         subjects[i] = os.path.basename(subj)
@@ -346,31 +607,36 @@ def make_epitome_folders(path, n_runs):
 def run_dummy_q(list_of_names):
     """
     This holds the script until all of the queued items are done.
+
+    Going through qbatch with no QBATCH_SYSTEM set, the queue is taken to be
+    SGE, and we hold on a dummy job as we always have. Otherwise the
+    scheduler (see datman.scheduler) is polled until the jobs are done.
     """
     print('Holding for remaining processes.')
-    opts = 'h_vmem=3G,mem_free=3G,virtual_free=3G'
-    holds = ",".join(list_of_names)
-    cmd = 'qsub -sync y -hold_jid {} -l {} -b y echo'.format(holds, opts)
-    run(cmd)
+    sched = scheduler.get_scheduler()
+    if (isinstance(sched, scheduler.QbatchScheduler) and
+            not os.environ.get('QBATCH_SYSTEM')):
+        opts = 'h_vmem=3G,mem_free=3G,virtual_free=3G'
+        holds = ",".join(list_of_names)
+        run('qsub -sync y -hold_jid {} -l {} -b y echo'.format(holds, opts))
+    else:
+        sched.wait(list_of_names)
     print('... Done.')
 
 def run(cmd, dryrun=False, echo=False):
     """
     Runs a command in the default shell (so beware!)
 
-    Returns the return code, stdout and stderr.
+    Returns the return code, stdout and stderr. If echo is True, the output
+    is not captured but goes to ours. The run is recorded in the run log, if
+    there is one (see datman.runner).
     """
     if dryrun:
         return 0, "", ""
-    elif echo:
-        p = proc.call(cmd, shell=True)
-        return p, "", ""
-    else:
-        p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
-        out, err = p.communicate()
-        return p.returncode, out, err
+    result = runner.run(cmd, capture=not echo, shell=True)
+    return result.returncode, result.out, result.err
 
-def get_files_with_tag(parentdir, tag, fuzzy = False):
+def get_files_with_tag(parentdir, tag, fuzzy = False, catalog = None):
     """
     Returns a list of files that have the specified tag.
 
@@ -379,16 +645,23 @@ def get_files_with_tag(parentdir, tag, fuzzy = False):
 
     If fuzzy == True, then filenames are matched if the given tag is found
     within the filename's tag.
+
+    If a datman.catalog.Catalog is given, the files are looked up in it
+    rather than on disk.
     """
+    if catalog:
+        return [os.path.join(parentdir, os.path.basename(entry.path))
+                for entry in catalog.files(folder=parentdir, tag=tag,
+                                           fuzzy=fuzzy)]
 
     files = []
-    for f in os.listdir(parentdir):
-        try:
-            _, filetag, _, _ = scanid.parse_filename(f)
-            if tag == filetag or (fuzzy and tag in filetag):
-                files.append(os.path.join(parentdir,f))
-        except scanid.ParseException:
+    names = os.listdir(parentdir)
+    for f, parsed in zip(names, scanid.parse_many(names)):
+        if parsed is None:
             continue
+        _, filetag, _, _ = parsed
+        if tag == filetag or (fuzzy and tag in filetag):
+            files.append(os.path.join(parentdir,f))
 
     return files
 
@@ -435,6 +708,145 @@ def loadnii(filename):
 
     return nifti, affine, header, dims
 
+def load_masked_nii(filename, mask, dtype=np.float32, chunksize=16):
+    """
+    Usage:
+        data = load_masked_nii(filename, mask)
+
+    Loads the voxels of a 3D or 4D Nifti file that fall within mask, which
+    is either a filename or an array with the same spatial dimensions as the
+    image. Non-zero mask voxels are taken in the same order as loadnii()
+    lays out its rows, i.e. data == loadnii(filename)[0][mask.ravel() > 0].
+
+    Unlike loadnii(), the full image is never held in memory: uncompressed
+    files are memory-mapped and compressed files are read sequentially,
+    chunksize volumes at a time. Only the masked rows are kept, converted to
+    dtype as they are read.
+
+    Returns:
+        a 2D matrix of in-mask voxels x timepoints.
+    """
+    if isinstance(mask, basestring):
+        mask = nib.load(mask).get_data()
+    mask = np.asarray(mask)
+    mask = mask.reshape(mask.shape[:3]) > 0
+
+    nifti = nib.load(filename, mmap='r', keep_file_open=True)
+    dims = nifti.shape
+
+    if len(dims) < 3:
+        raise Exception('Your data has less than 3 dimensions!')
+    if len(dims) > 4:
+        raise Exception('Your data is at least a penteract (> 4 dimensions!)')
+    if dims[:3] != mask.shape:
+        raise Exception('Mask dimensions {} do not match {} {}'.format(
+                mask.shape, filename, dims))
+
+    proxy = nifti.dataobj
+    if len(dims) == 3:
+        return np.asarray(proxy[...][mask], dtype=dtype).reshape(-1, 1)
+
+    data = np.empty((mask.sum(), dims[3]), dtype=dtype)
+    # volumes are the slowest-changing axis on disk, so each chunk is a
+    # single contiguous (and, for .nii.gz, forward-only) read
+    for start in range(0, dims[3], chunksize):
+        stop = min(start + chunksize, dims[3])
+        data[:, start:stop] = proxy[..., start:stop][mask]
+
+    return data
+
+def roi_means(data, labels):
+    """
+    Usage:
+        rois, means = roi_means(data, labels)
+
+    Averages the rows of a 2D voxels x timepoints matrix within each region
+    of an atlas, where labels gives the atlas value of every row (e.g. the
+    atlas masked the same way as the data). Rows labelled zero or less are
+    ignored.
+
+    The rows are sorted by label once and each region is summed as one
+    contiguous block, so the cost does not grow with the number of regions.
+
+    Returns:
+        the sorted region labels,
+        and a regions x timepoints matrix of the mean time series.
+    """
+    data = np.asarray(data)
+    labels = np.asarray(labels).ravel()
+
+    if data.ndim != 2:
+        raise Exception('Data must be a 2D voxels x timepoints matrix!')
+    if len(labels) != data.shape[0]:
+        raise Exception('Got {} labels for {} voxels'.format(
+                len(labels), data.shape[0]))
+
+    idx = np.where(labels > 0)[0]
+    idx = idx[np.argsort(labels[idx], kind='mergesort')]
+    rois, starts, counts = np.unique(labels[idx], return_index=True,
+                                     return_counts=True)
+    if len(rois) == 0:
+        return rois, np.zeros((0, data.shape[1]))
+
+    sums = np.add.reduceat(data[idx], starts, axis=0, dtype=np.float64)
+
+    return rois, sums / counts[:, np.newaxis]
+
+def partial_corr(C, shrinkage=0):
+    """
+    Usage:
+        P = partial_corr(C, shrinkage)
+
+    Returns the sample linear partial correlation coefficients between the
+    columns of C (an observations x variables matrix, e.g. timepoints x ROIs),
+    controlling for the remaining columns. P[i, j] is the partial correlation
+    of C[:, i] and C[:, j].
+
+    When the covariance is of full rank, this gives the same result as
+    regressing the other variables out of each pair and correlating the
+    residuals, but computes every pair at once from the precision (inverse
+    covariance) matrix, Theta:
+
+        P[i, j] = -Theta[i, j] / sqrt(Theta[i, i] * Theta[j, j])
+
+    With no more observations than variables (e.g. a short scan and a large
+    atlas) the sample covariance is singular, and without shrinkage the
+    result (from its pseudo-inverse) is not a partial correlation at all.
+    shrinkage, between 0 and 1, blends the covariance with a scaled identity
+    matrix before inverting it, i.e. (1 - shrinkage) * S + shrinkage *
+    trace(S) / p * I, which makes it invertible.
+    """
+    C = np.asarray(C, dtype=np.float64)
+    p = C.shape[1]
+
+    if not 0 <= shrinkage <= 1:
+        raise ValueError('shrinkage must be between 0 and 1, got {}'.format(
+                shrinkage))
+
+    S = np.cov(C, rowvar=False).reshape(p, p)
+    if shrinkage:
+        mu = np.trace(S) / p
+        S = (1 - shrinkage) * S + shrinkage * mu * np.eye(p)
+
+    theta = np.linalg.pinv(S)
+    d = np.sqrt(np.diag(theta))
+    P = -theta / np.outer(d, d)
+    np.fill_diagonal(P, 1)
+
+    return P
+
+def reorient_to_radiological(image):
+    """
+    Reorients a 3D or 4D image array (x, y, z[, t]) to radiological
+    orientation for plotting, i.e. (z, x, y[, t]) with the first two axes
+    reversed.
+
+    Returns a view of image, so no data is copied no matter how many time
+    points there are.
+    """
+    axes = (2, 0, 1) + tuple(range(3, image.ndim))
+    return np.transpose(image, axes)[::-1, ::-1]
+
 def check_returncode(returncode):
     if returncode != 0:
         raise ValueError
@@ -0,0 +1,291 @@
+"""
+Watches folders (e.g. an XNAT archive, or a project's data/dicom folder) for
+exams that appear or change in them.
+
+Only the entries directly within each watched folder are watched: an exam is
+a folder or a file (e.g. a zip) in a watched folder. An entry is reported
+when it is created, moved in, or modified. For a folder, modified means that
+its own modification time changed, i.e. that something was added to, removed
+from or renamed within it. Changes deeper inside an exam folder (e.g. a
+series added under SCANS/ of an XNAT exam) do not change its modification
+time, so they are not reported. While an exam is settling (see Debouncer)
+its whole tree is checked, but once it has settled, only a change to the exam
+folder itself brings it back.
+
+Two watchers are available. InotifyWatcher uses the Linux inotify API (through
+ctypes, so nothing needs to be installed) and is told of changes as they
+happen. It does not see changes made from other machines over NFS. There,
+PollingWatcher stats every entry of the watched folders every so often
+instead.
+
+Exams are usually still being written when they are first noticed. Debouncer
+holds on to each changed entry until its signature (see
+datman.headerindex.archive_signature) has stopped changing for a while.
+
+Usage:
+
+    import datman as dm
+
+    watcher = dm.watcher.get_watcher()
+    watcher.add('/xnat/archive/SPINS/arc001')
+    debouncer = dm.watcher.Debouncer(settle=300)
+    while True:
+        for path in watcher.changes(timeout=60):
+            debouncer.touch(path)
+        for path in debouncer.ready():
+            print 'new exam', path
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import datman.headerindex
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO |
+              IN_CREATE | IN_ONLYDIR)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+class WatcherException(Exception):
+    pass
+
+def load_libc():
+    """
+    Returns libc, if it has the inotify calls, or None.
+    """
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def list_entries(folder):
+    """
+    Returns a dict mapping the path of each entry in folder to its
+    modification time.
+    """
+    entries = {}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            entries[path] = os.stat(path).st_mtime
+        except OSError:
+            continue  # removed since listed
+    return entries
+
+class InotifyWatcher:
+    """
+    Reports changed entries of the watched folders, as inotify tells of them.
+    """
+
+    def __init__(self, libc=None):
+        self.libc = libc or load_libc()
+        if self.libc is None:
+            raise WatcherException("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherException("inotify_init1 failed: {}".format(
+                os.strerror(ctypes.get_errno())))
+        self.folders = {}   # watch descriptor -> folder
+        self.entries = {}   # folder -> {path: last known mtime}
+
+    def add(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, folder, WATCH_MASK)
+        if wd < 0:
+            raise WatcherException("Cannot watch {}: {}".format(
+                folder, os.strerror(ctypes.get_errno())))
+        self.folders[wd] = folder
+        self.entries[folder] = list_entries(folder)
+
+    def changes(self, timeout=None):
+        """
+        Waits up to timeout seconds for changes, and returns the set of paths
+        of the entries that have changed.
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("Missed some changes, rescanning")
+                    changed.update(self.rescan())
+                elif mask & IN_IGNORED:
+                    folder = self.folders.pop(wd, None)
+                    self.entries.pop(folder, None)
+                    logger.warning("No longer watching {}".format(folder))
+                elif name and wd in self.folders:
+                    path = os.path.join(self.folders[wd], name)
+                    changed.add(path)
+                    self.seen(self.folders[wd], path)
+        return changed
+
+    def seen(self, folder, path):
+        """
+        Records the modification time of a changed entry, so that a rescan
+        does not report it again.
+        """
+        try:
+            self.entries[folder][path] = os.stat(path).st_mtime
+        except OSError:
+            self.entries[folder].pop(path, None)
+
+    def rescan(self):
+        """
+        Returns the entries of the watched folders that are new or have been
+        modified since they were last seen (as PollingWatcher does), for when
+        the kernel's event queue overflows.
+        """
+        modified = set()
+        for folder, before in self.entries.items():
+            try:
+                after = list_entries(folder)
+            except OSError, e:
+                logger.warning("Cannot list {}: {}".format(folder, e))
+                continue
+            modified.update(path for path, mtime in after.iteritems()
+                            if before.get(path) != mtime)
+            self.entries[folder] = after
+        return modified
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Reports changed entries of the watched folders by listing them, and
+    stat-ing every entry, every interval seconds.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.folders = {}   # folder -> {path: mtime}
+        self.next_poll = time.time() + interval
+
+    def add(self, folder):
+        self.folders[folder] = list_entries(folder)
+
+    def changes(self, timeout=None):
+        """
+        Waits up to timeout seconds for the next poll, and returns the set of
+        paths of the entries that have been created or modified since the
+        last one.
+        """
+        wait = self.next_poll - time.time()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return set()
+        time.sleep(max(wait, 0))
+        self.next_poll = time.time() + self.interval
+
+        changed = set()
+        for folder, before in self.folders.items():
+            try:
+                after = list_entries(folder)
+            except OSError, e:
+                logger.warning("Cannot list {}: {}".format(folder, e))
+                continue
+            changed.update(path for path, mtime in after.iteritems()
+                           if before.get(path) != mtime)
+            self.folders[folder] = after
+        return changed
+
+    def close(self):
+        pass
+
+def get_watcher(poll=None):
+    """
+    Returns an InotifyWatcher, or a PollingWatcher that polls every poll
+    seconds if poll is given or inotify is not available.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher()
+        except WatcherException, e:
+            logger.warning("{}, polling for changes instead".format(e))
+    return PollingWatcher(poll or 60)
+
+class Debouncer:
+    """
+    Holds changed entries until they have settled: until their signature has
+    gone unchanged for settle seconds.
+    """
+
+    def __init__(self, settle=300):
+        self.settle = settle
+        self.pending = {}   # path -> (signature, time it was first seen)
+
+    def touch(self, path, now=None):
+        """
+        Notes that path has changed.
+        """
+        if path not in self.pending:
+            self.pending[path] = (None, now or time.time())
+
+    def ready(self, now=None):
+        """
+        Returns the pending paths that have settled (sorted), and forgets them.
+        Paths that no longer exist are forgotten as well.
+        """
+        now = now or time.time()
+        settled = []
+        for path, (signature, since) in self.pending.items():
+            try:
+                current = datman.headerindex.archive_signature(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                settled.append(path)
+        return sorted(settled)
+
+# vim: ts=4 sw=4:
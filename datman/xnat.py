@@ -0,0 +1,366 @@
+"""
+Uploads exam archives (zip files of dicoms, plus any other files from the
+exam) to XNAT.
+
+The dicoms are sent to XNAT's import service in a single request, and every
+other file in the archive is attached to the session as a resource. See
+https://wiki.xnat.org/pages/viewpage.action?pageId=5017279
+
+All requests go through one pooled session, and bodies are streamed from
+the archive a block at a time rather than read into memory. A request that
+fails to connect, or that the server answers with one of RETRY_STATUSES, is
+retried with exponential backoff. Resources are attached in parallel.
+
+If a journal folder is given, the steps of each upload that have completed
+(creating the subject, importing the dicoms, attaching each resource) are
+recorded in it, so an interrupted upload of an exam can be run again and
+resume where it stopped. The record is discarded if the archive changes.
+
+Usage:
+
+    import datman as dm
+
+    uploader = dm.xnat.Uploader(server, (username, password), jobs=4)
+    uploader.upload('SPINS', 'SPN01_CMH_0001_01_01.zip', journaldir='logs')
+"""
+import os
+import json
+import time
+import urllib
+import logging
+import zipfile
+import threading
+import multiprocessing.pool
+import requests
+import requests.adapters
+import datman.utils
+import datman.headerindex
+
+logger = logging.getLogger(__name__)
+
+CREATE_URL = "{server}/REST/projects/{project}/subjects/{subject}"
+
+UPLOAD_URL = "{server}/data/services/import?" \
+             "project={project}&subject={subject}&session={session}" \
+             "&overwrite=delete&prearchive=false&inbody=true"
+
+ATTACH_URL = "{server}/data/archive/projects/{project}/subjects/{subject}" \
+             "/experiments/{session}/files/{filename}?" \
+             "inbody=true"
+
+# files named like this are taken to be dicoms without looking inside them
+DICOM_EXTENSIONS = ('dcm', 'img')
+
+# bytes of a request body read at a time
+BLOCKSIZE = 1024 * 1024
+
+# responses worth trying a request again for
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# the import service answers 504 when the proxy in front of it gives up
+# waiting, while the import carries on in XNAT. Sending the exam again would
+# only start the import over, so for the dicoms a 504 (or our own timeout
+# waiting for the answer) is waited out instead, and the import recorded as
+# pending rather than failed.
+IMPORT_RETRY_STATUSES = (500, 502, 503)
+IMPORT_TIMEOUT_WAIT = 30
+PENDING = 'pending'
+
+# seconds to wait for the server to answer before giving up on a request
+TIMEOUT = 600
+
+class UploadBody:
+    """
+    A request body that is read from a stream a block at a time.
+
+    The length is given up front, so that requests sends a Content-Length
+    header (as it does for whole files) rather than using chunked transfer
+    encoding. Whatever is passed as 'closing' (e.g. the zip file a member
+    stream comes from) is closed along with the stream.
+    """
+
+    def __init__(self, stream, length, closing=None):
+        self.stream = stream
+        self.length = length
+        self.closing = closing
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def __iter__(self):
+        block = self.read(BLOCKSIZE)
+        while block:
+            yield block
+            block = self.read(BLOCKSIZE)
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        self.stream.close()
+        if self.closing is not None:
+            self.closing.close()
+
+def file_body(path):
+    """
+    Returns a function that opens the file at path as an UploadBody.
+    """
+    def open_body():
+        return UploadBody(open(path, 'rb'), os.path.getsize(path))
+    return open_body
+
+def member_body(archive, member):
+    """
+    Returns a function that opens a member of a zip file as an UploadBody.
+
+    Each body has a zip file of its own, so bodies can be read from different
+    threads at once.
+    """
+    def open_body():
+        zf = zipfile.ZipFile(archive)
+        info = zf.getinfo(member)
+        return UploadBody(zf.open(info), info.file_size, closing=zf)
+    return open_body
+
+def is_named_like_a_dicom(path):
+    return path.lower().endswith(DICOM_EXTENSIONS)
+
+def is_dicom_member(zf, info):
+    """
+    Checks whether a zip member is a dicom, by reading only the preamble and
+    'DICM' marker at its start.
+    """
+    stream = zf.open(info)
+    try:
+        return datman.utils.has_dicom_magic(datman.utils.StreamBuffer(stream))
+    finally:
+        stream.close()
+
+def find_resources(archive):
+    """
+    Returns the names of the files in a zip archive that are not dicoms.
+    """
+    resources = []
+    zf = zipfile.ZipFile(archive)
+    try:
+        for info in zf.infolist():
+            if info.filename.endswith('/'): continue
+            if is_named_like_a_dicom(info.filename): continue
+            if is_dicom_member(zf, info): continue
+            resources.append(info.filename)
+    finally:
+        zf.close()
+    return resources
+
+class UploadJournal:
+    """
+    A record of the completed steps of uploading an archive, kept in a json
+    file (or only in memory, if filename is None).
+
+    The record only holds for the version of the archive it was made for (see
+    datman.headerindex.archive_signature), and is started over otherwise.
+    """
+
+    def __init__(self, filename, archive):
+        self.filename = filename
+        self.signature = list(datman.headerindex.archive_signature(archive))
+        self.lock = threading.Lock()
+        self.steps = []
+
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as stream:
+                record = json.load(stream)
+            if record.get('signature') == self.signature:
+                self.steps = record.get('steps', [])
+
+    def done(self, step):
+        with self.lock:
+            return step in self.steps
+
+    def mark(self, step):
+        with self.lock:
+            self.steps.append(step)
+            if not self.filename:
+                return
+            tmpfile = self.filename + '.tmp'
+            with open(tmpfile, 'w') as stream:
+                json.dump({'signature': self.signature, 'steps': self.steps},
+                          stream)
+            os.rename(tmpfile, self.filename)
+
+class Uploader:
+    """
+    Uploads exam archives to an XNAT server.
+
+    <jobs> resources are attached at a time. Failed requests are tried up to
+    <retries> more times, waiting <backoff> seconds before the first retry
+    and twice as long before each one after. A request the server does not
+    answer within <timeout> seconds (None to wait forever) has failed.
+    """
+
+    def __init__(self, server, auth, jobs=1, retries=5, backoff=2,
+                 timeout=TIMEOUT):
+        self.server = server
+        self.jobs = max(jobs, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, body=None, headers=None,
+                retry_statuses=RETRY_STATUSES, retry_timeouts=True):
+        """
+        Makes a request, retrying with backoff if it fails to connect, times
+        out (unless retry_timeouts is False, in which case the
+        requests.exceptions.ReadTimeout is raised) or the response status is
+        one of retry_statuses. <body> is a function that opens the request
+        body, so that it can be sent again from the start.
+
+        Returns the last response, or raises the last connection error.
+        """
+        for attempt in range(self.retries + 1):
+            response, error = None, None
+            data = body() if body else None
+            try:
+                response = self.session.request(method, url, data=data,
+                        headers=headers, timeout=self.timeout)
+            except requests.exceptions.ReadTimeout, e:
+                if not retry_timeouts:
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), e:
+                error = e
+            finally:
+                if data is not None:
+                    data.close()
+
+            if response is not None and response.status_code not in retry_statuses:
+                return response
+            if attempt == self.retries:
+                break
+
+            delay = self.backoff * 2 ** attempt
+            logger.warning("{} {} failed ({}), retrying in {}s".format(
+                method, url, error or response.status_code, delay))
+            time.sleep(delay)
+
+        if response is None:
+            raise error
+        return response
+
+    def upload(self, project, archive, journaldir=None):
+        """
+        Uploads an exam archive, named by its scan id, to a project.
+
+        Returns True if the dicoms were imported (or are still being
+        imported by XNAT, see PENDING), and raises a
+        requests.exceptions.HTTPError if a resource could not be attached.
+        """
+        archivefile = os.path.basename(os.path.normpath(archive))
+        scanid = archivefile[:-len(datman.utils.get_extension(archivefile))]
+
+        journalfile = None
+        if journaldir:
+            journalfile = os.path.join(journaldir, scanid + '.json')
+        journal = UploadJournal(journalfile, archive)
+
+        url_params = {'server'  : self.server,
+                      'project' : project,
+                      'subject' : scanid,
+                      'session' : scanid}
+
+        if not journal.done('subject'):
+            if self.create_subject(url_params):
+                journal.mark('subject')
+
+        imported = journal.done('dicoms') or journal.done('dicoms:' + PENDING)
+        if not imported:
+            imported = self.import_dicoms(url_params, archive)
+            if imported == PENDING:
+                logger.warning("{}: dicom import is still running on "
+                               "XNAT".format(scanid))
+                journal.mark('dicoms:' + PENDING)
+            elif imported:
+                journal.mark('dicoms')
+
+        logger.info("Scanning for non-dicom data...")
+        resources = [f for f in find_resources(archive)
+                     if not journal.done('resource:' + f)]
+
+        def attach(resource):
+            self.attach_resource(url_params, archive, resource)
+            journal.mark('resource:' + resource)
+
+        logger.info("Uploading non-dicom data...")
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            pool.map(attach, resources)
+        finally:
+            pool.close()
+            pool.join()
+
+        return imported
+
+    def create_subject(self, url_params):
+        """
+        Creates the subject (if need be). Returns True on success.
+        """
+        logger.info("Creating subject {}".format(url_params['subject']))
+        r = self.request('PUT', CREATE_URL.format(**url_params))
+
+        if r.status_code not in (200, 201):
+            logger.error("{} http client error at folder creation: {}".format(
+                url_params['subject'], r.status_code))
+            return False
+        return True
+
+    def import_dicoms(self, url_params, archive):
+        """
+        Sends the archive to the import service. Returns True on success,
+        PENDING if the import is carrying on in XNAT after we stopped
+        waiting for it, and False if it failed.
+        """
+        # NOTE: If your project is not set to auto archive, then this will
+        # end up in the prearchive
+        logger.info("Uploading dicom data...")
+        try:
+            r = self.request('POST', UPLOAD_URL.format(**url_params),
+                    body=file_body(archive),
+                    headers={'Content-Type' : 'application/zip'},
+                    retry_statuses=IMPORT_RETRY_STATUSES,
+                    retry_timeouts=False)
+        except requests.exceptions.ReadTimeout, e:
+            status = 'timeout'
+        else:
+            status = r.status_code
+
+        if status in (504, 'timeout'):
+            # give the import a head start on the resources attached to it
+            time.sleep(IMPORT_TIMEOUT_WAIT)
+            return PENDING
+        if status != 200:
+            logger.error("{} http client error dicom data upload: {}".format(
+                url_params['session'], status))
+            return False
+        return True
+
+    def attach_resource(self, url_params, archive, resource):
+        # convert to HTTP language
+        uploadname = urllib.quote(resource)
+        r = self.request('POST',
+                ATTACH_URL.format(filename=uploadname, **url_params),
+                body=member_body(archive, resource))
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError, e:
+            logger.error("ERROR uploading file {}".format(resource))
+            raise e
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_file(root, name, contents="data"):
+    path = os.path.join(root, name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+def age(path):
+    # pretend path was last modified long ago, so it isn't "racy"
+    os.utime(path, (1000000000, 1000000000))
+
+def make_catalog(root):
+    return dm.catalog.Catalog(tempfile.mktemp(dir=TMPDIR), root)
+
+def test_files_are_parsed():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'DTI_CMH_H001_01/DTI_CMH_H001_01_01_T1_02_Sag-T1.nii.gz')
+    make_file(root, 'DTI_CMH_H001_01/notes.txt', 'hello')
+    catalog = make_catalog(root)
+    catalog.refresh()
+
+    eq_(catalog.subjects(), ['DTI_CMH_H001_01'])
+    t1, = catalog.files(subject='DTI_CMH_H001_01', tag='T1')
+    eq_(t1.path, os.path.join(root, 'DTI_CMH_H001_01',
+                              'DTI_CMH_H001_01_01_T1_02_Sag-T1.nii.gz'))
+    eq_((t1.scanid, t1.series, t1.description, t1.size),
+        ('DTI_CMH_H001_01_01', '02', 'Sag-T1', 4))
+
+    notes = catalog.files(folder=os.path.join(root, 'DTI_CMH_H001_01'))[1]
+    eq_(notes.tag, None)
+    eq_(notes.size, 5)
+
+def test_fuzzy_tags():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'DTI_CMH_H001_01/DTI_CMH_H001_01_01_DTI60-1000_05_DTI.nii')
+    catalog = make_catalog(root)
+    catalog.refresh()
+    eq_(catalog.files(tag='DTI'), [])
+    eq_(len(catalog.files(tag='DTI', fuzzy=True)), 1)
+
+def test_only_changed_folders_are_listed_again():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'SUBJ_A/a.nii')
+    make_file(root, 'SUBJ_B/b.nii')
+    for folder in ('SUBJ_A', 'SUBJ_B', '.'):
+        age(os.path.join(root, folder))
+    catalog = make_catalog(root)
+    catalog.refresh()
+
+    make_file(root, 'SUBJ_B/c.nii')
+    shutil.rmtree(os.path.join(root, 'SUBJ_A'))
+    os.makedirs(os.path.join(root, 'SUBJ_A'))
+    make_file(root, 'SUBJ_A/a.nii', 'more data')
+    catalog.refresh()
+
+    eq_([os.path.basename(e.path) for e in catalog.files()],
+        ['a.nii', 'b.nii', 'c.nii'])
+    eq_(catalog.files(subject='SUBJ_A')[0].size, 9)
+
+def test_stale_sizes_need_a_full_refresh():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'SUBJ_A/a.nii')
+    age(os.path.join(root, 'SUBJ_A'))
+    age(root)
+    catalog = make_catalog(root)
+    catalog.refresh()
+
+    make_file(root, 'SUBJ_A/a.nii', 'more data')
+    age(os.path.join(root, 'SUBJ_A'))
+    catalog.refresh()
+    eq_(catalog.files()[0].size, 4)
+    catalog.refresh(full=True)
+    eq_(catalog.files()[0].size, 9)
+
+def test_removed_folders_are_forgotten():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'SUBJ_A/nested/a.nii')
+    catalog = make_catalog(root)
+    catalog.refresh()
+    eq_(len(catalog.files()), 1)
+
+    shutil.rmtree(os.path.join(root, 'SUBJ_A'))
+    catalog.refresh()
+    eq_(catalog.files(), [])
+    eq_(catalog.subjects(), [])
+
+def test_catalog_of_another_root_is_discarded():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    other = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'SUBJ_A/a.nii')
+    filename = tempfile.mktemp(dir=TMPDIR)
+    dm.catalog.Catalog(filename, root).refresh()
+
+    eq_(dm.catalog.Catalog(filename, other).files(), [])
+
+@raises(ValueError)
+def test_folder_outside_root():
+    make_catalog(tempfile.mkdtemp(dir=TMPDIR)).files(folder=TMPDIR)
+
+def test_utils_use_catalog():
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    make_file(root, 'DTI_CMH_H001_01/DTI_CMH_H001_01_01_T1_02_Sag-T1.nii.gz')
+    catalog = dm.catalog.open_catalog(tempfile.mktemp(dir=TMPDIR), root)
+
+    subjdir = os.path.join(root, 'DTI_CMH_H001_01')
+    eq_(dm.utils.get_subjects(root, catalog), ['DTI_CMH_H001_01'])
+    eq_(dm.utils.get_files_with_tag(subjdir, 'T1', catalog=catalog),
+        dm.utils.get_files_with_tag(subjdir, 'T1'))
+
+# vim: ts=4 sw=4:
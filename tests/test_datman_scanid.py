@@ -1,3 +1,4 @@
+import pickle
 import datman.scanid as scanid
 from nose.tools import *
 
@@ -95,4 +96,27 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+def test_parse_is_cached():
+    ok_(scanid.parse("DTI_CMH_H001_01_02") is scanid.parse("DTI_CMH_H001_01_02"))
+    ident, _, _, _ = scanid.parse_filename(
+            'DTI_CMH_H001_01_02_T1_03_description.nii.gz')
+    ok_(ident is scanid.parse("DTI_CMH_H001_01_02"))
+
+@raises(AttributeError)
+def test_identifier_is_immutable():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    ident.site = "MRC"
+
+def test_identifier_pickles():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    copy = pickle.loads(pickle.dumps(ident))
+    eq_(copy, ident)
+    eq_(copy.get_full_subjectid_with_timepoint(), "DTI_CMH_H001_01")
+
+def test_parse_many():
+    parsed = scanid.parse_many(['DTI_CMH_H001_01_01_T1_02_description.nii.gz',
+                                'README.txt'])
+    eq_(parsed[0][1:], ('T1', '02', 'description'))
+    eq_(parsed[1], None)
+
 # vim: ts=4 sw=4:
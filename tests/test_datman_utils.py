@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy import stats, linalg
+from nose.tools import *
+import datman.utils as utils
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_nii(name, data):
+    path = os.path.join(TMPDIR, name)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+def test_reorient_to_radiological_3d():
+    image = np.arange(2*3*4).reshape(2, 3, 4)
+    expected = np.rot90(np.transpose(image, (2, 0, 1)), 2)
+    ok_(np.array_equal(utils.reorient_to_radiological(image), expected))
+
+def test_reorient_to_radiological_4d():
+    image = np.arange(2*3*4*5).reshape(2, 3, 4, 5)
+    reoriented = utils.reorient_to_radiological(image)
+    eq_(reoriented.shape, (4, 2, 3, 5))
+    for t in range(5):
+        ok_(np.array_equal(reoriented[..., t],
+            utils.reorient_to_radiological(image[..., t])))
+
+def test_reorient_to_radiological_is_a_view():
+    image = np.zeros((2, 3, 4, 5))
+    reoriented = utils.reorient_to_radiological(image)
+    reoriented[0, 0, 0, 0] = 1
+    eq_(image.sum(), 1)
+
+def check_load_masked_nii(name):
+    data = np.random.rand(4, 5, 6, 7)
+    mask = np.zeros((4, 5, 6), dtype=np.int16)
+    mask[1:3, 2:4, 3:6] = 1
+    func = make_nii(name, data)
+
+    expected = utils.loadnii(func)[0][mask.ravel() > 0]
+    masked = utils.load_masked_nii(func, make_nii('mask.nii', mask),
+                                   chunksize=3)
+    eq_(masked.dtype, np.float32)
+    ok_(np.allclose(masked, expected))
+
+def test_load_masked_nii():
+    check_load_masked_nii('func.nii')
+
+def test_load_masked_nii_gz():
+    check_load_masked_nii('func.nii.gz')
+
+def test_load_masked_nii_3d():
+    data = np.arange(4*5*6, dtype=np.float64).reshape(4, 5, 6)
+    mask = data % 2 == 0
+    masked = utils.load_masked_nii(make_nii('vol.nii.gz', data), mask,
+                                   dtype=np.float64)
+    eq_(masked.shape, (mask.sum(), 1))
+    ok_(np.array_equal(masked[:, 0], data[mask]))
+
+def test_roi_means_matches_per_roi_loop():
+    data = np.random.rand(200, 7)
+    labels = np.random.randint(0, 9, 200)
+    labels[labels == 4] = 0
+
+    rois, means = utils.roi_means(data, labels)
+
+    ok_(np.array_equal(rois, np.unique(labels[labels > 0])))
+    for i, roi in enumerate(rois):
+        ok_(np.allclose(means[i], data[labels == roi].mean(axis=0)))
+
+def test_roi_means_without_rois():
+    rois, means = utils.roi_means(np.ones((5, 3)), np.zeros(5))
+    eq_(len(rois), 0)
+    eq_(means.shape, (0, 3))
+
+def regression_partial_corr(C):
+    # the regression method dm-proc-rest.py used to use, for reference
+    p = C.shape[1]
+    P_corr = np.zeros((p, p))
+    for i in range(p):
+        P_corr[i, i] = 1
+        for j in range(i + 1, p):
+            idx = np.ones(p, dtype=np.bool)
+            idx[i] = False
+            idx[j] = False
+            beta_i = linalg.lstsq(C[:, idx], C[:, j])[0]
+            beta_j = linalg.lstsq(C[:, idx], C[:, i])[0]
+            res_j = C[:, j] - C[:, idx].dot(beta_i)
+            res_i = C[:, i] - C[:, idx].dot(beta_j)
+            P_corr[i, j] = P_corr[j, i] = stats.pearsonr(res_i, res_j)[0]
+    return P_corr
+
+def test_partial_corr_matches_regression_method():
+    C = np.random.rand(100, 8).dot(np.random.rand(8, 8))
+    C -= C.mean(axis=0)
+    ok_(np.allclose(utils.partial_corr(C), regression_partial_corr(C)))
+
+def test_partial_corr_shrinkage():
+    C = np.random.rand(10, 20)
+    P = utils.partial_corr(C, shrinkage=0.5)
+    ok_(np.allclose(P, P.T))
+    ok_(np.all(np.abs(P) <= 1))
+    ok_(np.array_equal(np.diag(P), np.ones(20)))
+
+def test_run_dummy_q_holds_on_sge_by_default():
+    bindir = os.path.join(TMPDIR, 'fakebin')
+    os.makedirs(bindir)
+    args = os.path.join(TMPDIR, 'qsub.args')
+    with open(os.path.join(bindir, 'qsub'), 'w') as f:
+        f.write('#!/bin/bash\necho "$@" > {}\n'.format(args))
+    os.chmod(os.path.join(bindir, 'qsub'), 0755)
+
+    saved = dict((k, os.environ.get(k)) for k in
+                 ('PATH', 'DM_SCHEDULER', 'QBATCH_SYSTEM'))
+    os.environ['PATH'] = bindir + os.pathsep + saved['PATH']
+    for k in ('DM_SCHEDULER', 'QBATCH_SYSTEM'):
+        os.environ.pop(k, None)
+    try:
+        utils.run_dummy_q(['job_a', 'job_b'])
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    words = open(args).read().split()
+    eq_(words[:2], ['-sync', 'y'])
+    eq_(words[words.index('-hold_jid') + 1], 'job_a,job_b')
+
+def test_guess_tag():
+    eq_(utils.guess_tag('Sag-T1-BRAVO'), 'T1')
+    eq_(utils.guess_tag('Nothing-to-see'), None)
+    eq_(utils.guess_tag('T1-Rest'), ['REST', 'T1'])
+
+def test_tagmatcher_conflicts():
+    matcher = utils.TagMatcher({'T1': 'T1', 'BRAVO': 'T1', 'Sag': 'SAG'})
+    eq_(matcher.guess('Sag-T1-BRAVO'), ['SAG', 'T1'])
+    eq_(matcher.conflicts('Sag-T1-BRAVO'), {'SAG': ['Sag'],
+                                            'T1': ['BRAVO', 'T1']})
+    eq_(matcher.guess('Ax-T1-BRAVO'), 'T1')
+
+def test_tagmatcher_with_many_patterns():
+    tagmap = dict(('pattern{}$'.format(i), 'TAG{}'.format(i))
+                  for i in range(250))
+    matcher = utils.TagMatcher(tagmap)
+    ok_(len(matcher.regexes) > 1)
+    eq_(matcher.guess('a-pattern7'), 'TAG7')
+    eq_(matcher.guess('a-pattern249'), 'TAG249')
+    eq_(matcher.guess('pattern250'), None)
+
+def test_tagmatcher_inline_flags_stay_with_their_pattern():
+    eq_(utils.guess_tag('dti60', {'(?i)t1': 'T1', 'DTI': 'DTI'}), None)
+    eq_(utils.guess_tag('dti60-T1', {'(?i)t1': 'T1', 'DTI': 'DTI'}), 'T1')
+
+def test_tagmatcher_patterns_with_groups():
+    tagmap = {r'(a)\1': 'A', 'x': 'X', r'(?P<n>b)(?P=n)': 'B'}
+    eq_(utils.guess_tag('aa', tagmap), 'A')
+    eq_(utils.guess_tag('abx', tagmap), 'X')
+    eq_(utils.guess_tag('bbx', tagmap), ['B', 'X'])
+
+# vim: ts=4 sw=4:
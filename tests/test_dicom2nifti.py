@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import dicom
+import numpy as np
+import nibabel as nib
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+MR_SMALL = os.path.join(os.path.dirname(dicom.__file__), 'testfiles',
+                        'MR_small.dcm')
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_series(nslices, nvolumes, gradients=None, **headers):
+    """
+    Writes a series of MR_small slices, 2mm apart, to a new folder. The
+    pixels of each slice are filled with 10 * volume + slice.
+    """
+    seriesdir = tempfile.mkdtemp(dir=TMPDIR)
+    ds = dicom.read_file(MR_SMALL)
+    for name, value in headers.items():
+        setattr(ds, name, value)
+
+    # written out of order, as they often are in archives
+    for t in reversed(range(nvolumes)):
+        for z in range(nslices):
+            ds.ImagePositionPatient = ['-80', '-90', str(10 + 2 * z)]
+            ds.InstanceNumber = t * nslices + z + 1
+            ds.SOPInstanceUID = '1.2.3.{}'.format(ds.InstanceNumber)
+            pixels = np.zeros((ds.Rows, ds.Columns), dtype=np.int16)
+            pixels[:] = 10 * t + z
+            pixels[0, 1] = -1   # marks the first row, second column
+            ds.PixelData = pixels.tostring()
+            if gradients:
+                bvalue, direction = gradients[t]
+                ds.DiffusionBValue = bvalue
+                ds.DiffusionGradientOrientation = direction
+            ds.save_as(os.path.join(seriesdir, '{}.dcm'.format(
+                ds.InstanceNumber)))
+    return seriesdir
+
+def test_volume_is_assembled():
+    seriesdir = make_series(3, 1)
+    stem = os.path.join(TMPDIR, 'T1')
+    outputs = dm.dicom2nifti.convert_series(seriesdir, stem)
+    eq_(outputs, [stem + '.nii.gz'])
+
+    image = nib.load(stem + '.nii.gz')
+    data = image.get_data()
+    eq_(data.shape, (64, 64, 3))
+    eq_(list(data[5, 5, :]), [0, 1, 2])
+    eq_(data[1, 0, 0], -1)
+    assert_true(np.allclose(image.affine,
+        [[-0.3125, 0, 0, 80], [0, -0.3125, 0, 90], [0, 0, 2, 10], [0, 0, 0, 1]]))
+
+def test_volumes_are_sorted_by_position_then_time():
+    seriesdir = make_series(2, 3, RepetitionTime='2000')
+    stem = os.path.join(TMPDIR, 'RST')
+    dm.dicom2nifti.convert_series(seriesdir, stem)
+
+    image = nib.load(stem + '.nii.gz')
+    eq_(image.shape, (64, 64, 2, 3))
+    eq_(image.get_data()[5, 5, 1, :].tolist(), [1, 11, 21])
+    eq_(image.header.get_zooms()[3], 2.0)
+
+def test_diffusion_gradients_are_written():
+    gradients = [(0, [0, 0, 0]), (1000, [1, 0, 0]), (1000, [0, 0.6, 0.8])]
+    seriesdir = make_series(2, 3, gradients)
+    stem = os.path.join(TMPDIR, 'DTI')
+    outputs = dm.dicom2nifti.convert_series(seriesdir, stem)
+    eq_(outputs, [stem + '.nii.gz', stem + '.bvec', stem + '.bval'])
+
+    eq_(open(stem + '.bval').read(), '0 1000 1000\n')
+    # x is flipped, since the image is stored in neurological order
+    eq_(np.loadtxt(stem + '.bvec').tolist(),
+        [[0, -1, 0], [0, 0, 0.6], [0, 0, 0.8]])
+
+def test_uneven_slices_are_rejected():
+    seriesdir = make_series(3, 2)
+    os.remove(os.path.join(seriesdir, '2.dcm'))
+    assert_raises(dm.dicom2nifti.ConversionError,
+                  dm.dicom2nifti.convert_series, seriesdir,
+                  os.path.join(TMPDIR, 'bad'))
+
+def test_missing_slice_is_rejected():
+    seriesdir = make_series(4, 1)
+    os.remove(os.path.join(seriesdir, '2.dcm'))
+    assert_raises(dm.dicom2nifti.ConversionError,
+                  dm.dicom2nifti.convert_series, seriesdir,
+                  os.path.join(TMPDIR, 'gap'))
+
+def test_mosaics_are_rejected_by_header():
+    header = dicom.read_file(MR_SMALL, stop_before_pixels=True)
+    header.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'MOSAIC']
+    assert_raises(dm.dicom2nifti.ConversionError,
+                  dm.dicom2nifti.check_header, header)
+
+# vim: ts=4 sw=4:
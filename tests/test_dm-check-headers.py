@@ -2,6 +2,7 @@ from nose.tools import *
 import importlib
 import sys
 from StringIO import StringIO
+import dicom
 
 check_headers = importlib.import_module('bin.dm-check-headers')
 
@@ -75,4 +76,69 @@ def test_header_single_mismatch():
         tolerance=None)]
     assert mismatches == expected
 
+
+def test_header_within_tolerance():
+    stdhdr = mock_header({"EchoTime": 30.2, "RepetitionTime": 2.01})
+    cmphdr = mock_header({"EchoTime": 33.9, "RepetitionTime": 2.06})
+
+    mismatches = check_headers.compare_headers(stdhdr, cmphdr)
+
+    expected = [check_headers.Mismatch(
+        header="RepetitionTime",
+        expected=2.0,
+        actual=2.1,
+        tolerance=1)]
+    assert mismatches == expected
+
+
+def test_plan_is_reused_and_ignores_headers():
+    stdhdr = mock_header({"same": 1, "ignored": 1})
+    plan = check_headers.HeaderPlan(stdhdr, ignore_headers=["ignored"])
+
+    assert plan.compare(mock_header({"same": 1, "ignored": 2})) == []
+    assert plan.compare(mock_header({"same": 2})) == [check_headers.Mismatch(
+        header="same",
+        expected=1,
+        actual=2,
+        tolerance=None)]
+
+def make_dataset(**headers):
+    ds = dicom.dataset.Dataset()
+    for name, value in headers.items():
+        setattr(ds, name, value)
+    return ds
+
+
+def test_dataset_headers_are_compared_by_tag():
+    stdhdr = make_dataset(EchoTime='30.2', RepetitionTime='2.01',
+                          SliceThickness='3', Manufacturer='GE')
+    cmphdr = make_dataset(EchoTime='33.9', RepetitionTime='2.01',
+                          SliceThickness='4', Modality='MR')
+
+    mismatches = check_headers.compare_headers(stdhdr, cmphdr)
+
+    expected = [("Manufacturer", 'GE', None),
+                ("Modality", None, 'MR'),
+                ("SliceThickness", 3.0, 4.0)]
+    eq_(sorted((m.header, m.expected, m.actual) for m in mismatches),
+        expected)
+
+
+def test_dataset_headers_are_reported_under_each_name():
+    # pydicom names this header ReferencedStudySequence and RefdStudySequence
+    # (see Dataset.dir()), and a mismatch is reported for each name
+    stdhdr = make_dataset(ReferencedStudySequence=[make_dataset(
+        ReferencedSOPInstanceUID='1.2.3')])
+    cmphdr = make_dataset(ReferencedStudySequence=[make_dataset(
+        ReferencedSOPInstanceUID='1.2.4')])
+    ok_('RefdStudySequence' in stdhdr.dir())
+
+    mismatches = check_headers.compare_headers(stdhdr, cmphdr)
+    eq_(sorted(m.header for m in mismatches),
+        ['RefdStudySequence', 'ReferencedStudySequence'])
+
+    mismatches = check_headers.compare_headers(
+        stdhdr, cmphdr, ignore_headers=['RefdStudySequence'])
+    eq_([m.header for m in mismatches], ['ReferencedStudySequence'])
+
 # vim: set ts=4 sw=4 :
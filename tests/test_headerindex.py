@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_archive(name, contents="data"):
+    path = os.path.join(TMPDIR, name)
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+def make_index():
+    return dm.headerindex.HeaderIndex(tempfile.mktemp(dir=TMPDIR))
+
+def test_lookup_unknown_archive():
+    index = make_index()
+    archive = make_archive('unknown.zip')
+    eq_(index.lookup(archive), None)
+
+def test_store_and_lookup():
+    index = make_index()
+    archive = make_archive('exam.zip')
+    manifest = {'exam/001': {'SeriesNumber': 1},
+                'exam/002': {'SeriesNumber': 2}}
+    index.store(archive, manifest)
+    eq_(index.lookup(archive), manifest)
+
+def test_changed_archive_is_not_served():
+    index = make_index()
+    archive = make_archive('changed.zip')
+    index.store(archive, {'exam/001': {'SeriesNumber': 1}})
+    make_archive('changed.zip', "more data")
+    eq_(index.lookup(archive), None)
+
+def test_incomplete_manifest_only_serves_stop_after_first():
+    index = make_index()
+    archive = make_archive('partial.zip')
+    manifest = {'exam/001': {'SeriesNumber': 1}}
+    index.store(archive, manifest, stop_after_first=True)
+    eq_(index.lookup(archive), None)
+    eq_(index.lookup(archive, stop_after_first=True), manifest)
+
+def test_complete_manifest_serves_stop_after_first():
+    index = make_index()
+    archive = make_archive('complete.zip')
+    index.store(archive, {'exam/001': {'SeriesNumber': 1},
+                          'exam/002': {'SeriesNumber': 2}})
+    eq_(len(index.lookup(archive, stop_after_first=True)), 1)
+
+def test_folder_archive_changes_when_series_added():
+    index = make_index()
+    archive = os.path.join(TMPDIR, 'folder')
+    os.makedirs(os.path.join(archive, 'SCANS', '001'))
+    index.store(archive, {'001': {'SeriesNumber': 1}})
+    ok_(index.lookup(archive) is not None)
+
+    make_archive(os.path.join('folder', 'SCANS', '001', 'new.dcm'))
+    eq_(index.lookup(archive), None)
+
+def test_archive_changed_while_read_is_not_served():
+    index = make_index()
+    archive = make_archive('uploading.zip')
+    signature = dm.headerindex.archive_signature(archive)
+    make_archive('uploading.zip', "more data")
+    index.store(archive, {'exam/001': {'SeriesNumber': 1}},
+                signature=signature)
+    eq_(index.lookup(archive), None)
+
+def test_store_leaves_pixel_data_of_callers_datasets():
+    index = make_index()
+    archive = make_archive('pixels.zip')
+    dataset = {'SeriesNumber': 1, dm.headerindex.PIXEL_DATA_TAG: 'pixels'}
+    index.store(archive, {'exam/001': dataset})
+    ok_(dm.headerindex.PIXEL_DATA_TAG in dataset)
+    eq_(index.lookup(archive), {'exam/001': {'SeriesNumber': 1}})
+
+def test_folder_archive_indexed_through_relative_path():
+    index = make_index()
+    archive = os.path.join(TMPDIR, 'relative')
+    os.makedirs(os.path.join(archive, 'SCANS', '001'))
+    link = os.path.join(TMPDIR, 'linked')
+    os.symlink(archive, link)
+
+    cwd = os.getcwd()
+    os.chdir(TMPDIR)
+    try:
+        index.store('relative', {'relative': {'SeriesNumber': 0},
+                                 'relative/SCANS/001': {'SeriesNumber': 1}})
+    finally:
+        os.chdir(cwd)
+
+    eq_(index.lookup(archive),
+        {archive: {'SeriesNumber': 0},
+         os.path.join(archive, 'SCANS', '001'): {'SeriesNumber': 1}})
+    eq_(sorted(index.lookup(link)),
+        [link, os.path.join(link, 'SCANS', '001')])
+
+# vim: ts=4 sw=4:
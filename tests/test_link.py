@@ -0,0 +1,133 @@
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import importlib
+from nose.tools import *
+import dicom
+
+link = importlib.import_module('bin.link')
+
+TMPDIR = None
+DICOM = os.path.join(os.path.dirname(dicom.__file__), 'testfiles',
+                     'CT_small.dcm')
+
+LOOKUP = """\
+source_name      target_name
+EXAM_IGNORED     <ignore>
+EXAM_LINKED      SPN01_CMH_0001_01_01
+EXAM_NAMED       SPN01_CMH_0002_01_01
+EXAM_NAMED       SPN01_CMH_0099_01_01
+EXAM_EXISTS      SPN01_CMH_0003_01_01
+"""
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_dir(name):
+    path = os.path.join(TMPDIR, name)
+    os.makedirs(path)
+    return path
+
+def make_lookup(folder, contents=LOOKUP):
+    path = os.path.join(folder, 'scans.csv')
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+def make_archive(folder, name, dicoms=True):
+    path = os.path.join(folder, name)
+    zf = zipfile.ZipFile(path, 'w')
+    if dicoms:
+        zf.write(DICOM, 'exam/001/image.dcm')
+    else:
+        zf.writestr('exam/notes.txt', 'some notes')
+    zf.close()
+    return path
+
+class FakeIndex:
+    """
+    Serves the given manifests, and records what is looked up and stored.
+    """
+
+    def __init__(self, manifests):
+        self.manifests = manifests
+        self.lookups = []
+        self.stored = []
+
+    def lookup(self, path, stop_after_first=False):
+        self.lookups.append(path)
+        return self.manifests.get(path)
+
+    def store(self, path, manifest, stop_after_first=False, signature=None):
+        self.stored.append(path)
+
+def test_read_lookup_table_keeps_first_entry():
+    lookup = link.read_lookup_table(make_lookup(make_dir('table')))
+    eq_(lookup['EXAM_NAMED']['target_name'], 'SPN01_CMH_0002_01_01')
+    eq_(link.get_scanid_from_lookup_table('/some/where/EXAM_NAMED.zip',
+                                          lookup)[0],
+        'SPN01_CMH_0002_01_01')
+    eq_(link.get_scanid_from_lookup_table('EXAM_MISSING.zip', lookup),
+        (None, None))
+
+def test_needs_header():
+    ok_(link.needs_header(None, None))
+    ok_(not link.needs_header('SPN01_CMH_0002_01_01',
+                              {'target_name': 'SPN01_CMH_0002_01_01'}))
+    ok_(link.needs_header('SPN01_CMH_0004_01_01',
+                          {'target_name': 'SPN01_CMH_0004_01_01',
+                           'dicom_StudyID': '512'}))
+
+def test_headers_are_only_read_when_needed():
+    folder = make_dir('batch')
+    targetdir = make_dir('batch/linked')
+    lookup = make_lookup(folder)
+    archives = [make_archive(folder, name + '.zip', dicoms=False) for name in
+                ('EXAM_IGNORED', 'EXAM_LINKED', 'EXAM_NAMED', 'EXAM_EXISTS',
+                 'EXAM_UNKNOWN')]
+    os.symlink(archives[1], os.path.join(targetdir, 'SPN01_CMH_0001_01_01.zip'))
+    open(os.path.join(targetdir, 'SPN01_CMH_0003_01_01.zip'), 'w').close()
+
+    probed = []
+    def get_headers(archives, index=None, jobs=1):
+        probed.extend(archives)
+        return dict((archive, None) for archive in archives)
+
+    get_headers_, argv = link.get_headers, sys.argv
+    link.get_headers = get_headers
+    sys.argv = ['link.py', '--lookup', lookup, targetdir] + archives
+    try:
+        link.main()
+    finally:
+        link.get_headers, sys.argv = get_headers_, argv
+
+    eq_(probed, [archives[4]])
+    # named in the table with nothing to check, so linked without being
+    # opened, even though it holds no dicoms
+    eq_(sorted(os.listdir(targetdir)), ['SPN01_CMH_0001_01_01.zip',
+                                        'SPN01_CMH_0002_01_01.zip',
+                                        'SPN01_CMH_0003_01_01.zip'])
+
+def test_index_is_used_before_reading_archives():
+    folder = make_dir('indexed')
+    indexed = os.path.join(folder, 'indexed.zip')   # never read
+    unindexed = make_archive(folder, 'unindexed.zip')
+    empty = make_archive(folder, 'empty.zip', dicoms=False)
+    index = FakeIndex({indexed: {'exam/001': {'StudyID': '512'}}})
+
+    headers = link.get_headers([indexed, unindexed, empty], index, jobs=2)
+
+    eq_(headers[indexed], {'StudyID': '512'})
+    ok_(headers[unindexed] is not None)
+    eq_(headers[empty], None)
+    eq_(index.lookups, [indexed, unindexed, empty])
+    # headers read by the workers are stored from this process
+    eq_(sorted(index.stored), [empty, unindexed])
+
+# vim: ts=4 sw=4:
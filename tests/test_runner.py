@@ -0,0 +1,92 @@
+import os
+import sys
+import shutil
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_runlog():
+    return dm.runner.RunLog(tempfile.mktemp(dir=TMPDIR))
+
+def test_program_name():
+    eq_(dm.runner.program_name(['OMP_NUM_THREADS=1', '/opt/afni/3dvolreg',
+                                '-prefix', 'x']), '3dvolreg')
+    eq_(dm.runner.program_name(dm.runner.command_argv(
+        "3dcalc -expr 'a/b' -prefix sfnr.nii.gz")), '3dcalc')
+    eq_(dm.runner.program_name([]), '')
+
+def test_output_and_status_are_returned():
+    result = dm.runner.run('echo out; echo err >&2; exit 3',
+                           runlog=make_runlog())
+    eq_((result.returncode, result.out, result.err), (3, 'out\n', 'err\n'))
+
+def test_argument_lists_are_not_run_by_the_shell():
+    result = dm.runner.run(['echo', '$HOME'], runlog=make_runlog())
+    eq_(result.out, '$HOME\n')
+    eq_(result.argv, ['echo', '$HOME'])
+
+def test_killed_commands_have_negative_status():
+    result = dm.runner.run('kill -9 $$', runlog=make_runlog())
+    eq_(result.returncode, -9)
+
+def test_resource_usage_is_measured():
+    allocate = 'x = "a" * (64 * 1024 * 1024)'
+    result = dm.runner.run([sys.executable, '-c', allocate],
+                           runlog=make_runlog())
+    ok_(result.maxrss > 64 * 1024)
+    ok_(result.user + result.sys > 0)
+    ok_(result.wall > 0)
+
+def test_report_is_read_without_waiting_for_other_children():
+    # the write end stays open, as in a child started by another thread
+    report, report_w = os.pipe()
+    try:
+        eq_(dm.runner.read_report(report), None)
+        os.write(report_w, '[1.5, 0.25, 0.125, 2048]')
+        eq_(dm.runner.read_report(report), (1.5, 0.25, 0.125, 2048))
+    finally:
+        os.close(report)
+        os.close(report_w)
+
+def test_memory_of_the_caller_is_not_counted():
+    ballast = 'a' * (128 * 1024 * 1024)
+    result = dm.runner.run(['true'], runlog=make_runlog())
+    ok_(result.maxrss < 64 * 1024)
+
+def test_runs_are_recorded():
+    runlog = make_runlog()
+    dm.runner.run('true', runlog=runlog)
+    dm.runner.run('false', runlog=runlog)
+    dm.runner.run(['false', 'again'], runlog=runlog)
+
+    runs = runlog.runs()
+    eq_([(r.program, r.returncode) for r in runs],
+        [('true', 0), ('false', 1), ('false', 1)])
+    eq_(runs[2].argv, ['false', 'again'])
+    eq_(runs[0].pid, os.getpid())
+    eq_(len(runlog.runs(failed=True)), 2)
+    eq_(runlog.runs(program='true')[0].program, 'true')
+
+    summary = dict((s.program, s) for s in runlog.summary())
+    eq_((summary['false'].runs, summary['false'].failures), (2, 2))
+    eq_((summary['true'].runs, summary['true'].failures), (1, 0))
+
+def test_runlog_is_taken_from_the_environment():
+    filename = tempfile.mktemp(dir=TMPDIR)
+    os.environ['DM_RUNLOG'] = filename
+    try:
+        dm.utils.run('true')
+    finally:
+        del os.environ['DM_RUNLOG']
+    eq_(len(dm.runner.RunLog(filename).runs()), 1)
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,169 @@
+import os
+import glob
+import shutil
+import subprocess
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def outfile(name):
+    return os.path.join(TMPDIR, name)
+
+def test_chunk():
+    eq_(dm.scheduler.chunk(['a', 'b', 'c'], 2), [['a', 'b'], ['c']])
+    eq_(dm.scheduler.chunk(['a', 'b'], 0), [['a'], ['b']])
+
+def test_get_scheduler_from_environment():
+    os.environ['DM_SCHEDULER'] = 'local'
+    try:
+        ok_(isinstance(dm.scheduler.get_scheduler(),
+                       dm.scheduler.LocalScheduler))
+    finally:
+        del os.environ['DM_SCHEDULER']
+
+@raises(dm.scheduler.SchedulerException)
+def test_get_unknown_scheduler():
+    dm.scheduler.get_scheduler('condor')
+
+def test_local_array_job():
+    sched = dm.scheduler.get_scheduler('local', processes=2)
+    logdir = outfile('array-logs')
+    commands = ['echo {} > {}'.format(i, outfile('array.{}'.format(i)))
+                for i in range(5)]
+
+    jobid = sched.submit(commands, 'array', logdir=logdir, chunksize=2)
+
+    ok_(sched.wait(jobid))
+    eq_(sched.status(jobid), dm.scheduler.DONE)
+    eq_(len(glob.glob(outfile('array.*'))), 5)
+    eq_(len(os.listdir(logdir)), 3)
+
+def test_local_failed_dependency_holds_job():
+    sched = dm.scheduler.get_scheduler('local')
+    sched.submit(['true'], 'deps_ok', logdir=TMPDIR)
+    sched.submit(['false'], 'deps_bad', logdir=TMPDIR)
+
+    held = sched.submit(['touch ' + outfile('held')], 'held', logdir=TMPDIR,
+                        afterok=['deps_*'])
+
+    ok_(not sched.wait(held))
+    eq_(sched.status(held), dm.scheduler.FAILED)
+    ok_(not os.path.exists(outfile('held')))
+    ok_(not sched.wait(['deps_*']))
+
+def test_local_jobs_run_in_the_background():
+    sched = dm.scheduler.get_scheduler('local', processes=2)
+    flag = outfile('started')
+    first = sched.submit(['while [ ! -e {} ]; do sleep 0.1; done'.format(flag)],
+                         'first', logdir=TMPDIR)
+    eq_(sched.status(first), dm.scheduler.ACTIVE)
+
+    # runs alongside the first job, which waits for it
+    sched.submit(['touch ' + flag], 'second', logdir=TMPDIR)
+    after = sched.submit(['touch ' + outfile('after')], 'after',
+                         logdir=TMPDIR, afterok=['first'])
+
+    ok_(sched.wait([first, after]))
+    ok_(os.path.exists(outfile('after')))
+
+def test_dryrun_runs_nothing():
+    sched = dm.scheduler.get_scheduler('local', dryrun=True)
+    sched.submit(['touch ' + outfile('dryrun')], 'dryrun', logdir=TMPDIR)
+    ok_(not os.path.exists(outfile('dryrun')))
+
+def test_sge_options():
+    sched = dm.scheduler.SGEScheduler()
+    opts = sched.options(3, 'job', '/logs', '1:00:00', ['prefix_*'])
+    ok_('-t' in opts and opts[opts.index('-t') + 1] == '1-3')
+    eq_(opts[opts.index('-hold_jid') + 1], 'prefix_*')
+    eq_(opts[opts.index('-l') + 1], 'h_rt=1:00:00')
+
+def test_pbs_dependencies_are_resolved_to_ids():
+    sched = dm.scheduler.PBSScheduler()
+    sched.jobs = {'prefix_a': '101.server', 'prefix_b': '102[].server'}
+    opts = sched.options(1, 'job', None, None, ['prefix_*'])
+    eq_(opts[opts.index('-W') + 1],
+        'depend=afterok:101.server,afterokarray:102[].server')
+
+def test_array_script_selects_task_chunk():
+    script = dm.scheduler.SGEScheduler().script([['a', 'b'], ['c']])
+    ok_('case ${SGE_TASK_ID} in' in script)
+    ok_('2)\n    ( c ) || rtn=1\n' in script)
+
+def test_script_exits_with_failure_of_any_command():
+    sched = dm.scheduler.SGEScheduler()
+    scriptfile = outfile('failing.sh')
+    with open(scriptfile, 'w') as f:
+        f.write(sched.script([['false', 'true']]))
+    eq_(subprocess.call(['bash', scriptfile]), 1)
+
+    with open(scriptfile, 'w') as f:
+        f.write(sched.script([['true'], ['false', 'true']]))
+    env = dict(os.environ, SGE_TASK_ID='1')
+    eq_(subprocess.call(['bash', scriptfile], env=env), 0)
+    env['SGE_TASK_ID'] = '2'
+    eq_(subprocess.call(['bash', scriptfile], env=env), 1)
+
+def test_qbatch_runs_chunks_serially():
+    bindir = outfile('fakebin')
+    os.makedirs(bindir)
+    qbatch = os.path.join(bindir, 'qbatch')
+    with open(qbatch, 'w') as f:
+        f.write('#!/bin/bash\necho "$@" > {}\n'.format(outfile('qbatch.args')))
+    os.chmod(qbatch, 0755)
+
+    path = os.environ['PATH']
+    os.environ['PATH'] = bindir + os.pathsep + path
+    try:
+        sched = dm.scheduler.QbatchScheduler()
+        sched.submit(['a', 'b', 'c'], 'serial', chunksize=3)
+    finally:
+        os.environ['PATH'] = path
+
+    args = open(outfile('qbatch.args')).read().split()
+    eq_(args[args.index('-c') + 1], '3')
+    eq_(args[args.index('-j') + 1], '1')
+
+def test_packed_commands_keep_their_own_logs():
+    sched = dm.scheduler.get_scheduler('local')
+    logdir = outfile('packed-logs')
+
+    jobid = sched.submit(['echo one', 'exit 3', 'echo three'], 'packed',
+                         logdir=logdir, chunksize=3, packed=True)
+
+    sched.wait(jobid)
+    eq_(sched.status(jobid), dm.scheduler.FAILED)
+    statuses = [dm.scheduler.read_status(os.path.join(logdir,
+                'packed.{}.status'.format(n))) for n in (1, 2, 3)]
+    eq_([s[0] for s in statuses], [0, 3, 0])
+    eq_(open(os.path.join(logdir, 'packed.3.log')).read(), 'three\n')
+
+def test_walltime_seconds():
+    eq_(dm.scheduler.walltime_seconds('1:30:00'), 5400)
+    eq_(dm.scheduler.walltime_seconds('0:30'), 30)
+
+def test_packed_chunksize():
+    logdir = outfile('history')
+    os.makedirs(logdir)
+    eq_(dm.scheduler.packed_chunksize(logdir, 'dm_dtifit_', '0:30:00'), 1)
+
+    for n in range(10):
+        with open(os.path.join(logdir,
+                  'dm_dtifit_old.{}.status'.format(n)), 'w') as f:
+            f.write('0 30\n')
+    with open(os.path.join(logdir, 'other_old.1.status'), 'w') as f:
+        f.write('0 3000\n')
+
+    eq_(dm.scheduler.packed_chunksize(logdir, 'dm_dtifit_', '0:30:00'), 30)
+    eq_(dm.scheduler.packed_chunksize(logdir, 'dm_dtifit_', '2:00:00'), 50)
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,136 @@
+import os
+import glob
+import shutil
+import signal
+import multiprocessing
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    dm.scratch.cleanup_all()
+    shutil.rmtree(TMPDIR)
+
+def write(path, size):
+    with open(path, 'w') as f:
+        f.write('x' * size)
+
+def test_parse_size():
+    eq_(dm.scratch.parse_size('512'), 512)
+    eq_(dm.scratch.parse_size('20G'), 20 * 1024 ** 3)
+    eq_(dm.scratch.parse_size('1.5m'), 1536 * 1024)
+    eq_(dm.scratch.parse_size(None), None)
+    assert_raises(dm.scratch.ScratchError, dm.scratch.parse_size, 'lots')
+
+def test_unusable_roots_are_skipped():
+    missing = os.path.join(TMPDIR, 'missing')
+    with dm.scratch.Scratch(roots=[missing, TMPDIR], keep='') as path:
+        ok_(os.path.isdir(path))
+        ok_(path.startswith(TMPDIR))
+
+def test_roots_without_room_for_the_quota_are_skipped():
+    eq_(dm.scratch.choose_root(['/', TMPDIR], quota=2 ** 60), TMPDIR)
+
+def test_scratch_is_removed():
+    with dm.scratch.Scratch(roots=[TMPDIR], keep='') as path:
+        write(os.path.join(path, 'mcorr.nii.gz'), 10)
+    ok_(not os.path.exists(path))
+
+def test_scratch_is_removed_on_error():
+    try:
+        with dm.scratch.Scratch(roots=[TMPDIR], keep='') as path:
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    ok_(not os.path.exists(path))
+
+def test_failed_scratch_is_kept():
+    with dm.scratch.Scratch(roots=[TMPDIR], keep='failed') as path:
+        pass
+    ok_(not os.path.exists(path))
+
+    try:
+        with dm.scratch.Scratch(roots=[TMPDIR], keep='failed') as path:
+            write(os.path.join(path, 'mean.nii.gz'), 10)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    kept = os.path.join(TMPDIR, 'datman-kept-' + os.path.basename(path))
+    ok_(os.path.exists(os.path.join(kept, 'mean.nii.gz')))
+
+def test_quota():
+    scratch = dm.scratch.Scratch(roots=[TMPDIR], quota='1K', keep='')
+    write(os.path.join(scratch.path, 'small'), 1000)
+    scratch.check_quota()
+    write(os.path.join(scratch.path, 'big'), 1000)
+    assert_raises(dm.scratch.ScratchQuotaExceeded, scratch.check_quota)
+    scratch.cleanup()
+
+def test_no_scratch_is_made_over_quota():
+    root = os.path.join(TMPDIR, 'quota')
+    os.makedirs(root)
+    scratch = dm.scratch.Scratch(roots=[root], quota='1K', keep='')
+    write(os.path.join(scratch.path, 'big'), 2000)
+    assert_raises(dm.scratch.ScratchQuotaExceeded, dm.scratch.Scratch,
+                  roots=[root], quota='1K', keep='')
+    eq_(os.listdir(scratch.jobdir), [os.path.basename(scratch.path)])
+    scratch.cleanup()
+
+def test_mkdtemp_and_remove():
+    path = dm.scratch.mkdtemp(prefix='qc-', roots=[TMPDIR], keep='')
+    ok_(os.path.basename(path).startswith('qc-'))
+    dm.scratch.remove(path)
+    ok_(not os.path.exists(path))
+
+def use_scratch(root):
+    with dm.scratch.Scratch(roots=[root], keep='') as path:
+        write(os.path.join(path, 'mcorr.nii.gz'), 10)
+    return os.getpid()
+
+def test_pool_workers_leave_no_job_folders():
+    root = os.path.join(TMPDIR, 'pool')
+    os.makedirs(root)
+    pool = multiprocessing.Pool(3)
+    try:
+        pids = pool.map(use_scratch, [root] * 6)
+    finally:
+        pool.close()
+        pool.join()
+    ok_(os.getpid() not in pids)
+    eq_(glob.glob(os.path.join(root, 'datman-*')), [])
+
+def test_job_folder_is_kept_while_in_use():
+    path = dm.scratch.mkdtemp(roots=[TMPDIR], keep='')
+    jobdir = os.path.dirname(path)
+    with dm.scratch.Scratch(roots=[TMPDIR], keep='') as other:
+        eq_(os.path.dirname(other), jobdir)
+    ok_(os.path.isdir(jobdir))
+    dm.scratch.remove(path)
+    ok_(not os.path.exists(jobdir))
+
+def test_sigterm_handler_can_be_left_out():
+    installed, handler = dm.scratch._installed[:], \
+                         signal.getsignal(signal.SIGTERM)
+    dm.scratch._installed[:] = []
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        dm.scratch.install_cleanup(sigterm=False)
+        eq_(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+    finally:
+        dm.scratch._installed[:] = installed
+        signal.signal(signal.SIGTERM, handler)
+
+def test_cleanup_all_removes_job_folders():
+    path = dm.scratch.mkdtemp(roots=[TMPDIR], keep='')
+    jobdir = os.path.dirname(path)
+    write(os.path.join(jobdir, 'left-by-a-worker'), 10)
+    dm.scratch.cleanup_all()
+    ok_(not os.path.exists(jobdir))
+
+# vim: ts=4 sw=4:
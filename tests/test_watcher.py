@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+import datman as dm
+
+TMPDIR = None
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+def make_file(path, contents="data"):
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+def check_watcher(watcher):
+    folder = tempfile.mkdtemp(dir=TMPDIR)
+    old = make_file(os.path.join(folder, 'old.zip'))
+    os.utime(old, (1000000000, 1000000000))
+    watcher.add(folder)
+
+    exam = os.path.join(folder, 'SPN01_CMH_0001_01_01')
+    os.mkdir(exam)
+    new = make_file(os.path.join(folder, 'new.zip'))
+    make_file(old, "more data")
+
+    changed = set()
+    for i in range(10):
+        changed.update(watcher.changes(timeout=0.5))
+        if len(changed) == 3:
+            break
+    eq_(changed, set([exam, new, old]))
+    watcher.close()
+
+def test_inotify_watcher():
+    try:
+        watcher = dm.watcher.InotifyWatcher()
+    except dm.watcher.WatcherException:
+        return  # not on linux
+    check_watcher(watcher)
+
+def test_inotify_rescan_reports_only_unseen_changes():
+    try:
+        watcher = dm.watcher.InotifyWatcher()
+    except dm.watcher.WatcherException:
+        return  # not on linux
+    folder = tempfile.mkdtemp(dir=TMPDIR)
+    processed = make_file(os.path.join(folder, 'processed.zip'))
+    watcher.add(folder)
+    new = make_file(os.path.join(folder, 'new.zip'))
+    for i in range(10):
+        if new in watcher.changes(timeout=0.5):
+            break
+
+    eq_(watcher.rescan(), set())
+    missed = make_file(os.path.join(folder, 'missed.zip'))
+    os.utime(new, (1000000000, 1000000000))
+    eq_(watcher.rescan(), set([missed, new]))
+    watcher.close()
+
+def test_polling_watcher():
+    check_watcher(dm.watcher.PollingWatcher(interval=0.1))
+
+def test_debouncer_waits_for_exam_to_settle():
+    exam = tempfile.mkdtemp(dir=TMPDIR)
+    debouncer = dm.watcher.Debouncer(settle=10)
+
+    debouncer.touch(exam, now=100)
+    eq_(debouncer.ready(now=100), [])
+    eq_(debouncer.ready(now=105), [])
+
+    # still being written
+    make_file(os.path.join(exam, 'a.dcm'))
+    eq_(debouncer.ready(now=108), [])
+    eq_(debouncer.ready(now=115), [])
+    eq_(debouncer.ready(now=118), [exam])
+    eq_(debouncer.ready(now=200), [])
+
+def test_debouncer_forgets_removed_exams():
+    exam = tempfile.mkdtemp(dir=TMPDIR)
+    debouncer = dm.watcher.Debouncer(settle=10)
+    debouncer.touch(exam, now=100)
+    os.rmdir(exam)
+    eq_(debouncer.ready(now=200), [])
+    eq_(debouncer.pending, {})
+
+# vim: ts=4 sw=4:
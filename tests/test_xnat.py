@@ -0,0 +1,175 @@
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+import requests
+from nose.tools import *
+import dicom
+import datman as dm
+
+TMPDIR = None
+DICOM = os.path.join(os.path.dirname(dicom.__file__), 'testfiles',
+                     'CT_small.dcm')
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Records each request, and answers with the next of the server's statuses
+    for the request's path (or 200, once those run out).
+    """
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        path = self.path.split('?')[0]
+        with self.server.lock:
+            self.server.requests.append((self.command, path, body))
+            statuses = self.server.statuses.get(path, [])
+            status = statuses.pop(0) if statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_server(statuses=None):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.statuses = statuses or {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return server
+
+def make_archive(name='SPN01_CMH_0001_01_01.zip'):
+    path = os.path.join(TMPDIR, name)
+    zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    zf.write(DICOM, 'exam/001/image')
+    zf.write(DICOM, 'exam/001/image2.dcm')
+    zf.writestr('exam/notes.txt', 'some notes')
+    zf.writestr('exam/behav/run 1.log', 'x' * 100000)
+    zf.close()
+    return path
+
+def make_uploader(server, **kwargs):
+    return dm.xnat.Uploader(server.url, ('user', 'pass'), backoff=0, **kwargs)
+
+def resource_paths(server):
+    return sorted(path.split('/files/')[1] for method, path, body in
+                  server.requests if '/files/' in path)
+
+def test_find_resources():
+    eq_(sorted(dm.xnat.find_resources(make_archive())),
+        ['exam/behav/run 1.log', 'exam/notes.txt'])
+
+def test_upload():
+    server = start_server()
+    archive = make_archive()
+    ok_(make_uploader(server, jobs=2).upload('SPINS', archive))
+
+    method, path, body = server.requests[1]
+    eq_((method, path), ('POST', '/data/services/import'))
+    eq_(body, open(archive, 'rb').read())
+    eq_(resource_paths(server), ['exam/behav/run%201.log', 'exam/notes.txt'])
+    body, = [b for m, p, b in server.requests if p.endswith('.log')]
+    eq_(body, 'x' * 100000)
+    server.shutdown()
+
+def test_failed_requests_are_retried():
+    server = start_server({'/data/services/import': [503, 502]})
+    ok_(make_uploader(server).upload('SPINS', make_archive()))
+    eq_(len([r for r in server.requests if r[1] == '/data/services/import']), 3)
+    server.shutdown()
+
+def test_retries_run_out():
+    server = start_server({'/data/services/import': [503, 503, 503]})
+    ok_(not make_uploader(server, retries=2).upload('SPINS', make_archive()))
+    server.shutdown()
+
+@raises(requests.exceptions.HTTPError)
+def test_failed_resource_raises():
+    server = start_server({
+        '/data/archive/projects/SPINS/subjects/SPN01_CMH_0001_01_01'
+        '/experiments/SPN01_CMH_0001_01_01/files/exam/notes.txt': [404]})
+    try:
+        make_uploader(server).upload('SPINS', make_archive())
+    finally:
+        server.shutdown()
+
+def test_interrupted_upload_resumes():
+    journaldir = tempfile.mkdtemp(dir=TMPDIR)
+    archive = make_archive()
+    notes = ('/data/archive/projects/SPINS/subjects/SPN01_CMH_0001_01_01'
+             '/experiments/SPN01_CMH_0001_01_01/files/exam/notes.txt')
+
+    server = start_server({notes: [400]})
+    try:
+        make_uploader(server).upload('SPINS', archive, journaldir)
+    except requests.exceptions.HTTPError:
+        pass
+    server.shutdown()
+
+    server = start_server()
+    ok_(make_uploader(server).upload('SPINS', archive, journaldir))
+    eq_([path for method, path, body in server.requests], [notes])
+    server.shutdown()
+
+    record = json.load(open(os.path.join(journaldir,
+                                         'SPN01_CMH_0001_01_01.json')))
+    eq_(len(record['steps']), 4)
+
+def test_import_gateway_timeout_is_pending():
+    journaldir = tempfile.mkdtemp(dir=TMPDIR)
+    archive = make_archive()
+    wait, dm.xnat.IMPORT_TIMEOUT_WAIT = dm.xnat.IMPORT_TIMEOUT_WAIT, 0
+    try:
+        server = start_server({'/data/services/import': [504]})
+        ok_(make_uploader(server).upload('SPINS', archive, journaldir))
+        eq_(len([r for r in server.requests
+                 if r[1] == '/data/services/import']), 1)
+        server.shutdown()
+    finally:
+        dm.xnat.IMPORT_TIMEOUT_WAIT = wait
+
+    server = start_server()
+    ok_(make_uploader(server).upload('SPINS', archive, journaldir))
+    eq_(server.requests, [])
+    server.shutdown()
+
+def test_failed_subject_creation_is_not_journalled():
+    journaldir = tempfile.mkdtemp(dir=TMPDIR)
+    archive = make_archive()
+    subject = '/REST/projects/SPINS/subjects/SPN01_CMH_0001_01_01'
+
+    server = start_server({subject: [500]})
+    make_uploader(server, retries=0).upload('SPINS', archive, journaldir)
+    server.shutdown()
+    record = json.load(open(os.path.join(journaldir,
+                                         'SPN01_CMH_0001_01_01.json')))
+    ok_('subject' not in record['steps'])
+
+    server = start_server()
+    make_uploader(server).upload('SPINS', archive, journaldir)
+    eq_([(method, path) for method, path, body in server.requests],
+        [('PUT', subject)])
+    server.shutdown()
+
+# vim: ts=4 sw=4: